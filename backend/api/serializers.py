@@ -11,7 +11,7 @@ from core.utils import ExcludeFieldsMixin
 from operations.models import Share
 from tinkoff_api import TinkoffProfile
 from tinkoff_api.exceptions import InvalidTokenError
-from users.models import InvestmentAccount, Investor, CoOwner, Capital
+from users.models import InvestmentAccount, Investor, CoOwner, Capital, PortfolioPosition
 
 logger = logging.getLogger(__name__)
 
@@ -53,18 +53,28 @@ class InvestmentAccountSerializer(serializers.ModelSerializer):
     """ Сериализатор для ИС """
     class Meta:
         model = InvestmentAccount
-        fields = ['id', 'name', 'creator', 'token', 'broker_account_id']
+        fields = ['id', 'name', 'creator', 'token', 'broker_account_id', 'incomes_up_to_date']
 
     creator = serializers.PrimaryKeyRelatedField(read_only=True)
     broker_account_id = serializers.ReadOnlyField()
+    # False, пока есть сделки в очереди на перерасчет дохода (после изменения долей)
+    incomes_up_to_date = serializers.SerializerMethodField()
 
     def get_field_names(self, *args, **kwargs):
         """ Пользователь не должен получать поле token """
-        fields = super().get_field_names(*args, **kwargs)
+        # Копия, иначе token удаляется из Meta.fields и следующий запрос падает
+        fields = list(super().get_field_names(*args, **kwargs))
         if self.instance is not None and not hasattr(self, 'initial_data'):
             fields.remove('token')
         return fields
 
+    def get_incomes_up_to_date(self, investment_account: InvestmentAccount) -> bool:
+        # Аннотация InvestmentAccountView, у только что созданного/измененного ИС ее нет
+        has_outdated_incomes = getattr(investment_account, 'has_outdated_incomes', None)
+        if has_outdated_incomes is None:
+            has_outdated_incomes = investment_account.deals.income_outdated().exists()
+        return not has_outdated_incomes
+
     def validate_token(self, value: str) -> str:
         """ Валидация токена. Токен должен быть валидным +
             давать доступ к реальному портфелю пользователя (а не к песочнице)
@@ -165,3 +175,23 @@ class ShareSerializer(serializers.ModelSerializer):
             if total_share - self.instance.value + value > 1:
                 raise ValidationError('Доля не может быть такой большой')
         return value
+
+
+class PortfolioPositionSerializer(serializers.ModelSerializer):
+    """ Сериализатор позиции портфеля (только чтение) """
+    class Meta:
+        model = PortfolioPosition
+        fields = [
+            'id', 'investment_account', 'figi', 'instrument_type', 'balance', 'lots',
+            'average_position_price', 'expected_yield', 'expected_percent_profit', 'currency'
+        ]
+        read_only_fields = fields
+
+    expected_percent_profit = serializers.DecimalField(max_digits=20, decimal_places=4, read_only=True)
+
+
+class PortfolioCapitalSerializer(serializers.Serializer):
+    """ Стоимость позиций портфеля в одной валюте (только чтение) """
+    currency = serializers.CharField(read_only=True)
+    price = serializers.DecimalField(max_digits=20, decimal_places=4, read_only=True)
+    expected_yield = serializers.DecimalField(max_digits=20, decimal_places=4, read_only=True)
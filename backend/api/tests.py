@@ -1,3 +1,97 @@
+import datetime as dt
+import random
+from decimal import Decimal
+
+import pytz
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from market.models import Deal, StockInstrument
+from market.tests import create_deal_operations, create_investment_account
+from operations.models import Currency, Share
+from users.models import CoOwner, Investor, PortfolioPosition
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class IncomesUpToDateTest(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        self.creator = Investor.objects.create(username='creator')
+        self.investment_account = create_investment_account(self.creator)
+        CoOwner.objects.create(
+            investor=Investor.objects.create(username='co_owner'), investment_account=self.investment_account
+        )
+        instrument = StockInstrument.objects.create(
+            figi='FIGI', name='Apple', ticker='AAPL', lot=1, currency=currency, isin='US0378331005'
+        )
+        self.deal = Deal.objects.create(instrument=instrument, investment_account=self.investment_account)
+        create_deal_operations(random.Random(0), self.deal, dt.datetime(2020, 1, 1, tzinfo=pytz.utc), 5)
+        self.share = Share.objects.filter(operation__deal=self.deal).order_by('pk').first()
+        self.client = APIClient()
+        self.client.force_authenticate(self.creator)
+
+    def incomes_up_to_date(self):
+        response = self.client.get(reverse('investment_accounts-list'))
+        self.assertEqual(response.status_code, 200)
+        return {account['id']: account['incomes_up_to_date'] for account in response.json()}
+
+    def test_share_update_marks_deal_outdated(self):
+        self.assertEqual(self.incomes_up_to_date(), {self.investment_account.pk: True})
+        response = self.client.patch(
+            reverse('shares-detail', args=(self.share.pk, )), {'value': '0'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Share.objects.get(pk=self.share.pk).value, Decimal(0))
+        self.assertTrue(Deal.objects.income_outdated().filter(pk=self.deal.pk).exists())
+        self.assertEqual(self.incomes_up_to_date(), {self.investment_account.pk: False})
+
+    def test_share_destroy_marks_deal_outdated(self):
+        response = self.client.delete(reverse('shares-detail', args=(self.share.pk, )))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Share.objects.filter(pk=self.share.pk).exists())
+        self.assertTrue(Deal.objects.income_outdated().filter(pk=self.deal.pk).exists())
+
+    def test_list_queries_do_not_grow_with_accounts(self):
+        # Признак считается подзапросом в том же запросе, что и список ИС
+        with self.assertNumQueries(1):
+            self.incomes_up_to_date()
+        for number in range(3):
+            create_investment_account(self.creator, name=f'ИС {number}', token=f'token{number}')
+        Deal.objects.filter(pk=self.deal.pk).mark_income_outdated()
+        with self.assertNumQueries(1):
+            incomes_up_to_date = self.incomes_up_to_date()
+        self.assertEqual(len(incomes_up_to_date), 4)
+        self.assertFalse(incomes_up_to_date[self.investment_account.pk])
+        self.assertEqual(sum(incomes_up_to_date.values()), 3)
+
 
-# Create your tests here.
+@override_settings(ALLOWED_HOSTS=['testserver'])
+class PortfolioCapitalTest(TestCase):
+    def test_capital_by_currency(self):
+        for iso_code in ('USD', 'RUB'):
+            Currency.objects.create(iso_code=iso_code, abbreviation=iso_code, name=iso_code)
+        creator = Investor.objects.create(username='creator')
+        investment_account = create_investment_account(creator)
+        creator.default_investment_account = investment_account
+        creator.save(update_fields=('default_investment_account', ))
+        PortfolioPosition.objects.bulk_create([
+            PortfolioPosition(
+                investment_account=investment_account, figi=figi, instrument_type='Stock', balance=balance,
+                average_position_price=price, expected_yield=expected_yield, currency_id=currency
+            )
+            for figi, balance, price, expected_yield, currency in (
+                ('FIGI1', 2, 100, 10, 'USD'), ('FIGI2', 1, 50, -5, 'USD'), ('FIGI3', 10, 200, 30, 'RUB'),
+                ('FIGI4', 1, 1, 1, None)
+            )
+        ])
+        client = APIClient()
+        client.force_authenticate(creator)
+        response = client.get(reverse('portfolio_positions-capital'))
+        self.assertEqual(response.status_code, 200)
+        # Позиции в разных валютах не складываются, позиции без известной валюты не учитываются
+        self.assertEqual(response.json(), [
+            {'currency': 'RUB', 'price': '2000.0000', 'expected_yield': '30.0000'},
+            {'currency': 'USD', 'price': '250.0000', 'expected_yield': '5.0000'}
+        ])
@@ -1,6 +1,7 @@
 from rest_framework.routers import DefaultRouter
 
-from api.views import InvestmentAccountView, InvestorView, ShareView, CoOwnerView, CapitalView
+from api.views import InvestmentAccountView, InvestorView, ShareView, CoOwnerView, CapitalView, \
+    PortfolioPositionView
 
 router = DefaultRouter()
 router.register('investors', InvestorView, basename='investors')
@@ -8,5 +9,6 @@ router.register('investment-accounts', InvestmentAccountView, basename='investme
 router.register('co-owners', CoOwnerView, basename='co_owners')
 router.register('capital', CapitalView, basename='capital')
 router.register('shares', ShareView, basename='shares')
+router.register('portfolio-positions', PortfolioPositionView, basename='portfolio_positions')
 
 urlpatterns = router.urls
@@ -4,22 +4,24 @@ import logging
 import os
 from typing import List, Dict, Any, Set, Optional
 
-from django.db.models import F, Sum
+from django.db.models import Exists, F, OuterRef, Sum
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
 from rest_framework.filters import SearchFilter
 from rest_framework.response import Response
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
 from core.utils import PermissionsByActionMixin, CheckObjectPermissionMixin
+from market.models import Deal
 from operations.models import Share
-from users.models import InvestmentAccount, Investor, Capital, CoOwner
+from users.models import InvestmentAccount, Investor, Capital, CoOwner, PortfolioPosition
 from .annotations import T_CAPITAL_ID, T_CAPITAL_FIELD_NAME, T_CAPITAL_ID_INT, T_CURRENCY_ISO_CODE, \
     TValidatedDataByCurrency
 from .permissions import RequestUserPermissions
 from .serializers import InvestmentAccountSerializer, CoOwnerSerializer, \
-    ShareSerializer, SimplifiedInvestorSerializer, ExtendedInvestorSerializer, CapitalSerializer
+    ShareSerializer, SimplifiedInvestorSerializer, ExtendedInvestorSerializer, CapitalSerializer, \
+    PortfolioPositionSerializer, PortfolioCapitalSerializer
 
 logger = logging.getLogger(__name__)
 
@@ -74,7 +76,10 @@ class InvestmentAccountView(PermissionsByActionMixin, ModelViewSet):
         'partial_update': RequestUserPermissions.CanEditInvestmentAccount,
         'destroy': RequestUserPermissions.CanEditInvestmentAccount
     }
-    queryset = InvestmentAccount.objects.all()
+    # has_outdated_incomes - есть ли сделки в очереди на перерасчет дохода (одним подзапросом на весь список)
+    queryset = InvestmentAccount.objects.annotate(
+        has_outdated_incomes=Exists(Deal.objects.income_outdated().filter(investment_account=OuterRef('pk')))
+    )
 
     def filter_queryset(self, queryset):
         """ Список ИС, владельцем которых является пользователь """
@@ -250,6 +255,42 @@ class ShareView(PermissionsByActionMixin, ModelViewSet):
     queryset = Share.objects.all()
 
     def perform_update(self, serializer):
-        """ После изменения доли в операции, перерасчитывается доход от сделки """
+        """ После изменения доли в операции сделка ставится в очередь на перерасчет дохода.
+            Пересчет выполняет sync_worker, когда доли сделки перестают меняться,
+            поэтому несколько изменений подряд пересчитываются один раз (incomes_up_to_date у ИС)
+        """
         instance = serializer.save()
-        instance.operation.deal.recalculation_income()
+        Deal.objects.filter(pk=instance.operation.deal_id).mark_income_outdated()
+
+    def perform_destroy(self, instance):
+        """ После удаления доли в операции сделка тоже ставится в очередь на перерасчет дохода """
+        deal_id = instance.operation.deal_id
+        super().perform_destroy(instance)
+        Deal.objects.filter(pk=deal_id).mark_income_outdated()
+
+
+class PortfolioPositionView(PermissionsByActionMixin, ReadOnlyModelViewSet):
+    """ Позиции портфеля ИС по умолчанию, из снимка последней синхронизации """
+    serializer_class = PortfolioPositionSerializer
+    permissions_by_action = {
+        'retrieve': RequestUserPermissions.HasDefaultInvestmentAccount,
+        'list': RequestUserPermissions.HasDefaultInvestmentAccount,
+        'capital': RequestUserPermissions.HasDefaultInvestmentAccount
+    }
+    queryset = PortfolioPosition.objects.all()
+    lookup_field = 'figi'
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return queryset.filter(investment_account=self.request.user.default_investment_account)
+
+    @action(detail=False, methods=['get'])
+    def capital(self, request):
+        """ Стоимость портфеля по каждой валюте:
+            [{'currency': 'USD', 'price': 1000, 'expected_yield': 50}, ...]
+        """
+        capital_by_currency = self.filter_queryset(self.get_queryset()).capital_by_currency()
+        serializer = PortfolioCapitalSerializer([
+            {'currency': currency, **capital} for currency, capital in sorted(capital_by_currency.items())
+        ], many=True)
+        return Response(serializer.data)
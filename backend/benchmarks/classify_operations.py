@@ -0,0 +1,99 @@
+""" Бенчмарк классификации операций Updater.
+    Сравнивает однопроходный classify_operations с прежним подходом
+    (проход по копии списка и list.remove для каждой обработанной операции).
+
+    Запуск из директории backend:
+        python benchmarks/classify_operations.py [--sizes 12500 25000 50000 100000]
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from operations.models_constraints import OperationTypes, OperationStatuses  # noqa: E402
+from tinkoff_api._records import OperationRecord  # noqa: E402
+from users.services.operation_classifier import (  # noqa: E402
+    classify_operations, SIMPLE_OPERATION_TYPES, TRADE_OPERATION_TYPES
+)
+
+# Примерное распределение типов операций на реальном счете
+OPERATION_TYPE_WEIGHTS = {
+    OperationTypes.BUY: 40,
+    OperationTypes.SELL: 30,
+    OperationTypes.BROKER_COMMISSION: 10,
+    OperationTypes.DIVIDEND: 6,
+    OperationTypes.TAX_DIVIDEND: 6,
+    OperationTypes.PAY_IN: 4,
+    OperationTypes.SERVICE_COMMISSION: 2,
+    OperationTypes.TAX: 1,
+    OperationTypes.UNKNOWN: 1
+}
+
+
+def generate_operations(count: int, seed: int = 0):
+    rnd = random.Random(seed)
+    types = list(OPERATION_TYPE_WEIGHTS)
+    weights = list(OPERATION_TYPE_WEIGHTS.values())
+    start = dt.datetime(2018, 1, 1, tzinfo=dt.timezone.utc)
+    return [
+        OperationRecord(
+            id=str(i),
+            status=OperationStatuses.DONE if rnd.random() > 0.02 else OperationStatuses.DECLINE,
+            operation_type=operation_type,
+            date=start + dt.timedelta(minutes=i),
+            is_margin_call=False,
+            payment=Decimal(rnd.randint(-1000, 1000)),
+            currency='USD'
+        )
+        for i, operation_type in enumerate(rnd.choices(types, weights, k=count))
+    ]
+
+
+def classify_with_remove(operations):
+    """ Прежний алгоритм: обработанные операции удаляются из списка по одной """
+    operations = list(operations)
+    primary = []
+    for operation in operations.copy():
+        if operation.status != OperationStatuses.DONE:
+            operations.remove(operation)
+        elif operation.operation_type in SIMPLE_OPERATION_TYPES or \
+                operation.operation_type in TRADE_OPERATION_TYPES:
+            primary.append(operation)
+            operations.remove(operation)
+        elif operation.operation_type == OperationTypes.BROKER_COMMISSION:
+            operations.remove(operation)
+    dividend_taxes = []
+    for operation in operations.copy():
+        if operation.operation_type == OperationTypes.TAX_DIVIDEND:
+            dividend_taxes.append(operation)
+            operations.remove(operation)
+    return primary, dividend_taxes, operations
+
+
+def measure(func, operations) -> float:
+    started = time.perf_counter()
+    func(operations)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[12500, 25000, 50000, 100000])
+    parser.add_argument('--skip-remove', action='store_true', help='Не замерять прежний алгоритм')
+    args = parser.parse_args()
+
+    print(f'{"операций":>10} {"single-pass, с":>15} {"мкс/операцию":>13} {"list.remove, с":>15}')
+    for size in args.sizes:
+        operations = generate_operations(size)
+        single_pass = measure(classify_operations, operations)
+        remove = '-' if args.skip_remove else f'{measure(classify_with_remove, operations):.3f}'
+        print(f'{size:>10} {single_pass:>15.4f} {single_pass / size * 1e6:>13.3f} {remove:>15}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+""" Бенчмарк векторизованного расчета доходов (compute_incomes) против SmartInvestorSet.
+    Считает доходы всех сделок ИС: SmartInvestorSet проходит операции каждой сделки по одной,
+    compute_incomes считает все сделки сразу. Загрузка операций из БД не входит в замер.
+    В сгенерированных сделках дивиденды - четверть операций, после первых дивидендов сделки
+    compute_incomes складывает капитал в Decimal, поэтому без дивидендов (--without-dividends) разница больше.
+
+    Запуск из директории backend:
+        python benchmarks/income_engine.py [--deals 200] [--operations 50] [--investors 2 5 20] [--without-dividends]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+# БД не используется, достаточно приложений с моделями
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.auth', 'django.contrib.contenttypes',
+        'users.apps.UsersConfig', 'market.apps.MarketConfig', 'operations.apps.OperationsConfig'
+    ],
+    AUTH_USER_MODEL='users.Investor'
+)
+django.setup()
+
+from market.services.income_calculation import SmartInvestorSet  # noqa: E402
+from market.services.income_engine import compute_incomes  # noqa: E402
+from market.tests import generate_operations, pack_operations  # noqa: E402
+from operations.models_constraints import OperationTypes  # noqa: E402
+
+
+def measure_smart_investor_set(deals) -> float:
+    started = time.perf_counter()
+    for deal in deals:
+        smart_investor_set = SmartInvestorSet()
+        for operation in deal:
+            smart_investor_set.add_operation(operation)
+    return time.perf_counter() - started
+
+
+def measure_compute_incomes(deals, investors: int) -> float:
+    arrays = pack_operations(deals, investors)
+    started = time.perf_counter()
+    compute_incomes(**arrays)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--deals', type=int, default=200)
+    parser.add_argument('--operations', type=int, default=50, help='операций в сделке')
+    parser.add_argument('--investors', type=int, nargs='+', default=[2, 5, 20])
+    parser.add_argument('--without-dividends', action='store_true', help='только покупки и продажи')
+    args = parser.parse_args()
+
+    print(f'{"инвесторов":>10} {"SmartInvestorSet, с":>20} {"compute_incomes, с":>19} {"ускорение":>10}')
+    for investors in args.investors:
+        rnd = random.Random(0)
+        deals = [generate_operations(rnd, args.operations, investors) for _ in range(args.deals)]
+        if args.without_dividends:
+            deals = [[operation for operation in deal if operation.type != OperationTypes.DIVIDEND] for deal in deals]
+            deals = [deal for deal in deals if deal]
+        smart_investor_set = measure_smart_investor_set(deals)
+        vectorized = measure_compute_incomes(deals, investors)
+        print(f'{investors:>10} {smart_investor_set:>20.4f} {vectorized:>19.4f} '
+              f'{smart_investor_set / vectorized:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+""" Бенчмарк расчета дохода инвесторов за сделку (SmartInvestorSet).
+    Сравнивает накопительные суммы с прежним подходом, при котором общее количество бумаг
+    суммировалось по всем инвесторам для каждой доли (O(инвесторов²) на дивиденды).
+
+    Запуск из директории backend:
+        python benchmarks/smart_investor_set.py [--operations 2000] [--investors 2 10 50 200]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+# БД не используется, достаточно приложений с моделями
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.auth', 'django.contrib.contenttypes',
+        'users.apps.UsersConfig', 'market.apps.MarketConfig', 'operations.apps.OperationsConfig'
+    ],
+    AUTH_USER_MODEL='users.Investor'
+)
+django.setup()
+
+from market.services.income_calculation import SmartInvestorSet  # noqa: E402
+from market.tests import RecomputingSmartInvestorSet, generate_operations  # noqa: E402
+
+
+def measure(smart_investor_set_class, operations) -> float:
+    smart_investor_set = smart_investor_set_class()
+    started = time.perf_counter()
+    for operation in operations:
+        smart_investor_set.add_operation(operation)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--operations', type=int, default=2000)
+    parser.add_argument('--investors', type=int, nargs='+', default=[2, 10, 50, 200])
+    args = parser.parse_args()
+
+    print(f'{"инвесторов":>10} {"накопительно, с":>16} {"пересчет, с":>12} {"ускорение":>10}')
+    for investors in args.investors:
+        operations = generate_operations(random.Random(0), args.operations, investors)
+        running = measure(SmartInvestorSet, operations)
+        recomputing = measure(RecomputingSmartInvestorSet, operations)
+        print(f'{investors:>10} {running:>16.4f} {recomputing:>12.4f} {recomputing / running:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
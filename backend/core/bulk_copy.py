@@ -0,0 +1,89 @@
+""" Быстрая массовая вставка через COPY (PostgreSQL).
+    Строки потоком пишутся во временную таблицу, затем переносятся в основную одним
+    INSERT ... ON CONFLICT DO NOTHING, поведение такое же, как у bulk_create(ignore_conflicts=True).
+    Ограничения (CHECK, UNIQUE) основной таблицы проверяются при переносе
+"""
+import csv
+import functools
+import io
+import logging
+from typing import List
+
+from django.db import connection, models, transaction
+
+from core.utils import _get_is_abstract_by_proxy_model, _get_possible_types_by_proxy_model
+
+logger = logging.getLogger(__name__)
+
+# Меньше этого количества строк COPY не быстрее обычного bulk_create
+COPY_MIN_ROWS = 1000
+# Обозначение NULL в CSV, пустая строка остается пустой строкой
+COPY_NULL = r'\N'
+
+
+def _copy_fields(model) -> List[models.Field]:
+    """ Поля, которые записываются в таблицу (автоинкрементный id заполняет БД) """
+    return [
+        field for field in model._meta.concrete_fields
+        if not (field.primary_key and isinstance(field, models.AutoField))
+    ]
+
+
+def write_csv_rows(objs: list, fields: List[models.Field], buffer: io.StringIO) -> None:
+    """ Пишет объекты в buffer в формате CSV, значения подготавливаются так же, как при save() """
+    writer = csv.writer(buffer)
+    for obj in objs:
+        row = []
+        for field in fields:
+            value = field.get_db_prep_save(field.pre_save(obj, add=True), connection)
+            row.append(COPY_NULL if value is None else value)
+        writer.writerow(row)
+    buffer.seek(0)
+
+
+def copy_expert(cursor, sql: str, buffer: io.StringIO) -> None:
+    """ COPY через execute_wrappers подключения, как обычный cursor.execute.
+        Иначе COPY не видят обертки запросов (например, трассировка синхронизации)
+    """
+    def execute(sql, params, many, context):
+        return cursor.cursor.copy_expert(sql, buffer)
+    # Тот же порядок оберток, что и в CursorWrapper._execute_with_wrappers
+    executor = execute
+    for wrapper in reversed(connection.execute_wrappers):
+        executor = functools.partial(wrapper, executor)
+    executor(sql, None, False, {'connection': connection, 'cursor': cursor})
+
+
+def copy_create(model, objs: list, min_rows: int = COPY_MIN_ROWS) -> None:
+    """ Массовая вставка объектов с пропуском конфликтующих строк.
+        На других БД и для небольших пачек - обычный bulk_create(ignore_conflicts=True)
+    """
+    if connection.vendor != 'postgresql' or len(objs) < min_rows:
+        model.objects.bulk_create(objs, ignore_conflicts=True)
+        return
+    if hasattr(model, 'proxy_constraints'):
+        # То же, что делает ProxyInheritanceManager.bulk_create
+        _get_is_abstract_by_proxy_model(model, raise_exception=True)
+        for obj in objs:
+            obj.type = _get_possible_types_by_proxy_model(obj.__class__)[0]
+
+    quote_name = connection.ops.quote_name
+    fields = _copy_fields(model)
+    columns = ', '.join(quote_name(field.column) for field in fields)
+    table = quote_name(model._meta.db_table)
+    staging_table = quote_name(f'{model._meta.db_table}_staging')
+    buffer = io.StringIO()
+    write_csv_rows(objs, fields, buffer)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {staging_table}')
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE {staging_table} ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA'
+        )
+        copy_expert(
+            cursor, f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer
+        )
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging_table} ON CONFLICT DO NOTHING'
+        )
+        inserted = cursor.rowcount
+    logger.info(f'{model.__name__}: через COPY записано {inserted} из {len(objs)} строк')
@@ -0,0 +1,28 @@
+import os
+
+from django.core.management import BaseCommand, CommandError
+
+from market.services.market_data import MarketDataFeed
+
+
+class Command(BaseCommand):
+    help = (
+        'Последние цены ценных бумаг открытых сделок из streaming API Tinkoff. '
+        'Цены сохраняются в БД, страницы сайта берут ожидаемую доходность по ним'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--flush-interval',
+            type=float,
+            default=5,
+            help='Как часто в секундах обновлять подписку по открытым сделкам и сохранять цены'
+        )
+
+    def handle(self, *args, **options):
+        token = os.getenv('tinkoff_api_production_token')
+        if not token:
+            raise CommandError('Не задан tinkoff_api_production_token')
+        if options['flush_interval'] <= 0:
+            raise CommandError('--flush-interval должен быть больше 0')
+        MarketDataFeed(token, flush_interval=options['flush_interval']).run_forever()
@@ -0,0 +1,60 @@
+import datetime
+import os
+
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+
+from market.services.income_rebuild import IncomeRebuild
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчет дохода сделок (DealIncome) с начала пулом процессов. '
+        'Сделки ставятся в отдельную очередь полного пересчета, прерванный пересчет продолжается с --resume'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p', '--processes',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Количество процессов, у каждого не больше одного подключения к БД'
+        )
+        parser.add_argument(
+            '-a', '--account',
+            type=int,
+            nargs='+',
+            help='id ИС, по умолчанию - все ИС'
+        )
+        parser.add_argument(
+            '--since',
+            type=datetime.date.fromisoformat,
+            help='Пересчитать только сделки, в которых есть операции с этой даты (ГГГГ-ММ-ДД)'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help='Продолжить прерванный пересчет: пересчитать сделки, которые остались в очереди'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Сколько сделок одного ИС пересчитывается за раз'
+        )
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError('Количество процессов должно быть больше 0')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size должен быть больше 0')
+        since = options['since']
+        if since is not None:
+            since = timezone.make_aware(datetime.datetime.combine(since, datetime.time.min))
+        report = IncomeRebuild(
+            options['processes'], chunk_size=options['chunk_size'], investment_account_ids=options['account'],
+            since=since, resume=options['resume']
+        ).run()
+        for line in report.lines():
+            self.stdout.write(line)
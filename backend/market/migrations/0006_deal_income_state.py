@@ -0,0 +1,38 @@
+# Generated by Django 3.0.8 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0005_dealincome_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='income_applied_date',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Доход рассчитан по дату'),
+        ),
+        migrations.AddField(
+            model_name='deal',
+            name='income_applied_operation_id',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Доход рассчитан по операцию'),
+        ),
+        migrations.AddField(
+            model_name='dealincome',
+            name='capital',
+            field=models.DecimalField(decimal_places=50, default=0, max_digits=70, verbose_name='Капитал'),
+        ),
+        migrations.AddField(
+            model_name='dealincome',
+            name='last_dividend_share',
+            field=models.DecimalField(decimal_places=50, default=0, max_digits=70, verbose_name='Доля с последних дивидендов'),
+        ),
+        migrations.AddField(
+            model_name='dealincome',
+            name='stock_quantity',
+            field=models.DecimalField(decimal_places=50, default=0, max_digits=70, verbose_name='Количество бумаг'),
+        ),
+    ]
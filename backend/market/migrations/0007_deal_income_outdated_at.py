@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0006_deal_income_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='income_outdated_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Доход устарел с'),
+        ),
+    ]
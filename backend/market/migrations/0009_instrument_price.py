@@ -0,0 +1,26 @@
+# Generated by Django 3.0.8 on 2026-10-18 17:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0007_deal_income_outdated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstrumentPrice',
+            fields=[
+                ('instrument', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='last_price', serialize=False, to='market.InstrumentType', verbose_name='Ценная бумага')),
+                ('price', models.DecimalField(decimal_places=6, max_digits=20, verbose_name='Цена')),
+                ('time', models.DateTimeField(verbose_name='Время свечи')),
+            ],
+            options={
+                'verbose_name': 'Последняя цена',
+                'verbose_name_plural': 'Последние цены',
+            },
+        ),
+    ]
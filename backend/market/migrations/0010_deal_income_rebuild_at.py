@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0009_instrument_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deal',
+            name='income_rebuild_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='В очереди полного пересчета с'),
+        ),
+    ]
@@ -1,12 +1,21 @@
+import datetime
+import logging
+import os
+from typing import Iterable, List
+
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Sum, F, Q, Case, When
 from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 from core.utils import ProxyInheritanceManager, ProxyQ
 from market.models_constraints import InstrumentTypeConstraints, InstrumentTypeTypes
-from market.services.income_calculation import SmartInvestorSet
-from operations.models import SaleOperation, PurchaseOperation, DividendOperation
+from market.services.income_engine import IncomeEngine
+from operations.models import SaleOperation, PurchaseOperation
+from tinkoff_api import LastPriceTable
+
+logger = logging.getLogger(__name__)
 
 
 class InstrumentType(models.Model):
@@ -88,6 +97,92 @@ class DealQuerySet(models.QuerySet):
             )
         )
 
+    def income_outdated(self):
+        """ Сделки, доход которых надо пересчитать """
+        return self.filter(income_outdated_at__isnull=False)
+
+    def mark_income_outdated(self, now: datetime.datetime = None) -> int:
+        """ Ставит сделки в очередь на пересчет дохода (после изменения долей в операциях) """
+        return self.update(income_outdated_at=now or timezone.now())
+
+    def clear_income_outdated(self, before: datetime.datetime) -> int:
+        """ Убирает из очереди сделки, помеченные не позже before.
+            Сделки, которые изменились во время пересчета, остаются в очереди
+        """
+        return self.filter(income_outdated_at__lte=before).update(income_outdated_at=None)
+
+    def income_rebuild_queued(self):
+        """ Сделки, которые ждут полного пересчета дохода (manage.py recalculate_incomes) """
+        return self.filter(income_rebuild_at__isnull=False)
+
+    def mark_income_rebuild(self, now: datetime.datetime) -> int:
+        """ Ставит сделки в очередь полного пересчета дохода.
+            Очередь отдельная от income_outdated_at, поэтому на время пересчета доход ИС не считается устаревшим
+        """
+        return self.update(income_rebuild_at=now)
+
+    def lock_for_income(self, skip_locked: bool = False) -> List[int]:
+        """ Блокирует строки сделок до конца транзакции, чтобы доход сделки записывал только один процесс
+            (воркер, синхронизация или полный пересчет). Вызывается внутри transaction.atomic()
+        :param skip_locked: пропустить сделки, заблокированные другим процессом, вместо ожидания
+        :return: id заблокированных сделок
+        """
+        return list(self.select_for_update(skip_locked=skip_locked).order_by('pk').values_list('pk', flat=True))
+
+    def recalculate_outdated_incomes(self, delay: datetime.timedelta, now: datetime.datetime = None) -> int:
+        """ Пересчет дохода сделок из очереди.
+            Сделка пересчитывается, если ее доли не менялись delay, поэтому серия изменений
+            пересчитывается один раз, сделки одного ИС - одним IncomeEngine
+        :return: количество пересчитанных сделок
+        """
+        now = now or timezone.now()
+        before = now - delay
+        deal_ids_by_account = {}
+        for deal_id, investment_account_id in (
+            self.income_outdated().filter(income_outdated_at__lte=before).values_list('pk', 'investment_account_id')
+        ):
+            deal_ids_by_account.setdefault(investment_account_id, []).append(deal_id)
+        recalculated = 0
+        for investment_account_id, deal_ids in deal_ids_by_account.items():
+            try:
+                deal_ids = self._recalculate_locked_incomes(investment_account_id, deal_ids, before)
+            except Exception:
+                logger.exception(
+                    f'Пересчет дохода сделок ИС {investment_account_id} не удался, сделки пересчитываются по одной'
+                )
+                deal_ids = self._recalculate_incomes_one_by_one(investment_account_id, deal_ids, before, now)
+            recalculated += len(deal_ids)
+        return recalculated
+
+    def _recalculate_locked_incomes(self, investment_account_id: int, deal_ids: List[int],
+                                    before: datetime.datetime) -> List[int]:
+        """ Пересчет дохода сделок, которые не заблокированы другим процессом, и удаление их из очереди.
+            Заблокированные сделки остаются в очереди до следующего цикла
+        :return: id пересчитанных сделок
+        """
+        with transaction.atomic():
+            deal_ids = self.model.objects.filter(pk__in=deal_ids).lock_for_income(skip_locked=True)
+            if deal_ids:
+                IncomeEngine(investment_account_id, deal_ids=deal_ids).run()
+                self.model.objects.filter(pk__in=deal_ids).clear_income_outdated(before)
+        return deal_ids
+
+    def _recalculate_incomes_one_by_one(self, investment_account_id: int, deal_ids: List[int],
+                                        before: datetime.datetime, now: datetime.datetime) -> List[int]:
+        """ Пересчет дохода сделок по одной, чтобы сделка с ошибкой не мешала остальным.
+            Сделка с ошибкой остается в очереди, но откладывается на delay от now,
+            чтобы не пересчитываться в каждом цикле воркера
+        :return: id пересчитанных сделок
+        """
+        recalculated = []
+        for deal_id in deal_ids:
+            try:
+                recalculated += self._recalculate_locked_incomes(investment_account_id, [deal_id], before)
+            except Exception:
+                logger.exception(f'Пересчет дохода сделки {deal_id} не удался')
+                self.model.objects.filter(pk=deal_id).mark_income_outdated(now)
+        return recalculated
+
 
 class DealManager(models.Manager):
     def get_queryset(self):
@@ -102,6 +197,15 @@ class DealManager(models.Manager):
     def with_closed_annotations(self):
         return self.get_queryset().with_closed_annotations()
 
+    def income_outdated(self):
+        return self.get_queryset().income_outdated()
+
+    def income_rebuild_queued(self):
+        return self.get_queryset().income_rebuild_queued()
+
+    def recalculate_outdated_incomes(self, delay: datetime.timedelta, now: datetime.datetime = None) -> int:
+        return self.get_queryset().recalculate_outdated_incomes(delay, now)
+
 
 class Deal(models.Model):
     """ Набор операций для одной компании/фонда и т.д.
@@ -120,35 +224,30 @@ class Deal(models.Model):
         related_name='deals'
     )
     co_owners = models.ManyToManyField('users.CoOwner', through='DealIncome')
+    # Последняя операция, учтенная в состоянии совладельцев (DealIncome), новые операции добавляются после нее
+    income_applied_date = models.DateTimeField(verbose_name='Доход рассчитан по дату', null=True, blank=True)
+    income_applied_operation_id = models.PositiveIntegerField(
+        verbose_name='Доход рассчитан по операцию', null=True, blank=True
+    )
+    # Когда доход сделки устарел (последнее изменение долей), None - доход актуален
+    income_outdated_at = models.DateTimeField(
+        verbose_name='Доход устарел с', null=True, blank=True, db_index=True
+    )
+    # Когда сделка поставлена в очередь полного пересчета дохода (recalculate_incomes), None - не в очереди
+    income_rebuild_at = models.DateTimeField(
+        verbose_name='В очереди полного пересчета с', null=True, blank=True, db_index=True
+    )
+
+    @staticmethod
+    def income_recalculation_delay() -> datetime.timedelta:
+        """ Сколько ждать после последнего изменения долей сделки перед пересчетом дохода
+            (PROJECT_INCOME_RECALCULATION_DELAY, в секундах), чтобы серия изменений пересчитывалась один раз
+        """
+        return datetime.timedelta(seconds=float(os.getenv('PROJECT_INCOME_RECALCULATION_DELAY', 5)))
 
     def recalculation_income(self):
-        """ Перерасчет дохода со сделки для каждого участника """
-        # XXX
-        # Получаем все операции покупки/продажи и операции получения дивидендов
-        operations = (
-            self.operations
-            .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation))
-            .prefetch_related('shares')
-        )
-        # Для расчета дохода каждого инвестора от сделки используется этот класс
-        smart_investors_set = SmartInvestorSet()
-        smart_investors_set.add_operations(operations)
-
-        currency = operations.last().currency
-        DealIncome.objects.exclude(co_owner__in=smart_investors_set.investors).delete()
-        DealIncome.objects.bulk_create(
-            [
-                DealIncome(deal=self, co_owner=i, currency=currency)
-                for i in smart_investors_set.investors
-            ],
-            ignore_conflicts=True
-        )
-        deal_income_set = DealIncome.objects.filter(deal=self).select_related('co_owner')
-        deal_income_bulk_update = []
-        for deal_income in deal_income_set:
-            deal_income.value = smart_investors_set[deal_income.co_owner].capital
-            deal_income_bulk_update.append(deal_income)
-        DealIncome.objects.bulk_update(deal_income_bulk_update, fields=['value'])
+        """ Перерасчет дохода со сделки для каждого участника (с начала сделки) """
+        IncomeEngine(self.investment_account_id, deal_ids=[self.pk]).run()
 
     def __str__(self):
         return f'Deal({self.instrument.name})'
@@ -174,5 +273,44 @@ class DealIncome(models.Model):
     value = models.DecimalField(verbose_name='Доход', max_digits=20, decimal_places=4, default=0)
     currency = models.ForeignKey('operations.Currency', verbose_name='Валюта', on_delete=models.CASCADE)
 
+    # Состояние совладельца в сделке (SmartInvestor), к нему применяются новые операции сделки.
+    # Точности хватает, чтобы хранить Decimal (28 значащих цифр) без округления, иначе результат применения
+    # операций по частям расходится с пересчетом с начала
+    stock_quantity = models.DecimalField(
+        verbose_name='Количество бумаг', max_digits=70, decimal_places=50, default=0
+    )
+    capital = models.DecimalField(verbose_name='Капитал', max_digits=70, decimal_places=50, default=0)
+    last_dividend_share = models.DecimalField(
+        verbose_name='Доля с последних дивидендов', max_digits=70, decimal_places=50, default=0
+    )
+
     def __str__(self):
         return f'{self.deal}: {self.co_owner} ({self.value})'
+
+
+class InstrumentPriceQuerySet(models.QuerySet):
+    def table(self, figies: Iterable[str]) -> LastPriceTable:
+        """ Последние цены инструментов в виде LastPriceTable """
+        prices = LastPriceTable()
+        for instrument_price in self.filter(instrument_id__in=figies):
+            prices.update(instrument_price.instrument_id, instrument_price.price, instrument_price.time)
+        return prices
+
+
+class InstrumentPrice(models.Model):
+    """ Последняя цена инструмента из streaming API (пишет market_data_stream, читают страницы сайта) """
+    class Meta:
+        verbose_name = 'Последняя цена'
+        verbose_name_plural = 'Последние цены'
+
+    objects = InstrumentPriceQuerySet.as_manager()
+
+    instrument = models.OneToOneField(
+        InstrumentType, verbose_name='Ценная бумага', on_delete=models.CASCADE, primary_key=True,
+        related_name='last_price'
+    )
+    price = models.DecimalField(verbose_name='Цена', max_digits=20, decimal_places=6)
+    time = models.DateTimeField(verbose_name='Время свечи')
+
+    def __str__(self):
+        return f'{self.instrument_id}: {self.price} ({self.time})'
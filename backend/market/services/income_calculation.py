@@ -1,24 +1,30 @@
 """ Расчет доходов каждого инвестора за определенную сделку
 """
-import operator
 from decimal import Decimal
-from typing import Union, Dict, NoReturn
+from typing import Union, Dict, NoReturn, Optional, Tuple
 
 from core.utils import is_proxy_instance
 from operations.models import DividendOperation, SaleOperation, PurchaseOperation
 
 
-# Как правило, это либо username, либо id, либо CoOwner
-T_INVESTOR = Union[str, int, 'users.CoOwner']
+# Как правило, это id совладельца (Share.co_owner_id)
+T_INVESTOR = Union[str, int]
 T_OPERATIONS = Union[PurchaseOperation, SaleOperation, DividendOperation]
 T_OPERATIONS_QUERYSET = Union['django.db.models.QuerySet']
 
 
 class SmartInvestorSet:
-    """ Набор совладельцев одной сделки """
+    """ Набор совладельцев одной сделки.
+        Общее количество бумаг и общий капитал обновляются при каждом изменении инвестора,
+        поэтому доля инвестора считается за O(1), а не суммированием по всем инвесторам
+    """
     def __init__(self):
         self.investors: Dict[T_INVESTOR, 'SmartInvestor'] = {}
         self.currency = None
+        # Сумма stock_quantity всех инвесторов
+        self._total_stock_quantity = Decimal(0)
+        # Сумма capital всех инвесторов по валютам
+        self._total_capital_by_currency: Dict[str, Decimal] = {}
 
     def __getitem__(self, item: T_INVESTOR) -> 'SmartInvestor':
         try:
@@ -30,8 +36,8 @@ class SmartInvestorSet:
     def add_operation(self, operation: T_OPERATIONS) -> None:
         """ Добавляет одну операцию """
         if self.currency is None:
-            self.currency = operation.currency
-        elif self.currency != operation.currency:
+            self.currency = operation.currency_id
+        elif self.currency != operation.currency_id:
             raise ValueError('У всех операций должна быть одинаковая валюта')
         # FIXME: считать дивиденды, надо относительно момента, когда была див. отсечка
         if is_proxy_instance(operation, DividendOperation):
@@ -42,7 +48,7 @@ class SmartInvestorSet:
                 investor.last_dividend_share = investor.share_of_stock_quantity
         elif is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
             for share in operation.shares.all():
-                investor = self[share.co_owner]
+                investor = self[share.co_owner_id]
                 if is_proxy_instance(operation, PurchaseOperation):
                     # Количество акций у инвестора увеличивается на
                     # количество купленных за операцию акций * долю инвестора в операции
@@ -60,14 +66,38 @@ class SmartInvestorSet:
                     # (Стоимость операции + комиссия за операцию) * долю в операции
                     investor.capital += (operation.payment + operation.commission) * share.value
 
+    @classmethod
+    def from_state(cls, currency: str, states: Dict[T_INVESTOR, Tuple[Decimal, Decimal, Decimal]]
+                   ) -> 'SmartInvestorSet':
+        """ Набор, восстановленный из сохраненного состояния (DealIncome), к нему можно добавлять новые операции
+        :param currency: валюта сделки
+        :param states: (количество бумаг, капитал, доля с последних дивидендов) каждого инвестора
+        """
+        smart_investor_set = cls()
+        smart_investor_set.currency = currency
+        for key, (stock_quantity, capital, last_dividend_share) in states.items():
+            investor = smart_investor_set[key]
+            investor.stock_quantity = stock_quantity
+            investor.capital = capital
+            investor.last_dividend_share = last_dividend_share
+        return smart_investor_set
+
     def add_operations(self, operations: T_OPERATIONS_QUERYSET) -> None:
         """ Добавляет список операций"""
         for operation in operations.order_by('date'):
             self.add_operation(operation)
 
-    def total_stock_quantity(self):
+    def total_stock_quantity(self) -> Decimal:
         """ Общее количество акций на руках инвесторов """
-        return sum(map(operator.attrgetter('stock_quantity'), self.investors.values()))
+        return self._total_stock_quantity
+
+    def total_capital(self, currency: Optional[str] = None) -> Decimal:
+        """ Общий капитал инвесторов в валюте currency, по умолчанию - в валюте сделки """
+        return self._total_capital_by_currency.get(currency or self.currency, Decimal(0))
+
+    def total_capital_by_currency(self) -> Dict[str, Decimal]:
+        """ Общий капитал инвесторов по каждой валюте """
+        return dict(self._total_capital_by_currency)
 
     def __iter__(self):
         return iter(self.investors.values())
@@ -85,13 +115,33 @@ class SmartInvestor:
         # Инвестор может быть любого строкой или числом (как правило username или id)
         self.investor: T_INVESTOR = investor
         # Количество ценных бумаг у инвестора
-        self.stock_quantity: Decimal = Decimal(0)
+        self._stock_quantity: Decimal = Decimal(0)
         # Количество денег у инвестора
-        self.capital = Decimal(0)
+        self._capital = Decimal(0)
         # Доля с последних дивидендов
         # Нужна чтобы расчитать, какую часть налога на дивиденды, инвестор должен отдать
         self.last_dividend_share = 0
 
+    @property
+    def stock_quantity(self) -> Decimal:
+        return self._stock_quantity
+
+    @stock_quantity.setter
+    def stock_quantity(self, value: Decimal) -> None:
+        self.smart_investor_set._total_stock_quantity += value - self._stock_quantity
+        self._stock_quantity = value
+
+    @property
+    def capital(self) -> Decimal:
+        return self._capital
+
+    @capital.setter
+    def capital(self, value: Decimal) -> None:
+        totals = self.smart_investor_set._total_capital_by_currency
+        currency = self.smart_investor_set.currency
+        totals[currency] = totals.get(currency, Decimal(0)) + value - self._capital
+        self._capital = value
+
     @property
     def share_of_stock_quantity(self) -> Decimal:
         """ Доля акций среди всех совладельцев """
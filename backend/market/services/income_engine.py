@@ -0,0 +1,382 @@
+""" Векторизованный расчет доходов совладельцев по всем сделкам ИС.
+    Считает то же, что и SmartInvestorSet, но для всех сделок сразу:
+    операции и доли загружаются несколькими запросами и упаковываются в массивы NumPy
+    (операции × совладельцы), доходы считаются векторно, без цикла по операциям.
+    Количество бумаг и деньги покупок/продаж считаются целыми числами (int64), доли дивидендов - Decimal,
+    а капитал после первых дивидендов сделки складывается в Decimal по порядку операций,
+    поэтому результат совпадает с SmartInvestorSet до последнего знака.
+
+    Вместе с доходом в DealIncome сохраняется состояние совладельца (количество бумаг, капитал,
+    доля с последних дивидендов), а в Deal - последняя учтенная операция. Новые операции сделки
+    применяются к сохраненному состоянию (IncomeEngine.apply), полный пересчет нужен, только если
+    операция пришла раньше уже учтенных или изменились доли в прошлых операциях
+"""
+import datetime as dt
+import logging
+from decimal import Decimal
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from django.apps import apps
+from django.db import transaction
+
+from core.utils import _get_possible_types_by_proxy_model
+from market.services.income_calculation import SmartInvestorSet
+from operations.models import PurchaseOperation, SaleOperation, DividendOperation
+
+logger = logging.getLogger(__name__)
+
+# Вид операции в массиве kinds
+PURCHASE, SALE, DIVIDEND = 0, 1, 2
+# Доли (Share.value, 8 знаков после запятой) переводятся в целые числа, чтобы количество бумаг считалось точно
+SHARE_PLACES = 8
+SHARE_SCALE = 10 ** SHARE_PLACES
+# При покупке количество умножается на долю, при продаже - на долю / 100 (как в SmartInvestorSet)
+PURCHASE_QUANTITY_FACTOR, SALE_QUANTITY_FACTOR = 100, -1
+# Единица количества бумаг в compute_incomes
+STOCK_QUANTITY_SCALE = SHARE_SCALE * PURCHASE_QUANTITY_FACTOR
+# Перевод целых чисел массива (в т.ч. np.int64) в Decimal
+to_decimal = np.frompyfunc(lambda value: Decimal(int(value)), 1, 1)
+# Перевод целых чисел Python (массив object) в Decimal
+integer_to_decimal = np.frompyfunc(Decimal, 1, 1)
+
+
+class IncomeState(NamedTuple):
+    """ Доход и состояние совладельца в сделке (поля DealIncome) """
+    value: Decimal
+    stock_quantity: Decimal
+    capital: Decimal
+    last_dividend_share: Decimal
+
+
+def compute_incomes(deal_starts: np.ndarray, kinds: np.ndarray, quantity: np.ndarray, trade_payment: np.ndarray,
+                    dividend_payment: np.ndarray, shares: np.ndarray, has_share: np.ndarray
+                    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Доходы совладельцев по сделкам
+    :param deal_starts: индекс первой операции каждой сделки (операции отсортированы по сделке и дате)
+    :param kinds: вид операции (PURCHASE, SALE, DIVIDEND)
+    :param quantity: количество бумаг в операции
+    :param trade_payment: payment + commission (для покупок и продаж), Decimal
+    :param dividend_payment: payment + dividend_tax (для дивидендов), Decimal
+    :param shares: доли совладельцев в операциях, целые числа (Share.value * SHARE_SCALE), операции × совладельцы
+    :param has_share: есть ли у совладельца доля в операции
+    :return: доходы (сделки × совладельцы, Decimal), участники сделок (совладельцы, у которых есть доля
+        в покупке/продаже), количество бумаг в конце сделки (в единицах 1 / STOCK_QUANTITY_SCALE)
+        и доля с последних дивидендов сделки (Decimal)
+    """
+    operations_count = len(kinds)
+    is_trade = kinds != DIVIDEND
+    deal_index = np.repeat(np.arange(len(deal_starts)), np.diff(np.append(deal_starts, operations_count)))
+
+    # Количество бумаг у совладельцев после каждой операции, в единицах 1 / (SHARE_SCALE * 100)
+    quantity_factor = np.select(
+        (kinds == PURCHASE, kinds == SALE), (PURCHASE_QUANTITY_FACTOR, SALE_QUANTITY_FACTOR), 0
+    ) * quantity
+    # Большие объемы не помещаются в int64, тогда считаем целыми числами Python
+    bound = int(np.abs(quantity_factor).sum()) * int(shares.max(initial=0))
+    dtype = np.int64 if bound < 2 ** 62 else object
+    quantity_delta = shares.astype(dtype) * quantity_factor.astype(dtype)[:, None]
+    stock_quantity = np.cumsum(quantity_delta, axis=0)
+    # Накопленная сумма считается по всем операциям сразу, вычитаем то, что накопилось до начала сделки
+    stock_quantity -= (stock_quantity[deal_starts] - quantity_delta[deal_starts])[deal_index]
+
+    # Дивиденды делятся пропорционально количеству бумаг на момент получения.
+    # Доля - деление Decimal, как в SmartInvestor.share_of_stock_quantity (0, если бумаг ни у кого нет)
+    is_dividend = ~is_trade
+    dividend_stock_quantity = to_decimal(stock_quantity[is_dividend]) / Decimal(STOCK_QUANTITY_SCALE)
+    total_stock_quantity = dividend_stock_quantity.sum(axis=1, initial=Decimal(0))
+    has_stocks = total_stock_quantity != 0
+    dividend_share = np.full(dividend_stock_quantity.shape, Decimal(0), dtype=object)
+    dividend_share[has_stocks] = dividend_stock_quantity[has_stocks] / total_stock_quantity[has_stocks][:, None]
+
+    # Деньги покупок и продаж - целые числа в единицах 1 / 10 ** (money_places + SHARE_PLACES), их сумма точная.
+    # Пока в сделке не было дивидендов, капитал - накопленная сумма этих чисел (SmartInvestorSet тоже
+    # складывает их без округления), после дивидендов складываем Decimal по порядку, как SmartInvestorSet
+    trade_payments = trade_payment[is_trade].tolist()
+    money_places = max([-payment.as_tuple().exponent for payment in trade_payments] + [0])
+    payment_units = np.zeros(operations_count, dtype=object)
+    payment_units[is_trade] = [int(payment.scaleb(money_places)) for payment in trade_payments]
+    bound = int(np.abs(payment_units).sum()) * int(shares.max(initial=0))
+    dtype = np.int64 if bound < 2 ** 62 else object
+    capital_delta = shares.astype(dtype) * payment_units.astype(dtype)[:, None]
+    trade_capital = np.cumsum(capital_delta, axis=0)
+    trade_capital -= (trade_capital[deal_starts] - capital_delta[deal_starts])[deal_index]
+    capital_places = money_places + SHARE_PLACES
+    capital_unit = Decimal(1).scaleb(-capital_places)
+
+    def from_units(values: np.ndarray) -> np.ndarray:
+        # Умножение на степень 10 точное, а целые числа Python переводятся в Decimal быстрее, чем np.int64
+        return integer_to_decimal(values.astype(object)) * capital_unit
+
+    deal_ends = np.append(deal_starts[1:], operations_count) - 1
+    incomes = from_units(trade_capital[deal_ends])
+    # Номер строки в dividend_share для каждой операции-дивиденда
+    dividend_rows = np.cumsum(is_dividend) - 1
+    first_dividend = np.minimum.reduceat(
+        np.where(is_dividend, np.arange(operations_count), operations_count), deal_starts
+    )
+    # Операции с первых дивидендов сделки до ее конца, их деньги складываются в Decimal
+    tail_rows = np.flatnonzero(np.arange(operations_count) >= first_dividend[deal_index])
+    if len(tail_rows):
+        tail = np.empty((len(tail_rows), shares.shape[1]), dtype=object)
+        tail_trade, tail_dividend = tail_rows[is_trade[tail_rows]], tail_rows[is_dividend[tail_rows]]
+        tail[is_trade[tail_rows]] = from_units(capital_delta[tail_trade])
+        tail[is_dividend[tail_rows]] = (
+            dividend_payment[tail_dividend][:, None] * dividend_share[dividend_rows[tail_dividend]]
+        )
+        tail_deals = deal_index[tail_rows]
+        tail_starts = np.flatnonzero(np.diff(tail_deals, prepend=-1))
+        # Первая строка - дивиденды, в capital_delta у них нули, поэтому trade_capital на ней - капитал до них
+        tail[tail_starts] = from_units(trade_capital[tail_rows[tail_starts]]) + tail[tail_starts]
+        # reduceat складывает по порядку строк, как SmartInvestorSet
+        incomes[tail_deals[tail_starts]] = np.add.reduceat(tail, tail_starts, axis=0)
+    participants = np.logical_or.reduceat(has_share & is_trade[:, None], deal_starts, axis=0)
+
+    final_stock_quantity = stock_quantity[deal_ends]
+    # Индекс последних дивидендов в каждой сделке, -1 - дивидендов не было
+    last_dividend = np.maximum.reduceat(
+        np.where(kinds == DIVIDEND, np.arange(operations_count), -1), deal_starts
+    )
+    last_dividend_share = np.full((len(deal_starts), shares.shape[1]), Decimal(0), dtype=object)
+    has_dividends = last_dividend >= 0
+    last_dividend_share[has_dividends] = dividend_share[dividend_rows[last_dividend[has_dividends]]]
+    return incomes, participants, final_stock_quantity, last_dividend_share
+
+
+class IncomeEngine:
+    """ Пересчет DealIncome для сделок ИС """
+    # Сколько знаков после запятой у DealIncome.value
+    decimal_places = 4
+
+    def __init__(self, investment_account_id: int, deal_ids: Optional[List[int]] = None):
+        """
+        :param investment_account_id: id ИС
+        :param deal_ids: сделки, доход которых пересчитывается, None - все сделки ИС
+        """
+        self.investment_account_id = investment_account_id
+        self.deal_ids = deal_ids
+
+    def load_operations(self) -> list:
+        operation_model = apps.get_model('operations', 'Operation')
+        operations = operation_model.objects.filter(
+            proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation),
+            investment_account_id=self.investment_account_id, deal__isnull=False
+        )
+        if self.deal_ids is not None:
+            operations = operations.filter(deal_id__in=self.deal_ids)
+        return list(
+            operations.order_by('deal_id', 'date', 'pk').values_list(
+                'pk', 'deal_id', 'type', 'quantity', 'payment', 'commission', 'dividend_tax', 'currency_id', 'date'
+            )
+        )
+
+    def load_shares(self, operation_ids: List[int]) -> list:
+        share_model = apps.get_model('operations', 'Share')
+        return list(
+            share_model.objects.filter(operation_id__in=operation_ids)
+            .values_list('operation_id', 'co_owner_id', 'value')
+        )
+
+    def compute(self) -> Tuple[Dict[Tuple[int, int], IncomeState], Dict[int, str],
+                               Dict[int, Tuple[dt.datetime, int]]]:
+        """ Доходы совладельцев с начала сделок
+        :return: доход и состояние по (id сделки, id совладельца), валюта и последняя операция (дата, id) сделки
+        """
+        operations = self.load_operations()
+        if not operations:
+            return {}, {}, {}
+        kind_by_type = {
+            **{operation_type: PURCHASE for operation_type in _get_possible_types_by_proxy_model(PurchaseOperation)},
+            **{operation_type: SALE for operation_type in _get_possible_types_by_proxy_model(SaleOperation)},
+            **{operation_type: DIVIDEND for operation_type in _get_possible_types_by_proxy_model(DividendOperation)},
+        }
+        (operation_ids, deal_ids, types, quantity, payment, commission, dividend_tax, currencies,
+         dates) = zip(*operations)
+
+        deal_starts, currency_by_deal, last_operations = [], {}, {}
+        for index, (deal_id, currency) in enumerate(zip(deal_ids, currencies)):
+            if deal_id not in currency_by_deal:
+                deal_starts.append(index)
+                currency_by_deal[deal_id] = currency
+            elif currency_by_deal[deal_id] != currency:
+                raise ValueError('У всех операций должна быть одинаковая валюта')
+            last_operations[deal_id] = (dates[index], operation_ids[index])
+
+        shares = self.load_shares(operation_ids)
+        co_owner_ids = sorted({co_owner_id for _, co_owner_id, _ in shares})
+        operation_index = {operation_id: index for index, operation_id in enumerate(operation_ids)}
+        co_owner_index = {co_owner_id: index for index, co_owner_id in enumerate(co_owner_ids)}
+        share_matrix = np.zeros((len(operation_ids), len(co_owner_ids)), dtype=np.int64)
+        has_share = np.zeros(share_matrix.shape, dtype=bool)
+        if shares:
+            rows = np.fromiter((operation_index[operation_id] for operation_id, _, _ in shares), dtype=np.int64)
+            columns = np.fromiter((co_owner_index[co_owner_id] for _, co_owner_id, _ in shares), dtype=np.int64)
+            share_matrix[rows, columns] = [int(value * SHARE_SCALE) for _, _, value in shares]
+            has_share[rows, columns] = True
+
+        incomes, participants, stock_quantity, last_dividend_share = compute_incomes(
+            deal_starts=np.array(deal_starts, dtype=np.int64),
+            kinds=np.array([kind_by_type[i] for i in types], dtype=np.int8),
+            quantity=np.array(quantity, dtype=np.int64),
+            trade_payment=np.array([p + c for p, c in zip(payment, commission)], dtype=object),
+            dividend_payment=np.array([p + t for p, t in zip(payment, dividend_tax)], dtype=object),
+            shares=share_matrix,
+            has_share=has_share
+        )
+        deal_order = list(currency_by_deal)
+        result = {}
+        for deal_position, column in zip(*np.nonzero(participants)):
+            result[(deal_order[deal_position], co_owner_ids[column])] = self.income_state(
+                capital=incomes[deal_position, column],
+                stock_quantity=Decimal(int(stock_quantity[deal_position, column])) / STOCK_QUANTITY_SCALE,
+                last_dividend_share=last_dividend_share[deal_position, column]
+            )
+        return result, currency_by_deal, last_operations
+
+    def income_state(self, capital: Decimal, stock_quantity: Decimal, last_dividend_share: Decimal) -> IncomeState:
+        """ Состояние для DealIncome: доход округляется, состояние совладельца сохраняется без потери точности,
+            чтобы следующие операции применялись к нему так же, как при пересчете с начала
+        """
+        return IncomeState(
+            value=round(capital, self.decimal_places),
+            stock_quantity=stock_quantity,
+            capital=capital,
+            last_dividend_share=Decimal(last_dividend_share)
+        )
+
+    def run(self) -> int:
+        """ Пересчитывает доходы с начала сделок и записывает их.
+            Сделки блокируются до записи, чтобы их доход одновременно не писал другой процесс
+        :return: количество записанных DealIncome
+        """
+        deal_model = apps.get_model('market', 'Deal')
+        deals = deal_model.objects.filter(investment_account_id=self.investment_account_id)
+        if self.deal_ids is not None:
+            deals = deals.filter(pk__in=self.deal_ids)
+        with transaction.atomic():
+            deal_ids = deals.lock_for_income()
+            incomes, currency_by_deal, last_operations = self.compute()
+            # У сделок без операций сбрасывается последняя учтенная операция
+            last_operations = {deal_id: last_operations.get(deal_id, (None, None)) for deal_id in deal_ids}
+            return self.write(incomes, currency_by_deal, last_operations)
+
+    def apply(self, operation_ids_by_deal: Dict[int, List[int]], replay_deal_ids: Iterable[int] = ()) -> int:
+        """ Применяет новые операции сделок к сохраненному состоянию совладельцев.
+            Сделки без сохраненного состояния и сделки, в которых новая операция раньше последней учтенной,
+            пересчитываются с начала (run). Сделки блокируются до записи, как в run
+        :param operation_ids_by_deal: id новых операций по id сделки
+        :param replay_deal_ids: сделки, в которых изменились уже учтенные операции (пересчитываются с начала)
+        :return: количество записанных DealIncome
+        """
+        with transaction.atomic():
+            apps.get_model('market', 'Deal').objects.filter(pk__in=operation_ids_by_deal).lock_for_income()
+            return self._apply(operation_ids_by_deal, replay_deal_ids)
+
+    def _apply(self, operation_ids_by_deal: Dict[int, List[int]], replay_deal_ids: Iterable[int]) -> int:
+        deal_model = apps.get_model('market', 'Deal')
+        operation_model = apps.get_model('operations', 'Operation')
+        deal_income_model = apps.get_model('market', 'DealIncome')
+        deals = deal_model.objects.filter(pk__in=operation_ids_by_deal).only(
+            'income_applied_date', 'income_applied_operation_id'
+        ).in_bulk()
+        operations_by_deal: Dict[int, list] = {deal_id: [] for deal_id in deals}
+        operations = (
+            operation_model.objects
+            .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation),
+                    pk__in=[pk for operation_ids in operation_ids_by_deal.values() for pk in operation_ids])
+            .prefetch_related('shares')
+            .order_by('date', 'pk')
+        )
+        for operation in operations:
+            operations_by_deal[operation.deal_id].append(operation)
+
+        replay_deal_ids, incremental = set(replay_deal_ids), {}
+        for deal_id, deal_operations in operations_by_deal.items():
+            if not deal_operations or deal_id in replay_deal_ids:
+                continue
+            deal = deals[deal_id]
+            watermark = (deal.income_applied_date, deal.income_applied_operation_id)
+            if deal.income_applied_date is None or (deal_operations[0].date, deal_operations[0].pk) <= watermark:
+                replay_deal_ids.add(deal_id)
+            else:
+                incremental[deal_id] = deal_operations
+
+        written = 0
+        if replay_deal_ids:
+            logger.info(f'Полный пересчет дохода сделок: {replay_deal_ids}')
+            written += IncomeEngine(self.investment_account_id, deal_ids=sorted(replay_deal_ids)).run()
+        if not incremental:
+            return written
+
+        smart_investor_sets: Dict[int, SmartInvestorSet] = {}
+        states: Dict[int, dict] = {deal_id: {} for deal_id in incremental}
+        currencies: Dict[int, str] = {}
+        for deal_income in deal_income_model.objects.filter(deal_id__in=incremental):
+            states[deal_income.deal_id][deal_income.co_owner_id] = (
+                deal_income.stock_quantity, deal_income.capital, deal_income.last_dividend_share
+            )
+            currencies[deal_income.deal_id] = deal_income.currency_id
+        for deal_id, deal_operations in incremental.items():
+            smart_investor_set = SmartInvestorSet.from_state(currencies.get(deal_id), states[deal_id])
+            for operation in deal_operations:
+                smart_investor_set.add_operation(operation)
+            smart_investor_sets[deal_id] = smart_investor_set
+
+        incomes = {
+            (deal_id, investor.investor): self.income_state(
+                investor.capital, investor.stock_quantity, investor.last_dividend_share
+            )
+            for deal_id, smart_investor_set in smart_investor_sets.items() for investor in smart_investor_set
+        }
+        currency_by_deal = {
+            deal_id: smart_investor_set.currency for deal_id, smart_investor_set in smart_investor_sets.items()
+        }
+        last_operations = {
+            deal_id: (deal_operations[-1].date, deal_operations[-1].pk)
+            for deal_id, deal_operations in incremental.items()
+        }
+        return written + self.write(incomes, currency_by_deal, last_operations)
+
+    def write(self, incomes: Dict[Tuple[int, int], IncomeState], currency_by_deal: Dict[int, str],
+              last_operations: Dict[int, Tuple[Optional[dt.datetime], Optional[int]]]) -> int:
+        """ Записывает доходы и состояние совладельцев сделок из last_operations
+            (DealIncome совладельцев, которых нет в incomes, удаляются) и последнюю учтенную операцию сделок
+        :return: количество записанных DealIncome
+        """
+        deal_model = apps.get_model('market', 'Deal')
+        deal_income_model = apps.get_model('market', 'DealIncome')
+        incomes = dict(incomes)
+        state_fields = ('value', 'stock_quantity', 'capital', 'last_dividend_share')
+        with transaction.atomic():
+            bulk_update, stale_ids = [], []
+            for deal_income in deal_income_model.objects.filter(deal_id__in=last_operations):
+                key = (deal_income.deal_id, deal_income.co_owner_id)
+                if key not in incomes:
+                    stale_ids.append(deal_income.pk)
+                    continue
+                state = incomes.pop(key)
+                currency = currency_by_deal[key[0]]
+                if deal_income.currency_id != currency or any(
+                    getattr(deal_income, field) != getattr(state, field) for field in state_fields
+                ):
+                    for field in state_fields:
+                        setattr(deal_income, field, getattr(state, field))
+                    deal_income.currency_id = currency
+                    bulk_update.append(deal_income)
+            deal_income_model.objects.filter(pk__in=stale_ids).delete()
+            deal_income_model.objects.bulk_update(bulk_update, fields=(*state_fields, 'currency'))
+            deal_income_model.objects.bulk_create([
+                deal_income_model(deal_id=deal_id, co_owner_id=co_owner_id, currency_id=currency_by_deal[deal_id],
+                                  **state._asdict())
+                for (deal_id, co_owner_id), state in incomes.items()
+            ])
+
+            deals = []
+            for deal_id, (date, operation_id) in last_operations.items():
+                deals.append(deal_model(pk=deal_id, income_applied_date=date, income_applied_operation_id=operation_id))
+            deal_model.objects.bulk_update(deals, fields=('income_applied_date', 'income_applied_operation_id'))
+        logger.info(
+            f'Доходы записаны: сделок {len(last_operations)}, изменено {len(bulk_update)}, '
+            f'создано {len(incomes)}, удалено {len(stale_ids)}'
+        )
+        return len(bulk_update) + len(incomes)
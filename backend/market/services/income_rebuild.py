@@ -0,0 +1,180 @@
+""" Полный пересчет DealIncome пулом процессов (например, после исправления расчета дохода).
+    Пересчитываемые сделки ставятся в свою очередь (Deal.income_rebuild_at), процессы разбирают ее
+    пачками сделок одного ИС и убирают пересчитанные сделки из очереди, поэтому прерванный
+    пересчет продолжается с того места, где остановился (resume).
+    Очередь воркера (Deal.income_outdated_at) не используется, поэтому на время пересчета доход ИС
+    не считается устаревшим, а сделки, которые сейчас пересчитывает воркер или синхронизация, пропускаются
+"""
+import datetime as dt
+import functools
+import logging
+import multiprocessing
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import django
+from django.apps import apps
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from market.services.income_engine import IncomeEngine
+
+logger = logging.getLogger(__name__)
+
+# Пачка сделок: id ИС и id сделок этого ИС
+T_CHUNK = Tuple[int, List[int]]
+
+
+def _init_pool_process() -> None:
+    if not apps.ready:
+        django.setup()
+
+
+def recalculate_chunk(chunk: T_CHUNK, before: dt.datetime) -> Tuple[T_CHUNK, Optional[str], List[int]]:
+    """ Пересчет пачки сделок, ошибка возвращается и не останавливает пересчет остальных пачек.
+        Сделки пачки блокируются, сделки, заблокированные другим процессом (воркером или синхронизацией),
+        пропускаются и остаются в очереди
+    :param chunk: пачка сделок
+    :param before: у пересчитанных сделок доход, устаревший не позже before, становится актуальным
+    :return: пачка, ошибка (None - пересчитана) и id пропущенных сделок
+    """
+    deal_model = apps.get_model('market', 'Deal')
+    investment_account_id, deal_ids = chunk
+    try:
+        with transaction.atomic():
+            locked_ids = deal_model.objects.filter(pk__in=deal_ids).lock_for_income(skip_locked=True)
+            if locked_ids:
+                IncomeEngine(investment_account_id, deal_ids=locked_ids).run()
+                locked_deals = deal_model.objects.filter(pk__in=locked_ids)
+                locked_deals.update(income_rebuild_at=None)
+                locked_deals.clear_income_outdated(before)
+    except Exception as e:
+        logger.exception(f'Пересчет дохода сделок ИС {investment_account_id} не удался')
+        return chunk, repr(e), []
+    locked_ids = set(locked_ids)
+    return chunk, None, [deal_id for deal_id in deal_ids if deal_id not in locked_ids]
+
+
+class IncomeRebuildReport:
+    """ Итоги пересчета дохода """
+
+    def __init__(self, enqueued: int, chunks: List[T_CHUNK], failed: List[Tuple[T_CHUNK, str]],
+                 elapsed: dt.timedelta, skipped: Optional[List[int]] = None):
+        self.enqueued = enqueued
+        self.chunks = chunks
+        self.failed = failed
+        self.elapsed = elapsed
+        # Сделки, заблокированные другим процессом во время пересчета
+        self.skipped = skipped if skipped is not None else []
+
+    @property
+    def deals_count(self) -> int:
+        return sum(len(deal_ids) for _, deal_ids in self.chunks)
+
+    @property
+    def failed_deals_count(self) -> int:
+        return sum(len(deal_ids) for (_, deal_ids), _ in self.failed)
+
+    def lines(self) -> List[str]:
+        seconds = self.elapsed.total_seconds()
+        recalculated = self.deals_count - self.failed_deals_count - len(self.skipped)
+        lines = [
+            f'Поставлено в очередь: {self.enqueued}, пересчитано сделок: {recalculated}, '
+            f'с ошибкой: {self.failed_deals_count}',
+            f'Время: {seconds:.1f} сек., сделок в секунду: {recalculated / seconds if seconds else 0:.1f}'
+        ]
+        for (investment_account_id, deal_ids), error in self.failed:
+            lines.append(f'Ошибка ИС {investment_account_id} ({len(deal_ids)} сделок): {error}')
+        if self.skipped:
+            lines.append(f'Пропущено сделок, занятых другим процессом: {len(self.skipped)}')
+        if self.failed or self.skipped:
+            lines.append(
+                'Сделки с ошибкой и пропущенные остались в очереди, для повторного пересчета запустите с --resume'
+            )
+        return lines
+
+
+class IncomeRebuild:
+    """ Пересчет дохода сделок с начала пулом процессов.
+        Сделки делятся на пачки внутри ИС, каждая пачка - один IncomeEngine (несколько запросов к БД)
+    """
+
+    def __init__(self, processes: int, chunk_size: int = 500, investment_account_ids: Optional[List[int]] = None,
+                 since: Optional[dt.datetime] = None, resume: bool = False):
+        """
+        :param processes: количество процессов, у каждого не больше одного подключения к БД
+        :param chunk_size: сколько сделок пересчитывается за раз
+        :param investment_account_ids: пересчитать только сделки этих ИС, None - все ИС
+        :param since: пересчитать только сделки, в которых есть операции не раньше since
+        :param resume: продолжить прерванный пересчет - сделки в очередь не ставятся,
+            пересчитываются те, которые в ней остались
+        """
+        if processes > 1 and connection.vendor == 'sqlite':
+            # sqlite не дает нескольким процессам писать одновременно
+            logger.warning('sqlite не поддерживает одновременную запись, пересчет выполняется в одном процессе')
+            processes = 1
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.investment_account_ids = investment_account_ids
+        self.since = since
+        self.resume = resume
+        self.deal_model = apps.get_model('market', 'Deal')
+
+    def deals(self):
+        """ Сделки, которые надо пересчитать """
+        deals = self.deal_model.objects.all()
+        if self.investment_account_ids is not None:
+            deals = deals.filter(investment_account_id__in=self.investment_account_ids)
+        if self.since is not None:
+            operation_model = apps.get_model('operations', 'Operation')
+            deals = deals.filter(
+                pk__in=operation_model.objects.filter(date__gte=self.since, deal__isnull=False).values('deal_id')
+            )
+        return deals
+
+    def chunks(self, before: dt.datetime) -> List[T_CHUNK]:
+        """ Сделки из очереди, разделенные на пачки внутри ИС """
+        chunks = []
+        deals = (
+            self.deals().income_rebuild_queued().filter(income_rebuild_at__lte=before)
+            .order_by('investment_account_id', 'pk').values_list('investment_account_id', 'pk')
+        )
+        for investment_account_id, deal_id in deals:
+            if not chunks or chunks[-1][0] != investment_account_id or len(chunks[-1][1]) >= self.chunk_size:
+                chunks.append((investment_account_id, []))
+            chunks[-1][1].append(deal_id)
+        return chunks
+
+    @staticmethod
+    def collect(results: Iterable[Tuple[T_CHUNK, Optional[str], List[int]]],
+                total: int) -> Tuple[List[Tuple[T_CHUNK, str]], List[int]]:
+        """ Результаты пересчета пачек по мере готовности
+        :return: пачки с ошибкой и id пропущенных сделок
+        """
+        failed, skipped, done = [], [], 0
+        for chunk, error, chunk_skipped in results:
+            done += len(chunk[1])
+            if error is not None:
+                failed.append((chunk, error))
+            skipped += chunk_skipped
+            logger.info(f'Пересчитано сделок: {done} из {total}')
+        return failed, skipped
+
+    def run(self) -> IncomeRebuildReport:
+        started_at = time.monotonic()
+        before = timezone.now()
+        enqueued = 0 if self.resume else self.deals().mark_income_rebuild(before)
+        chunks = self.chunks(before)
+        total = sum(len(deal_ids) for _, deal_ids in chunks)
+        logger.info(f'Сделок к пересчету: {total}, пачек: {len(chunks)}, процессов: {self.processes}')
+        task = functools.partial(recalculate_chunk, before=before)
+        if self.processes > 1:
+            # Дочерние процессы не должны использовать подключение родителя
+            connections.close_all()
+            with multiprocessing.Pool(self.processes, initializer=_init_pool_process) as pool:
+                failed, skipped = self.collect(pool.imap_unordered(task, chunks), total)
+        else:
+            failed, skipped = self.collect(map(task, chunks), total)
+        return IncomeRebuildReport(
+            enqueued, chunks, failed, dt.timedelta(seconds=time.monotonic() - started_at), skipped
+        )
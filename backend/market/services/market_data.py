@@ -0,0 +1,149 @@
+""" Последние цены ценных бумаг открытых сделок из streaming API.
+    MarketDataStream работает в отдельном потоке со своим event loop, а основной поток
+    периодически подстраивает подписку под открытые сделки и сохраняет новые цены в БД (InstrumentPrice),
+    откуда их читают страницы сайта
+"""
+import asyncio
+import datetime as dt
+import logging
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from django.apps import apps
+from django.db import close_old_connections
+
+from tinkoff_api import MarketDataStream
+
+logger = logging.getLogger(__name__)
+
+
+class MarketDataFeed:
+    """ Подписка на FIGI открытых сделок и сохранение последних цен в БД """
+    # Сколько ждать выполнения подписки/отписки в потоке streaming клиента
+    call_timeout = 30
+
+    def __init__(self, token: str, flush_interval: float = 5, stream: Optional[MarketDataStream] = None):
+        """
+        :param token: токен от Tinkoff API
+        :param flush_interval: как часто в секундах обновлять подписку и сохранять цены
+        :param stream: streaming клиент, если None - создается новый
+        """
+        self.flush_interval = flush_interval
+        self.stream = stream if stream is not None else MarketDataStream(token)
+        # Время последней сохраненной цены по FIGI, чтобы не сохранять одну и ту же цену повторно
+        self.flushed_times: Dict[str, dt.datetime] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        # Количество перезапусков потока streaming клиента после его падения
+        self.restarts = 0
+
+    @staticmethod
+    def opened_figies() -> Set[str]:
+        """ FIGI ценных бумаг открытых сделок всех ИС """
+        deal_model = apps.get_model('market', 'Deal')
+        return set(deal_model.objects.opened().values_list('instrument_id', flat=True))
+
+    def _call(self, coroutine) -> None:
+        """ Выполнение корутины streaming клиента в его event loop """
+        if self._loop is None:
+            asyncio.run(coroutine)
+            return
+        self.ensure_running()
+        asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(self.call_timeout)
+
+    def ensure_running(self) -> None:
+        """ Перезапуск потока streaming клиента, если он завершился.
+            Иначе корутины, поставленные в его event loop, ждали бы call_timeout и не выполнялись
+        """
+        if self._thread is None or self._thread.is_alive():
+            return
+        logger.error('Поток streaming клиента завершился, перезапуск')
+        self._loop.close()
+        self.restarts += 1
+        self.start()
+
+    def resubscribe(self) -> Tuple[Set[str], Set[str]]:
+        """ Подписка на FIGI новых открытых сделок и отписка от FIGI закрытых
+        :return: FIGI, на которые подписались, и FIGI, от которых отписались
+        """
+        figies = self.opened_figies()
+        subscribed, unsubscribed = figies - self.stream.figies, self.stream.figies - figies
+        if subscribed:
+            self._call(self.stream.subscribe(subscribed))
+        if unsubscribed:
+            self._call(self.stream.unsubscribe(unsubscribed))
+            for figi in unsubscribed:
+                self.flushed_times.pop(figi, None)
+        if subscribed or unsubscribed:
+            logger.info(f'Подписка на цены: +{len(subscribed)}, -{len(unsubscribed)}, всего {len(figies)} FIGI')
+        return subscribed, unsubscribed
+
+    def flush(self) -> int:
+        """ Сохранение в БД цен, полученных после предыдущего сохранения
+        :return: количество сохраненных цен
+        """
+        instrument_price_model = apps.get_model('market', 'InstrumentPrice')
+        last_prices = [
+            last_price for figi, last_price in self.stream.prices.snapshot().items()
+            # В LastPriceTable цена только новее, поэтому достаточно сравнить время с сохраненным
+            if figi in self.stream.figies and self.flushed_times.get(figi) != last_price.time
+        ]
+        if not last_prices:
+            return 0
+        existing_figies = set(
+            instrument_price_model.objects.filter(instrument_id__in=[last_price.figi for last_price in last_prices])
+            .values_list('instrument_id', flat=True)
+        )
+        instrument_prices = [
+            instrument_price_model(instrument_id=last_price.figi, price=last_price.price, time=last_price.time)
+            for last_price in last_prices
+        ]
+        instrument_price_model.objects.bulk_update(
+            [instrument_price for instrument_price in instrument_prices
+             if instrument_price.instrument_id in existing_figies],
+            ('price', 'time')
+        )
+        instrument_price_model.objects.bulk_create(
+            [instrument_price for instrument_price in instrument_prices
+             if instrument_price.instrument_id not in existing_figies]
+        )
+        for last_price in last_prices:
+            self.flushed_times[last_price.figi] = last_price.time
+        return len(last_prices)
+
+    def start(self) -> None:
+        """ Запуск streaming клиента в отдельном потоке """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_stream, name='market-data-stream', daemon=True)
+        self._thread.start()
+
+    def _run_stream(self) -> None:
+        try:
+            self._loop.run_until_complete(self.stream.run())
+        except Exception:
+            logger.exception('Streaming клиент завершился с ошибкой')
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self.stream.stop(), self._loop).result(self.call_timeout)
+        self._thread.join(self.call_timeout)
+        self._loop.close()
+        self._loop, self._thread = None, None
+
+    def run_forever(self) -> None:
+        logger.info('Получение последних цен запущено')
+        self.start()
+        try:
+            while True:
+                close_old_connections()
+                self.ensure_running()
+                self.resubscribe()
+                flushed = self.flush()
+                if flushed:
+                    logger.debug(f'Сохранено цен: {flushed}')
+                time.sleep(self.flush_interval)
+        finally:
+            self.stop()
@@ -6,32 +6,36 @@ from core.utils import word2declension
 register = template.Library()
 
 
+def _position_and_last_price(context, figi):
+    """ context['portfolio'] - позиции портфеля по FIGI (PortfolioPosition.objects.by_figi()),
+        context['last_prices'] - последние цены из streaming API (InstrumentPrice.objects.table())
+    """
+    position = context['portfolio'].get(figi)
+    last_prices = context.get('last_prices')
+    return position, last_prices.get(figi) if last_prices is not None else None
+
+
 @register.simple_tag(takes_context=True)
 def expected_profit(context, figi):
-    portfolio = context['portfolio']
-    for asset in portfolio:
-        if figi == asset['figi']:
-            expected = asset['expectedYield']['value']
-            if expected > 0:
-                return f'+{expected}'
-            else:
-                return expected
+    position, last_price = _position_and_last_price(context, figi)
+    if position is not None:
+        expected = position.live_expected_yield(last_price)
+        if expected > 0:
+            return f'+{expected}'
+        else:
+            return expected
 
 
 @register.simple_tag(takes_context=True)
 def expected_percent_profit(context, figi):
-    portfolio = context['portfolio']
-    for asset in portfolio:
-        if figi == asset['figi']:
-            price = asset['averagePositionPrice']['value'] * asset['balance']
-            expected_price = price + asset['expectedYield']['value']
-            if price < expected_price:
-                income = ((expected_price / price)-1) * 100
-                return f'+{income:.2f}'
-            elif price > expected_price:
-                expense = (1-(expected_price / price)) * 100
-                return f'-{expense:.2f}'
-            return 0
+    position, last_price = _position_and_last_price(context, figi)
+    if position is not None:
+        percent = position.live_expected_percent_profit(last_price)
+        if percent > 0:
+            return f'+{percent:.2f}'
+        elif percent < 0:
+            return f'-{-percent:.2f}'
+        return 0
 
 
 @register.simple_tag(takes_context=AttributeError)
@@ -1,3 +1,477 @@
-from django.test import TestCase
+import datetime as dt
+import io
+import random
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import List
+from unittest import mock, skipIf
 
-# Create your tests here.
+import numpy as np
+import pytz
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from market.models import Deal, DealIncome, DealQuerySet, InstrumentPrice, StockInstrument
+from market.services.income_calculation import SmartInvestorSet
+from market.services.income_engine import (
+    compute_incomes, IncomeEngine, PURCHASE, SALE, DIVIDEND, SHARE_SCALE, STOCK_QUANTITY_SCALE
+)
+from market.services.income_rebuild import IncomeRebuild
+from market.services.market_data import MarketDataFeed
+from market.templatetags.custom_tags import expected_percent_profit, expected_profit
+from operations.models import (
+    Currency, DividendOperation, InvestmentAccountPurchaseOperation, Operation, SaleOperation, Share
+)
+from operations.models_constraints import OperationTypes
+from tinkoff_api import LastPriceTable, MarketDataStream
+from users.models import CoOwner, InvestmentAccount, Investor, PortfolioPosition
+
+
+class RecomputingSmartInvestorSet(SmartInvestorSet):
+    """ Прежний алгоритм: общее количество бумаг каждый раз суммируется по всем инвесторам """
+    def total_stock_quantity(self):
+        return sum(investor.stock_quantity for investor in self.investors.values())
+
+
+def generate_operations(rnd: random.Random, count: int, investors: int):
+    """ Случайный поток покупок, продаж и дивидендов, у каждой покупки/продажи свои доли инвесторов """
+    operations = []
+    for _ in range(count):
+        operation_type = rnd.choice(
+            (OperationTypes.BUY, OperationTypes.BUY, OperationTypes.SELL, OperationTypes.DIVIDEND)
+        )
+        shares = [
+            SimpleNamespace(co_owner_id=co_owner, value=Decimal(rnd.randint(0, 100)) / 100)
+            for co_owner in rnd.sample(range(investors), rnd.randint(1, investors))
+        ]
+        quantity = rnd.randint(1, 50)
+        price = Decimal(rnd.randint(100, 100000)) / 100
+        payment = {
+            OperationTypes.BUY: -quantity * price,
+            OperationTypes.SELL: quantity * price,
+            OperationTypes.DIVIDEND: price
+        }[operation_type]
+        operations.append(SimpleNamespace(
+            type=operation_type, currency_id='USD', quantity=quantity, payment=payment,
+            commission=-(Decimal(rnd.randint(0, 500)) / 100), dividend_tax=-rnd.randint(0, 10),
+            shares=SimpleNamespace(all=lambda shares=shares: shares)
+        ))
+    return operations
+
+
+class SmartInvestorSetTest(SimpleTestCase):
+    def test_running_totals_match_recomputation(self):
+        for seed in range(50):
+            rnd = random.Random(seed)
+            operations = generate_operations(rnd, count=rnd.randint(1, 200), investors=rnd.randint(1, 6))
+            smart_investor_set, reference = SmartInvestorSet(), RecomputingSmartInvestorSet()
+            for operation in operations:
+                smart_investor_set.add_operation(operation)
+                reference.add_operation(operation)
+                self.assertEqual(smart_investor_set.total_stock_quantity(), reference.total_stock_quantity())
+            self.assertEqual(smart_investor_set.investors.keys(), reference.investors.keys())
+            for key, investor in smart_investor_set.investors.items():
+                expected = reference[key]
+                self.assertEqual(investor.stock_quantity, expected.stock_quantity, seed)
+                self.assertEqual(investor.capital, expected.capital, seed)
+                self.assertEqual(investor.last_dividend_share, expected.last_dividend_share, seed)
+            # Капитал после дивидендов - результат деления, поэтому сумма совпадает с точностью до округления
+            self.assertAlmostEqual(smart_investor_set.total_capital(), sum(i.capital for i in reference), places=12)
+            self.assertEqual(smart_investor_set.total_capital_by_currency().keys(), {'USD'})
+            self.assertEqual(smart_investor_set.total_capital('RUB'), 0)
+
+    def test_from_state_continues_calculation(self):
+        for seed in range(20):
+            rnd = random.Random(seed)
+            operations = generate_operations(rnd, count=rnd.randint(2, 100), investors=rnd.randint(1, 6))
+            split = rnd.randint(1, len(operations) - 1)
+            reference = SmartInvestorSet()
+            for operation in operations:
+                reference.add_operation(operation)
+            head = SmartInvestorSet()
+            for operation in operations[:split]:
+                head.add_operation(operation)
+            smart_investor_set = SmartInvestorSet.from_state(head.currency, {
+                investor.investor: (investor.stock_quantity, investor.capital, investor.last_dividend_share)
+                for investor in head
+            })
+            for operation in operations[split:]:
+                smart_investor_set.add_operation(operation)
+            self.assertEqual(smart_investor_set.investors.keys(), reference.investors.keys())
+            self.assertEqual(smart_investor_set.total_stock_quantity(), reference.total_stock_quantity())
+            for investor in reference:
+                restored = smart_investor_set[investor.investor]
+                self.assertEqual(restored.stock_quantity, investor.stock_quantity, seed)
+                self.assertEqual(restored.capital, investor.capital, seed)
+                self.assertEqual(restored.last_dividend_share, investor.last_dividend_share, seed)
+
+    def test_currency_mismatch(self):
+        smart_investor_set = SmartInvestorSet()
+        operation = SimpleNamespace(type=OperationTypes.DIVIDEND, currency_id='USD', payment=Decimal(1), dividend_tax=0)
+        smart_investor_set.add_operation(operation)
+        with self.assertRaises(ValueError):
+            smart_investor_set.add_operation(SimpleNamespace(**{**vars(operation), 'currency_id': 'RUB'}))
+
+
+def pack_operations(deals: List[list], investors: int) -> dict:
+    """ Аргументы compute_incomes для сделок из generate_operations """
+    kind_by_type = {OperationTypes.BUY: PURCHASE, OperationTypes.SELL: SALE, OperationTypes.DIVIDEND: DIVIDEND}
+    operations = [operation for deal in deals for operation in deal]
+    shares = np.zeros((len(operations), investors), dtype=np.int64)
+    has_share = np.zeros(shares.shape, dtype=bool)
+    for row, operation in enumerate(operations):
+        for share in operation.shares.all():
+            shares[row, share.co_owner_id] = int(share.value * SHARE_SCALE)
+            has_share[row, share.co_owner_id] = True
+    return dict(
+        deal_starts=np.cumsum([0] + [len(deal) for deal in deals[:-1]]),
+        kinds=np.array([kind_by_type[operation.type] for operation in operations]),
+        quantity=np.array([operation.quantity for operation in operations]),
+        trade_payment=np.array([operation.payment + operation.commission for operation in operations], dtype=object),
+        dividend_payment=np.array(
+            [operation.payment + operation.dividend_tax for operation in operations], dtype=object
+        ),
+        shares=shares,
+        has_share=has_share
+    )
+
+
+class ComputeIncomesTest(SimpleTestCase):
+    def assert_matches_smart_investor_set(self, deals: List[list], investors: int):
+        incomes, participants, stock_quantity, last_dividend_share = compute_incomes(
+            **pack_operations(deals, investors)
+        )
+        for deal_position, deal in enumerate(deals):
+            smart_investor_set = SmartInvestorSet()
+            for operation in deal:
+                smart_investor_set.add_operation(operation)
+            self.assertEqual(
+                set(np.flatnonzero(participants[deal_position])), set(smart_investor_set.investors), deal_position
+            )
+            for investor in smart_investor_set:
+                # Деньги считаются точно, а не с точностью до округления
+                self.assertEqual(incomes[deal_position, investor.investor], investor.capital, deal_position)
+                self.assertEqual(
+                    Decimal(int(stock_quantity[deal_position, investor.investor])) / STOCK_QUANTITY_SCALE,
+                    investor.stock_quantity, deal_position
+                )
+                self.assertEqual(
+                    last_dividend_share[deal_position, investor.investor], investor.last_dividend_share, deal_position
+                )
+
+    def test_matches_smart_investor_set(self):
+        rnd = random.Random(0)
+        deals = [generate_operations(rnd, count=rnd.randint(1, 100), investors=5) for _ in range(30)]
+        self.assert_matches_smart_investor_set(deals, investors=5)
+
+    def test_trades_without_dividends(self):
+        rnd = random.Random(1)
+        deals = [
+            [operation for operation in generate_operations(rnd, count=rnd.randint(1, 100), investors=5)
+             if operation.type != OperationTypes.DIVIDEND]
+            for _ in range(30)
+        ]
+        self.assert_matches_smart_investor_set([deal for deal in deals if deal], investors=5)
+
+    def test_large_payments(self):
+        # Сумма денег в единицах compute_incomes не помещается в int64
+        rnd = random.Random(2)
+        deals = [generate_operations(rnd, count=50, investors=3) for _ in range(5)]
+        for deal in deals:
+            for operation in deal:
+                operation.payment *= 10 ** 9
+        self.assert_matches_smart_investor_set(deals, investors=3)
+
+
+def create_investment_account(creator, **kwargs) -> InvestmentAccount:
+    """ ИС без задачи синхронизации (bulk_create не отправляет post_save) """
+    kwargs = {'name': 'ИС', 'token': 'token', 'broker_account_id': str(creator.pk), **kwargs}
+    InvestmentAccount.objects.bulk_create([InvestmentAccount(creator=creator, **kwargs)])
+    investment_account = InvestmentAccount.objects.get(creator=creator, name=kwargs['name'])
+    CoOwner.objects.create(investor=creator, investment_account=investment_account)
+    return investment_account
+
+
+def create_deal_operations(rnd: random.Random, deal: Deal, start: dt.datetime, count: int) -> List[Operation]:
+    """ Случайные покупки, продажи и дивиденды сделки с долями всех совладельцев ИС """
+    co_owner_ids = list(deal.investment_account.co_owners.values_list('pk', flat=True))
+    held = deal.operations.filter(type=OperationTypes.BUY).aggregate(q=Sum('quantity'))['q'] or 0
+    held -= deal.operations.filter(type=OperationTypes.SELL).aggregate(q=Sum('quantity'))['q'] or 0
+    operation_models = {
+        OperationTypes.BUY: InvestmentAccountPurchaseOperation,
+        OperationTypes.SELL: SaleOperation,
+        OperationTypes.DIVIDEND: DividendOperation
+    }
+    operations = []
+    for number in range(count):
+        operation_type = rnd.choice((OperationTypes.BUY, OperationTypes.SELL, OperationTypes.DIVIDEND))
+        if operation_type == OperationTypes.SELL and not held:
+            operation_type = OperationTypes.BUY
+        quantity, commission, dividend_tax = rnd.randint(1, 50), -(Decimal(rnd.randint(0, 500)) / 100), 0
+        price = Decimal(rnd.randint(100, 100000)) / 100
+        if operation_type == OperationTypes.BUY:
+            payment, held = -quantity * price, held + quantity
+        elif operation_type == OperationTypes.SELL:
+            quantity = rnd.randint(1, held)
+            payment, held = quantity * price, held - quantity
+        else:
+            payment, quantity, commission, dividend_tax = price, 0, 0, -rnd.randint(0, 10)
+        operations.append(operation_models[operation_type].objects.create(
+            investment_account=deal.investment_account, date=start + dt.timedelta(hours=number),
+            payment=payment, currency=deal.instrument.currency, instrument=deal.instrument, quantity=quantity,
+            commission=commission, dividend_tax=dividend_tax, _id=f'{deal.pk}-{start.timestamp()}-{number}',
+            deal=deal
+        ))
+    Share.objects.bulk_create([
+        Share(operation=operation, co_owner_id=co_owner_id, value=Decimal(rnd.randint(0, 100)) / 100)
+        for operation in operations for co_owner_id in co_owner_ids
+    ])
+    return operations
+
+
+class IncomeEngineApplyTest(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        creator = Investor.objects.create(username='creator')
+        self.investment_account = create_investment_account(creator)
+        for username in ('first', 'second'):
+            CoOwner.objects.create(
+                investor=Investor.objects.create(username=username), investment_account=self.investment_account
+            )
+        instrument = StockInstrument.objects.create(
+            figi='FIGI', name='Apple', ticker='AAPL', lot=1, currency=currency, isin='US0378331005'
+        )
+        self.deal = Deal.objects.create(instrument=instrument, investment_account=self.investment_account)
+
+    def deal_incomes(self):
+        return {
+            deal_income.co_owner_id: (
+                deal_income.value, deal_income.stock_quantity, deal_income.capital, deal_income.last_dividend_share
+            )
+            for deal_income in DealIncome.objects.filter(deal=self.deal)
+        }
+
+    # sqlite хранит DecimalField как число с плавающей точкой (15 значащих цифр)
+    @skipIf(connection.vendor == 'sqlite', 'sqlite округляет DecimalField')
+    def test_incremental_state_matches_replay(self):
+        rnd = random.Random(0)
+        start = dt.datetime(2020, 1, 1, tzinfo=pytz.utc)
+        for step in range(10):
+            operations = create_deal_operations(rnd, self.deal, start + dt.timedelta(days=step), rnd.randint(1, 15))
+            IncomeEngine(self.investment_account.pk).apply({self.deal.pk: [operation.pk for operation in operations]})
+            self.deal.refresh_from_db()
+            self.assertEqual(self.deal.income_applied_operation_id, operations[-1].pk)
+        incremental = self.deal_incomes()
+        IncomeEngine(self.investment_account.pk, deal_ids=[self.deal.pk]).run()
+        replay = self.deal_incomes()
+        self.assertEqual(len(replay), 3)
+        # Состояние сохраняется без округления, поэтому применение по частям совпадает с пересчетом точно
+        self.assertEqual(incremental, replay)
+
+
+class IncomeRebuildTest(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        rnd = random.Random(0)
+        start = dt.datetime(2020, 1, 1, tzinfo=pytz.utc)
+        self.deal_ids_by_account = {}
+        for account_number, deals_count in enumerate((3, 2)):
+            investment_account = create_investment_account(Investor.objects.create(username=f'creator{account_number}'))
+            CoOwner.objects.create(
+                investor=Investor.objects.create(username=f'co_owner{account_number}'),
+                investment_account=investment_account
+            )
+            deal_ids = []
+            for deal_number in range(deals_count):
+                instrument = StockInstrument.objects.create(
+                    figi=f'FIGI{account_number}{deal_number}', name='Stock', ticker=f'S{account_number}{deal_number}',
+                    lot=1, currency=currency, isin=f'ISIN{account_number}{deal_number}'
+                )
+                deal = Deal.objects.create(instrument=instrument, investment_account=investment_account)
+                create_deal_operations(rnd, deal, start + dt.timedelta(days=deal_number), 20)
+                deal_ids.append(deal.pk)
+            self.deal_ids_by_account[investment_account.pk] = deal_ids
+            IncomeEngine(investment_account.pk).run()
+        self.expected = self.deal_incomes()
+        DealIncome.objects.update(value=0, capital=0)
+
+    @staticmethod
+    def deal_incomes():
+        return {
+            (deal_income.deal_id, deal_income.co_owner_id): (deal_income.value, deal_income.capital)
+            for deal_income in DealIncome.objects.all()
+        }
+
+    def test_chunks(self):
+        rebuild = IncomeRebuild(1, chunk_size=2)
+        before = timezone.now()
+        self.assertEqual(rebuild.deals().mark_income_rebuild(before), 5)
+        (first_account, first_deals), (second_account, second_deals) = self.deal_ids_by_account.items()
+        # Пачка содержит сделки только одного ИС
+        self.assertEqual(rebuild.chunks(before), [
+            (first_account, first_deals[:2]), (first_account, first_deals[2:]), (second_account, second_deals)
+        ])
+        rebuild = IncomeRebuild(1, investment_account_ids=[second_account])
+        self.assertEqual(rebuild.chunks(before), [(second_account, second_deals)])
+
+    def test_failed_chunk_stays_outdated_until_resume(self):
+        failed_deal_ids = list(self.deal_ids_by_account.values())[0][:2]
+        run = IncomeEngine.run
+
+        def run_or_fail(engine):
+            if engine.deal_ids == failed_deal_ids:
+                raise RuntimeError('Сбой пересчета')
+            return run(engine)
+
+        with mock.patch.object(IncomeEngine, 'run', run_or_fail):
+            report = IncomeRebuild(1, chunk_size=2).run()
+        self.assertEqual((report.enqueued, report.deals_count, report.failed_deals_count), (5, 5, 2))
+        self.assertEqual(set(Deal.objects.income_rebuild_queued().values_list('pk', flat=True)), set(failed_deal_ids))
+        # Очередь воркера не используется, доход ИС не считается устаревшим
+        self.assertFalse(Deal.objects.income_outdated().exists())
+        incomes = self.deal_incomes()
+        for (deal_id, co_owner_id), income in self.expected.items():
+            if deal_id in failed_deal_ids:
+                self.assertEqual(incomes[(deal_id, co_owner_id)], (0, 0))
+            else:
+                self.assertEqual(incomes[(deal_id, co_owner_id)], income)
+
+        stdout = io.StringIO()
+        call_command('recalculate_incomes', '-p', '1', '--resume', stdout=stdout)
+        self.assertIn('Поставлено в очередь: 0, пересчитано сделок: 2, с ошибкой: 0', stdout.getvalue())
+        self.assertFalse(Deal.objects.income_rebuild_queued().exists())
+        self.assertEqual(self.deal_incomes(), self.expected)
+
+    def test_locked_deals_are_skipped(self):
+        locked_deal_id = list(self.deal_ids_by_account.values())[0][0]
+        lock_for_income = DealQuerySet.lock_for_income
+
+        def lock_unless_locked(deals, skip_locked=False):
+            # Сделка locked_deal_id заблокирована другим процессом
+            locked_ids = lock_for_income(deals, skip_locked)
+            return [deal_id for deal_id in locked_ids if not skip_locked or deal_id != locked_deal_id]
+
+        Deal.objects.filter(pk=locked_deal_id).mark_income_outdated(timezone.now())
+        with mock.patch.object(DealQuerySet, 'lock_for_income', lock_unless_locked):
+            report = IncomeRebuild(1).run()
+        self.assertEqual(report.skipped, [locked_deal_id])
+        self.assertIn('Пропущено сделок, занятых другим процессом: 1', report.lines())
+        self.assertEqual(list(Deal.objects.income_rebuild_queued().values_list('pk', flat=True)), [locked_deal_id])
+        # Пропущенная сделка остается в очереди воркера
+        self.assertEqual(list(Deal.objects.income_outdated().values_list('pk', flat=True)), [locked_deal_id])
+        incomes = self.deal_incomes()
+        for (deal_id, co_owner_id), income in self.expected.items():
+            expected = (0, 0) if deal_id == locked_deal_id else income
+            self.assertEqual(incomes[(deal_id, co_owner_id)], expected)
+
+        IncomeRebuild(1, resume=True).run()
+        self.assertFalse(Deal.objects.income_rebuild_queued().exists())
+        self.assertFalse(Deal.objects.income_outdated().exists())
+        self.assertEqual(self.deal_incomes(), self.expected)
+
+
+class MarketDataFeedTest(TestCase):
+    def setUp(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        self.investment_account = create_investment_account(Investor.objects.create(username='creator'))
+        self.instruments = {
+            figi: StockInstrument.objects.create(
+                figi=figi, name=ticker, ticker=ticker, lot=1, currency=currency, isin=f'US{figi}'
+            )
+            for figi, ticker in (('FIGI1', 'AAPL'), ('FIGI2', 'MSFT'), ('FIGI3', 'TSLA'))
+        }
+        # Сделка без операций тоже считается открытой, поэтому у FIGI3 сделки пока нет
+        self.deals = {
+            figi: Deal.objects.create(instrument=self.instruments[figi], investment_account=self.investment_account)
+            for figi in ('FIGI1', 'FIGI2')
+        }
+        self.now = dt.datetime(2020, 6, 1, tzinfo=pytz.utc)
+        self.buy(self.deals['FIGI1'], 0)
+        self.buy(self.deals['FIGI2'], 1)
+        self.feed = MarketDataFeed('token', stream=MarketDataStream('token'))
+
+    def buy(self, deal, hours):
+        InvestmentAccountPurchaseOperation.objects.create(
+            investment_account=self.investment_account, date=self.now + dt.timedelta(hours=hours), payment=-100,
+            currency=deal.instrument.currency, instrument=deal.instrument, quantity=1, _id=f'buy-{hours}', deal=deal
+        )
+
+    def candle(self, figi, price, minutes):
+        self.feed.stream.handle_message({'event': 'candle', 'payload': {
+            'figi': figi, 'c': price, 'time': (self.now + dt.timedelta(minutes=minutes)).isoformat()
+        }})
+
+    def test_subscription_follows_opened_deals(self):
+        self.assertEqual(self.feed.resubscribe(), ({'FIGI1', 'FIGI2'}, set()))
+        self.assertEqual(self.feed.resubscribe(), (set(), set()))
+        SaleOperation.objects.create(
+            investment_account=self.investment_account, date=self.now + dt.timedelta(hours=2), payment=110,
+            currency=self.deals['FIGI2'].instrument.currency, instrument=self.deals['FIGI2'].instrument, quantity=1,
+            _id='sell', deal=self.deals['FIGI2']
+        )
+        self.deals['FIGI3'] = Deal.objects.create(
+            instrument=self.instruments['FIGI3'], investment_account=self.investment_account
+        )
+        self.buy(self.deals['FIGI3'], 3)
+        self.assertEqual(self.feed.resubscribe(), ({'FIGI3'}, {'FIGI2'}))
+        self.assertEqual(self.feed.stream.figies, {'FIGI1', 'FIGI3'})
+
+    def test_flush_saves_new_prices(self):
+        self.feed.resubscribe()
+        self.candle('FIGI1', 101.5, 0)
+        self.candle('FIGI2', 20, 0)
+        # Цены FIGI без подписки не сохраняются
+        self.candle('FIGI3', 30, 0)
+        self.assertEqual(self.feed.flush(), 2)
+        self.assertEqual(self.feed.flush(), 0)
+        self.candle('FIGI1', 102, 1)
+        self.candle('FIGI2', 19, -1)
+        self.assertEqual(self.feed.flush(), 1)
+        prices = InstrumentPrice.objects.table(['FIGI1', 'FIGI2', 'FIGI3'])
+        self.assertEqual(len(prices), 2)
+        self.assertEqual(prices.get('FIGI1').price, Decimal(102))
+        self.assertEqual(prices.get('FIGI1').time, self.now + dt.timedelta(minutes=1))
+        self.assertEqual(prices.get('FIGI2').price, Decimal(20))
+
+    def test_expected_profit_by_last_price(self):
+        PortfolioPosition.objects.create(
+            investment_account=self.investment_account, figi='FIGI1', instrument_type='Stock', balance=2,
+            average_position_price=100, expected_yield=4
+        )
+        context = {'portfolio': self.investment_account.portfolio_positions.by_figi()}
+        # Без цены из streaming API - доходность из снимка портфеля
+        self.assertEqual(expected_profit(context, 'FIGI1'), '+4.0000')
+        self.assertEqual(expected_percent_profit(context, 'FIGI1'), '+2.00')
+        last_prices = LastPriceTable()
+        last_prices.update('FIGI1', Decimal('99.5'), self.now)
+        context['last_prices'] = last_prices
+        self.assertEqual(expected_profit(context, 'FIGI1'), Decimal('-1.0000'))
+        self.assertEqual(expected_percent_profit(context, 'FIGI1'), '-0.50')
+        self.assertIsNone(expected_profit(context, 'FIGI2'))
+
+    def test_restart_dead_stream_thread(self):
+        class FailingStream(MarketDataStream):
+            runs = 0
+
+            async def run(self, session=None):
+                self.runs += 1
+                if self.runs == 1:
+                    raise RuntimeError('Поток упал')
+                await super().run(session)
+
+        feed = MarketDataFeed('token', stream=FailingStream('token', url='ws://127.0.0.1:9/'))
+        feed.start()
+        feed._thread.join(5)
+        self.assertFalse(feed._thread.is_alive())
+        # Подписка не ждет call_timeout, а перезапускает поток
+        feed.resubscribe()
+        try:
+            self.assertEqual(feed.restarts, 1)
+            self.assertTrue(feed._thread.is_alive())
+            self.assertEqual(feed.stream.figies, {'FIGI1', 'FIGI2'})
+        finally:
+            feed.stop()
+        self.assertEqual(feed.stream.runs, 2)
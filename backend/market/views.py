@@ -6,18 +6,18 @@ from django.db.models import Max, Sum, Min, F, Subquery, OuterRef
 from django.db.models.functions import Coalesce
 from django.views.generic import TemplateView, ListView, RedirectView
 
-from market.models import StockInstrument, Deal, InstrumentType
+from market.models import StockInstrument, Deal, InstrumentType, InstrumentPrice
 from operations.models import Operation
-from tinkoff_api import TinkoffProfile
 
 logger = logging.getLogger(__name__)
 
 
-class UpdateInvestmentAccountMixin:
+class InvestmentAccountMixin:
+    """ ИС по умолчанию. Страницы только читают данные,
+        синхронизация с Tinkoff API выполняется в фоне (manage.py sync_worker)
+    """
     def get(self, *args, **kwargs):
         self.investment_account = getattr(self.request.user, 'default_investment_account', None)
-        if self.investment_account:
-            self.investment_account.update_portfolio()
         return super().get(*args, **kwargs)
 
     def get_context_data(self, **kwargs):
@@ -32,7 +32,7 @@ class IndexView(LoginRequiredMixin, RedirectView):
     pattern_name = 'operations'
 
 
-class OperationsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, ListView):
+class OperationsView(LoginRequiredMixin, InvestmentAccountMixin, ListView):
     template_name = 'operations.html'
     context_object_name = 'operations'
     model = Operation
@@ -59,7 +59,7 @@ class OperationsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, ListView)
         )
 
 
-class DealsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, TemplateView):
+class DealsView(LoginRequiredMixin, InvestmentAccountMixin, TemplateView):
     template_name = 'deals.html'
 
     def get_context_data(self, **kwargs):
@@ -86,21 +86,20 @@ class DealsView(LoginRequiredMixin, UpdateInvestmentAccountMixin, TemplateView):
             .order_by('-earliest_operation_date')
             .values()
         )
-        if self.investment_account:
-            with TinkoffProfile(self.investment_account.token) as tp:
-                portfolio = tp.portfolio()['payload']['positions']
-                portfolio = {i['figi']: i for i in portfolio}
-            for deal in opened_deals:
-                figi_figi = deal['instrument_figi']
-                asset = portfolio[figi_figi]
-                price = asset['averagePositionPrice']['value'] * asset['balance']
-                expected_price = price + asset['expectedYield']['value']
-                if price < expected_price:
-                    deal['expected_percent_profit'] = ((expected_price / price)-1)*100
-                else:
-                    deal['expected_percent_profit'] = -(1-(expected_price/price))*100
-                deal['expected_profit'] = asset['expectedYield']['value']
-                deal['lots_left'] = asset['lots']
+        # Снимок портфеля, сохраненный при последней синхронизации
+        portfolio = self.investment_account.portfolio_positions.by_figi() if self.investment_account else {}
+        # Последние цены из streaming API (market_data_stream), доходность считается по ним
+        last_prices = InstrumentPrice.objects.table(portfolio)
+        for deal in opened_deals:
+            position = portfolio.get(deal['instrument_figi'])
+            if position is None:
+                continue
+            last_price = last_prices.get(position.figi)
+            deal['expected_percent_profit'] = position.live_expected_percent_profit(last_price)
+            deal['expected_profit'] = position.live_expected_yield(last_price)
+            deal['lots_left'] = position.lots
+        context['portfolio'] = portfolio
+        context['last_prices'] = last_prices
         context['opened_deals'] = opened_deals
         context['closed_deals'] = (
             queryset.closed()
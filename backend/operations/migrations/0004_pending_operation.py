@@ -0,0 +1,32 @@
+# Generated by Django 3.0.8 on 2026-10-18 16:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_investmentaccount_operations_watermark'),
+        ('operations', '0003_operation_co_owners'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingOperation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('_id', models.CharField(max_length=32, verbose_name='ID')),
+                ('date', models.DateTimeField(verbose_name='Дата')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_operations', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Операция в процессе',
+                'verbose_name_plural': 'Операции в процессе',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='pendingoperation',
+            constraint=models.UniqueConstraint(fields=('investment_account', '_id'), name='unique_pending_operation'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 17:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0004_pending_operation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingoperation',
+            name='deferred_attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='Отложена раз'),
+        ),
+    ]
@@ -194,6 +194,31 @@ class TaxBackOperation(Operation):
         proxy = True
 
 
+class PendingOperation(models.Model):
+    """ Операция, которая на момент синхронизации была в процессе выполнения.
+        Следующая синхронизация запрашивает операции начиная с даты самой ранней из них,
+        поэтому операция будет записана, когда выполнится
+    """
+    class Meta:
+        verbose_name = 'Операция в процессе'
+        verbose_name_plural = 'Операции в процессе'
+        constraints = [
+            models.UniqueConstraint(fields=('investment_account', '_id'), name='unique_pending_operation')
+        ]
+
+    investment_account = models.ForeignKey(
+        'users.InvestmentAccount', verbose_name='Инвестиционный счет', on_delete=models.CASCADE,
+        related_name='pending_operations'
+    )
+    _id = models.CharField(verbose_name='ID', max_length=32)
+    date = models.DateTimeField(verbose_name='Дата')
+    # Сколько синхронизаций подряд операция откладывалась из-за инструмента, который не удалось получить
+    deferred_attempts = models.PositiveIntegerField(verbose_name='Отложена раз', default=0)
+
+    def __str__(self):
+        return f'{self.investment_account}::{self._id}: {self.date}'
+
+
 class Share(models.Model):
     """ Отражает долю совладельца в каждой операции """
     class Meta:
@@ -1 +1,7 @@
 from tinkoff_api._api import TinkoffApiUrl, TinkoffProfile
+from tinkoff_api._async_api import AsyncTinkoffProfile, AsyncSessionPool
+from tinkoff_api._auth_cache import AuthCache
+from tinkoff_api._cache import CatalogCache
+from tinkoff_api._streaming import MarketDataStream, LastPrice, LastPriceTable
+from tinkoff_api._throttling import RateLimits, RetryPolicy, TokenBucket
+from tinkoff_api._transport import Transport, RequestsTransport, RecordingTransport, ReplayTransport
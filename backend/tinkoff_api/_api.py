@@ -1,13 +1,22 @@
+import collections
 import datetime as dt
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 from functools import wraps
-from typing import Optional
-from urllib.parse import urljoin
+from typing import Optional, List, Tuple, Iterator
+from urllib.parse import urljoin, urlencode
 
 import requests
 
+from tinkoff_api._auth_cache import AuthCache, AuthInfo, BrokerAccount
+from tinkoff_api._cache import CatalogCache, CacheEntry
+from tinkoff_api._records import OperationRecord, batched
+from tinkoff_api._throttling import RateLimits, RetryPolicy
+from tinkoff_api._transport import Transport
 from tinkoff_api.exceptions import PermissionDeniedError, UnauthorizedError, UnknownError, InvalidArgumentError, \
-    InvalidTokenError
+    InvalidTokenError, TooManyRequestsError
 
 
 logger = logging.getLogger(__name__)
@@ -39,13 +48,7 @@ def generate_url(func):
     def wrapper(profile, *args, **kwargs):
         if kwargs.get('url') is not None:
             raise InvalidArgumentError('Нельзя передавать аргумент url')
-        path = func.__name__.split('_')
-        if profile.is_sandbox_token_valid:
-            path.insert(0, 'sandbox')
-        else:
-            path.insert(0, 'production')
-        url = TinkoffApiUrl.url(*path)
-        kwargs['url'] = url
+        kwargs['url'] = profile.url_for(*func.__name__.split('_'))
         result = func(profile, *args, **kwargs)
         return result
     return wrapper
@@ -82,9 +85,22 @@ class TinkoffApiUrl:
         return base.url()
 
 
-class TinkoffProfile:
+class BaseTinkoffProfile:
+    """ Общая часть синхронного и асинхронного профилей Tinkoff API """
+    # Методы авторизации, которые можно передать в auth(first=...)
+    auth_methods = ('production', 'prod', 'sandbox', 'sand')
+    # Политика повтора запросов, на которые Tinkoff API ответил 429/5xx
+    retry_policy = RetryPolicy()
+    # Кэш справочников (market/stocks, market/currencies), None - без кэширования
+    catalog_cache: Optional[CatalogCache] = CatalogCache.from_env()
+    # Кэш результатов авторизации, общий для всех профилей процесса
+    auth_cache: AuthCache = AuthCache.from_env()
+    # Длинный промежуток операций разбивается на окна такой длины, None - не разбивать
+    operations_window: Optional[dt.timedelta] = dt.timedelta(days=180)
+    # Сколько окон операций запрашивается одновременно
+    operations_max_workers = 4
+
     def __init__(self, token: str):
-        self._session = requests.session()
         try:
             token.encode('latin-1')
         except (UnicodeEncodeError, AttributeError):
@@ -92,120 +108,322 @@ class TinkoffProfile:
         self.token = token
         self.is_production_token_valid: bool = False
         self.is_sandbox_token_valid: bool = False
+        # Счет по умолчанию, запросы без broker_account_id относятся к нему
         self.broker_account_id: Optional[str] = None
+        # Все брокерские счета, доступные по токену
+        self.broker_accounts: List[BrokerAccount] = []
 
-    def auth(self, first='production') -> str:
-        """ Авторизация по токену
-        :param first: Какой метод авторизации будет первым (production/sandbox).
-            Если авторизация не пройдет успешно, будет попытка вызвать другой метод
+    @property
+    def is_authorized(self) -> bool:
+        return self.is_sandbox_token_valid or self.is_production_token_valid
+
+    def url_for(self, *path: str) -> str:
+        """ url метода Tinkoff API с учетом типа токена """
+        if self.is_sandbox_token_valid:
+            return TinkoffApiUrl.url('sandbox', *path)
+        return TinkoffApiUrl.url('production', *path)
+
+    def search_by_figi_url(self, figi: str) -> str:
+        """ url поиска инструмента по FIGI, FIGI входит в url, поэтому ответ кэшируется отдельно для каждого """
+        return f'{self.url_for("market", "search", "by-figi")}?{urlencode({"figi": figi})}'
+
+    @property
+    def authorization_headers(self) -> dict:
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def auth_urls(self, first='production') -> tuple:
+        """ Список url, по которым поочередно будет проходить авторизация
+        :param first: Какой метод авторизации будет первым (production/sandbox)
         """
         first = first.lower()
-        methods = ('production', 'prod', 'sandbox', 'sand')
-        if first not in methods:
-            raise InvalidArgumentError(f'Передайте одно из следующих значений аргумента first: {", ".join(methods)}')
-
+        if first not in self.auth_methods:
+            raise InvalidArgumentError(
+                f'Передайте одно из следующих значений аргумента first: {", ".join(self.auth_methods)}'
+            )
         url1 = TinkoffApiUrl.production.user.accounts.url()
         url2 = TinkoffApiUrl.sandbox.user.accounts.url()
-
         if first.startswith('sand'):
             url1, url2 = url2, url1
+        return url1, url2
 
-        for url in (url1, url2):
-            response = self._session.get(
-                url, headers={'Authorization': f'Bearer {self.token}'}
-            )
+    def set_accounts(self, response_json: dict) -> str:
+        """ Сохраняет результат успешной авторизации
+        :param response_json: ответ user/accounts
+        :return: тип токена (sandbox/production)
+        """
+        broker_accounts = [BrokerAccount.from_json(account) for account in response_json['payload']['accounts']]
+        if not broker_accounts:
+            raise InvalidTokenError('По токену не доступно ни одного брокерского счета')
+        auth_info = AuthInfo(broker_accounts, is_sandbox=broker_accounts[0].broker_account_id.startswith('SB'))
+        self.auth_cache.set(self.token, auth_info)
+        return self.apply_auth_info(auth_info)
+
+    def apply_auth_info(self, auth_info: AuthInfo) -> str:
+        """ Применяет результат авторизации (полученный от API или из кэша)
+        :return: тип токена (sandbox/production)
+        """
+        self.broker_account_id = auth_info.broker_account_id
+        self.broker_accounts = list(auth_info.broker_accounts)
+        self.is_sandbox_token_valid = auth_info.is_sandbox
+        self.is_production_token_valid = not auth_info.is_sandbox
+        return 'sandbox' if self.is_sandbox_token_valid else 'production'
+
+    @staticmethod
+    def account_params(broker_account_id: Optional[str] = None) -> dict:
+        """ Query параметры запроса к конкретному брокерскому счету,
+            без broker_account_id Tinkoff API использует счет по умолчанию
+        """
+        return {'brokerAccountId': broker_account_id} if broker_account_id else {}
+
+    @staticmethod
+    def check_date_range(from_datetime: dt.datetime, to_datetime: dt.datetime) -> True:
+        """ Проверка дат на корректность.
+            from_datetime должна быть меньше to_datetime,
+            обе даты должны быть типа datetime, и иметь timezone
+        :param from_datetime: начало промежутка
+        :param to_datetime: конец промежутка
+        :return: True или raise InvalidArgumentError
+        """
+        logger.info(f'Проверка валидности двух дат: {from_datetime} и {to_datetime}')
+        if not (isinstance(from_datetime, dt.datetime) and isinstance(to_datetime, dt.datetime)):
+            raise InvalidArgumentError('Аргументы from_datetime и to_datetime должны быть типа datetime')
+        if from_datetime >= to_datetime:
+            raise InvalidArgumentError('Аргумент from_datetime должен быть меньше аргумента to_datetime')
+        if getattr(from_datetime, 'tzinfo', None) is None or getattr(to_datetime, 'tzinfo', None) is None:
+            raise InvalidArgumentError('Аргументы from_datetime и to_datetime должны быть с timezone')
+        if from_datetime.tzinfo != to_datetime.tzinfo:
+            raise InvalidArgumentError('Временная зона должна быть одинаковой')
+        if not (callable(getattr(from_datetime, 'isoformat', None)) and
+                callable(getattr(to_datetime, 'isoformat', None))):
+            raise InvalidArgumentError('Аргументы from_datetime и to_datetime должны иметь метод isoformat')
+        logger.info('Даты валидны')
+
+    def split_date_range(self, from_datetime: dt.datetime, to_datetime: dt.datetime,
+                         window: Optional[dt.timedelta] = None) -> List[Tuple[dt.datetime, dt.datetime]]:
+        """ Разбивает промежуток на окна, начиная с самого нового
+            (в таком же порядке Tinkoff API возвращает операции)
+        :param window: длина окна, если None - operations_window
+        """
+        window = window or self.operations_window
+        if not window:
+            return [(from_datetime, to_datetime)]
+        windows = []
+        window_end = to_datetime
+        while window_end > from_datetime:
+            window_start = max(window_end - window, from_datetime)
+            windows.append((window_start, window_end))
+            window_end = window_start
+        return windows
+
+    @staticmethod
+    def merge_operations(responses: List[dict]) -> dict:
+        """ Объединяет ответы operations по окнам в один ответ.
+            Порядок окон сохраняется, операции на границах окон не дублируются
+        """
+        operation_ids = set()
+        operations = []
+        for response in responses:
+            for operation in response['payload']['operations']:
+                if operation['id'] not in operation_ids:
+                    operation_ids.add(operation['id'])
+                    operations.append(operation)
+        merged = dict(responses[0])
+        merged['payload'] = {**responses[0]['payload'], 'operations': operations}
+        return merged
+
+    def check_status_code(self, status_code: int, catalog: bool = False) -> None:
+        """ Возбуждает исключение, если запрос к Tinkoff API не удался.
+            Если токен перестал действовать, результат авторизации удаляется из кэша
+        :param catalog: запрос справочника, для него 500 - сбой Tinkoff API, а не недействительный токен
+        """
+        if status_code == 401 or (status_code == 500 and not catalog):
+            self.auth_cache.invalidate(self.token)
+            raise UnauthorizedError('Токен не действителен')
+        elif status_code == 429:
+            raise TooManyRequestsError('Превышен лимит запросов к Tinkoff API')
+        elif status_code != 200:
+            raise UnknownError(f'Неизвестный status_code запроса: {status_code}')
+
+
+class TinkoffProfile(BaseTinkoffProfile):
+    def __init__(self, token: str, transport: Optional[Transport] = None):
+        """
+        :param token: токен от Tinkoff API
+        :param transport: через что отправляются запросы, по умолчанию - Transport.from_env()
+        """
+        self.transport = transport if transport is not None else Transport.from_env()
+        super().__init__(token)
+
+    def auth(self, first='production') -> str:
+        """ Авторизация по токену
+        :param first: Какой метод авторизации будет первым (production/sandbox).
+            Если авторизация не пройдет успешно, будет попытка вызвать другой метод
+        """
+        auth_info = self.auth_cache.get(self.token)
+        if auth_info is not None:
+            return self.apply_auth_info(auth_info)
+        for url in self.auth_urls(first):
+            response = self.request('GET', url)
             if response.status_code == 200:
-                # FIXME: может быть несколько аккаунтов
-                response_json = response.json()
-                self.broker_account_id: str = response_json['payload']['accounts'][0]['brokerAccountId']
-                self.is_sandbox_token_valid = self.broker_account_id.startswith('SB')
-                self.is_production_token_valid = not self.is_sandbox_token_valid
-                self._session.headers.update({
-                    'Authorization': f'Bearer {self.token}'
-                })
-                return 'sandbox' if self.is_sandbox_token_valid else 'production'
+                return self.set_accounts(response.json())
             elif response.status_code in (401, 500):
                 pass
         raise InvalidTokenError('Авторизация по токенам не удалась')
 
-    @property
-    def is_authorized(self) -> bool:
-        return self.is_sandbox_token_valid or self.is_production_token_valid
-
     @only_authorized
     @generate_url
     def market_currencies(self, url: str):
         logger.info('Получение от Tinkoff API: market/currencies/')
-        return self.response_to_json(self._session.get(url))
+        return self.cached_get_json(url)
 
     @only_authorized
     @generate_url
     def market_stocks(self, url: str):
-        return self.response_to_json(self._session.get(url))
+        return self.cached_get_json(url)
+
+    @only_authorized
+    def market_search_by_figi(self, figi: str):
+        """ Инструмент по FIGI (для инструментов, которых нет в БД) """
+        logger.info(f'Получение от Tinkoff API: market/search/by-figi/ {figi}')
+        return self.cached_get_json(self.search_by_figi_url(figi))
 
     @only_authorized
     @generate_url
-    def operations(self, from_datetime: dt.datetime, to_datetime: dt.datetime, url: str):
-        """ Парсинг операций из tinkoff API в определенном временном интервале
+    def operations(self, from_datetime: dt.datetime, to_datetime: dt.datetime, url: str,
+                   window: Optional[dt.timedelta] = None, broker_account_id: Optional[str] = None):
+        """ Парсинг операций из tinkoff API в определенном временном интервале.
+            Длинный промежуток разбивается на окна, которые запрашиваются параллельно
         :param from_datetime: дата начала промежутка
         :param to_datetime: дата конца промежутка
         :param url: куда отправлять запрос
+        :param window: длина окна, если None - operations_window
+        :param broker_account_id: брокерский счет, если None - счет по умолчанию
         :return: список операций
         """
         logger.info(f'Собираемся обновлять операции от {from_datetime.isoformat()} до {to_datetime.isoformat()}')
         self.check_date_range(from_datetime, to_datetime)
-        response = self.response_to_json(self._session.get(
-            url, data={
+        windows = self.split_date_range(from_datetime, to_datetime, window)
+        params = self.account_params(broker_account_id)
+        if len(windows) == 1:
+            responses = [self._operations_window(url, *windows[0], params=params)]
+        else:
+            logger.info(f'Промежуток разбит на {len(windows)} окон')
+            with ThreadPoolExecutor(max_workers=self.operations_max_workers) as executor:
+                responses = list(executor.map(lambda w: self._operations_window(url, *w, params=params), windows))
+        response = self.merge_operations(responses)
+        logger.info('Операции получены')
+        return response
+
+    def _operations_window(self, url: str, from_datetime: dt.datetime, to_datetime: dt.datetime,
+                           params: Optional[dict] = None, **json_kwargs) -> dict:
+        return self.response_to_json(self.request(
+            'GET', url, params={
+                **(params or {}),
                 'from': from_datetime.isoformat(),
                 'to': to_datetime.isoformat()
             }
-        ))
-        logger.info('Операции получены')
-        return response
+        ), **json_kwargs)
 
-    @staticmethod
-    def check_date_range(from_datetime: dt.datetime, to_datetime: dt.datetime) -> True:
-        """ Проверка дат на корректность.
-            from_datetime должна быть меньше to_datetime,
-            обе даты должны быть типа datetime, и иметь timezone
-        :param from_datetime: начало промежутка
-        :param to_datetime: конец промежутка
-        :return: True или raise InvalidArgumentError
+    @only_authorized
+    def operations_records(self, from_datetime: dt.datetime, to_datetime: dt.datetime,
+                           batch_size: int = 500, window: Optional[dt.timedelta] = None,
+                           broker_account_id: Optional[str] = None) -> Iterator[List[OperationRecord]]:
+        """ Операции в виде OperationRecord пачками по batch_size, от старых к новым.
+            Одновременно в памяти находятся только окна, которые сейчас запрашиваются
+            (не больше operations_max_workers), поэтому память не растет вместе с историей счета
+        :param from_datetime: дата начала промежутка
+        :param to_datetime: дата конца промежутка
+        :param batch_size: размер пачки
+        :param window: длина окна, если None - operations_window
+        :param broker_account_id: брокерский счет, если None - счет по умолчанию
         """
-        logger.info(f'Проверка валидности двух дат: {from_datetime} и {to_datetime}')
-        if not (isinstance(from_datetime, dt.datetime) and isinstance(to_datetime, dt.datetime)):
-            raise InvalidArgumentError('Аргументы from_datetime и to_datetime должны быть типа datetime')
-        if from_datetime >= to_datetime:
-            raise InvalidArgumentError('Аргумент from_datetime должен быть меньше аргумента to_datetime')
-        if getattr(from_datetime, 'tzinfo', None) is None or getattr(to_datetime, 'tzinfo', None) is None:
-            raise InvalidArgumentError('Аргументы from_datetime и to_datetime должны быть с timezone')
-        if from_datetime.tzinfo != to_datetime.tzinfo:
-            raise InvalidArgumentError('Временная зона должна быть одинаковой')
-        if not (callable(getattr(from_datetime, 'isoformat', None)) and
-                callable(getattr(to_datetime, 'isoformat', None))):
-            raise InvalidArgumentError('Аргументы from_datetime и to_datetime должны иметь метод isoformat')
-        logger.info('Даты валидны')
+        logger.info(f'Собираемся обновлять операции от {from_datetime.isoformat()} до {to_datetime.isoformat()}')
+        self.check_date_range(from_datetime, to_datetime)
+        windows = self.split_date_range(from_datetime, to_datetime, window)[::-1]
+        return batched(self._iter_operations_records(
+            self.url_for('operations'), windows, self.account_params(broker_account_id)
+        ), batch_size)
+
+    def _iter_operations_records(self, url: str, windows: List[Tuple[dt.datetime, dt.datetime]],
+                                 params: Optional[dict] = None) -> Iterator[OperationRecord]:
+        # id операций предыдущего окна, операция на границе окон приходит в обоих
+        previous_ids = set()
+        with ThreadPoolExecutor(max_workers=self.operations_max_workers) as executor:
+            futures = collections.deque()
+            windows = iter(windows)
+            for window_from, window_to in windows:
+                futures.append(executor.submit(
+                    self._operations_window, url, window_from, window_to, params, parse_float=Decimal
+                ))
+                if len(futures) >= self.operations_max_workers:
+                    break
+            while futures:
+                operations = futures.popleft().result()['payload']['operations']
+                next_window = next(windows, None)
+                if next_window is not None:
+                    futures.append(executor.submit(
+                        self._operations_window, url, *next_window, params, parse_float=Decimal
+                    ))
+                current_ids = set()
+                # Tinkoff API возвращает операции от новых к старым
+                for operation in reversed(operations):
+                    current_ids.add(operation['id'])
+                    if operation['id'] not in previous_ids:
+                        yield OperationRecord.from_json(operation)
+                previous_ids = current_ids
+        logger.info('Операции получены')
 
     @only_authorized
     @generate_url
-    def portfolio(self, url: str):
-        return self.response_to_json(self._session.get(url))
+    def portfolio(self, url: str, broker_account_id: Optional[str] = None):
+        return self.response_to_json(self.request('GET', url, params=self.account_params(broker_account_id)))
 
     @only_authorized
     @generate_url
-    def portfolio_currencies(self, url: str):
-        return self.response_to_json(self._session.get(url))
-
-    def response_to_json(self, response):
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code in (401, 500):
-            raise UnauthorizedError('Токен не действителен')
-        else:
-            raise UnknownError(f'Неизвестный status_code запроса: {response.status_code}')
+    def portfolio_currencies(self, url: str, broker_account_id: Optional[str] = None):
+        return self.response_to_json(self.request('GET', url, params=self.account_params(broker_account_id)))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """ Запрос к Tinkoff API с учетом лимитов и повтором при 429/5xx """
+        bucket = RateLimits.bucket(url)
+        kwargs['headers'] = {**self.authorization_headers, **(kwargs.get('headers') or {})}
+        attempt = 0
+        while True:
+            bucket.acquire()
+            response = self.transport.request(method, url, **kwargs)
+            if not self.retry_policy.should_retry(response.status_code, attempt):
+                return response
+            delay = self.retry_policy.delay(attempt, response.headers.get('Retry-After'))
+            logger.warning(f'Tinkoff API ответил {response.status_code}, повтор через {delay:.2f} сек.')
+            time.sleep(delay)
+            attempt += 1
+
+    def cached_get_json(self, url: str):
+        """ GET запрос справочника через catalog_cache.
+            Свежий ответ берется с диска, устаревший - проверяется условным запросом
+        """
+        cache = self.catalog_cache
+        if cache is None:
+            return self.response_to_json(self.request('GET', url), catalog=True)
+        entry = cache.get(url)
+        if entry is not None and entry.is_fresh(cache.ttl):
+            logger.info(f'Ответ {url} взят из кэша')
+            return entry.payload
+        headers = entry.conditional_headers() if entry is not None else {}
+        response = self.request('GET', url, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            logger.info(f'Ответ {url} не изменился, продлеваем кэш')
+            return cache.revalidated(url, entry).payload
+        payload = self.response_to_json(response, catalog=True)
+        cache.set(url, CacheEntry(payload, response.headers.get('ETag'), response.headers.get('Last-Modified')))
+        return payload
+
+    def response_to_json(self, response, catalog: bool = False, **json_kwargs):
+        self.check_status_code(response.status_code, catalog=catalog)
+        return response.json(**json_kwargs)
 
     def close(self):
-        self._session.close()
+        self.transport.close()
 
     def __enter__(self):
         if not self.is_authorized:
@@ -0,0 +1,205 @@
+""" Асинхронный клиент Tinkoff API.
+    Все профили одного event loop работают через общий пул keep-alive соединений,
+    поэтому синхронизация множества ИС не упирается в последовательные HTTP запросы
+"""
+import asyncio
+import datetime as dt
+import logging
+import weakref
+from typing import Optional
+
+import aiohttp
+
+from tinkoff_api._api import BaseTinkoffProfile, only_authorized, generate_url
+from tinkoff_api._cache import CacheEntry
+from tinkoff_api._throttling import RateLimits
+from tinkoff_api.exceptions import InvalidTokenError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSessionPool:
+    """ Общий пул соединений (aiohttp.ClientSession) для каждого event loop """
+    # Максимальное количество одновременных соединений
+    limit = 100
+    # Максимальное количество одновременных соединений с одним хостом
+    limit_per_host = 20
+    # Сколько секунд держать неиспользуемое соединение открытым
+    keepalive_timeout = 30
+    # Таймаут одного запроса в секундах
+    timeout = 60
+
+    _sessions: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]' = \
+        weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get_session(cls) -> aiohttp.ClientSession:
+        """ Сессия текущего event loop, создается при первом обращении """
+        loop = asyncio.get_running_loop()
+        session = cls._sessions.get(loop)
+        if session is None or session.closed:
+            logger.info('Создание общего пула соединений для Tinkoff API')
+            connector = aiohttp.TCPConnector(
+                limit=cls.limit, limit_per_host=cls.limit_per_host, keepalive_timeout=cls.keepalive_timeout
+            )
+            session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=cls.timeout)
+            )
+            cls._sessions[loop] = session
+        return session
+
+    @classmethod
+    async def close(cls) -> None:
+        """ Закрытие пула соединений текущего event loop """
+        session = cls._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+
+class AsyncTinkoffProfile(BaseTinkoffProfile):
+    """ Асинхронный аналог TinkoffProfile """
+
+    def __init__(self, token: str, session: Optional[aiohttp.ClientSession] = None):
+        """
+        :param token: токен от Tinkoff API
+        :param session: сессия aiohttp, если None, будет использоваться общий пул AsyncSessionPool
+        """
+        super().__init__(token)
+        self._session = session
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is not None:
+            return self._session
+        return AsyncSessionPool.get_session()
+
+    async def auth(self, first='production') -> str:
+        """ Авторизация по токену
+        :param first: Какой метод авторизации будет первым (production/sandbox).
+            Если авторизация не пройдет успешно, будет попытка вызвать другой метод
+        """
+        auth_info = self.auth_cache.get(self.token)
+        if auth_info is not None:
+            return self.apply_auth_info(auth_info)
+        for url in self.auth_urls(first):
+            response = await self.request('GET', url, headers=self.authorization_headers)
+            if response.status == 200:
+                return self.set_accounts(await response.json())
+        raise InvalidTokenError('Авторизация по токенам не удалась')
+
+    @only_authorized
+    @generate_url
+    async def market_currencies(self, url: str):
+        logger.info('Получение от Tinkoff API: market/currencies/')
+        return await self.cached_get_json(url)
+
+    @only_authorized
+    @generate_url
+    async def market_stocks(self, url: str):
+        return await self.cached_get_json(url)
+
+    @only_authorized
+    async def market_search_by_figi(self, figi: str):
+        logger.info(f'Получение от Tinkoff API: market/search/by-figi/ {figi}')
+        return await self.cached_get_json(self.search_by_figi_url(figi))
+
+    @only_authorized
+    @generate_url
+    async def operations(self, from_datetime: dt.datetime, to_datetime: dt.datetime, url: str,
+                         window: Optional[dt.timedelta] = None, broker_account_id: Optional[str] = None):
+        """ Парсинг операций из tinkoff API в определенном временном интервале.
+            Длинный промежуток разбивается на окна, которые запрашиваются параллельно
+        :param from_datetime: дата начала промежутка
+        :param to_datetime: дата конца промежутка
+        :param url: куда отправлять запрос
+        :param window: длина окна, если None - operations_window
+        :param broker_account_id: брокерский счет, если None - счет по умолчанию
+        :return: список операций
+        """
+        logger.info(f'Собираемся обновлять операции от {from_datetime.isoformat()} до {to_datetime.isoformat()}')
+        self.check_date_range(from_datetime, to_datetime)
+        semaphore = asyncio.Semaphore(self.operations_max_workers)
+
+        async def operations_window(window_from: dt.datetime, window_to: dt.datetime) -> dict:
+            async with semaphore:
+                return await self.get_json(url, params={
+                    'from': window_from.isoformat(),
+                    'to': window_to.isoformat(),
+                    **self.account_params(broker_account_id)
+                })
+
+        windows = self.split_date_range(from_datetime, to_datetime, window)
+        responses = await asyncio.gather(*(operations_window(*w) for w in windows))
+        response = self.merge_operations(list(responses))
+        logger.info('Операции получены')
+        return response
+
+    @only_authorized
+    @generate_url
+    async def portfolio(self, url: str, broker_account_id: Optional[str] = None):
+        return await self.get_json(url, params=self.account_params(broker_account_id))
+
+    @only_authorized
+    @generate_url
+    async def portfolio_currencies(self, url: str, broker_account_id: Optional[str] = None):
+        return await self.get_json(url, params=self.account_params(broker_account_id))
+
+    async def request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """ Запрос к Tinkoff API с учетом лимитов и повтором при 429/5xx.
+            Тело ответа читается сразу, чтобы соединение вернулось в пул
+        """
+        bucket = RateLimits.bucket(url)
+        attempt = 0
+        while True:
+            await bucket.acquire_async()
+            async with self.session.request(method, url, **kwargs) as response:
+                await response.read()
+            if not self.retry_policy.should_retry(response.status, attempt):
+                return response
+            delay = self.retry_policy.delay(attempt, response.headers.get('Retry-After'))
+            logger.warning(f'Tinkoff API ответил {response.status}, повтор через {delay:.2f} сек.')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_json(self, url: str, catalog: bool = False, **kwargs):
+        """ GET запрос к Tinkoff API, возвращает ответ в виде json
+        :param catalog: запрос справочника (см. check_status_code)
+        """
+        response = await self.request('GET', url, headers=self.authorization_headers, **kwargs)
+        self.check_status_code(response.status, catalog=catalog)
+        return await response.json()
+
+    async def cached_get_json(self, url: str):
+        """ GET запрос справочника через catalog_cache (см. TinkoffProfile.cached_get_json) """
+        cache = self.catalog_cache
+        if cache is None:
+            return await self.get_json(url, catalog=True)
+        entry = cache.get(url)
+        if entry is not None and entry.is_fresh(cache.ttl):
+            logger.info(f'Ответ {url} взят из кэша')
+            return entry.payload
+        headers = {**self.authorization_headers, **(entry.conditional_headers() if entry is not None else {})}
+        response = await self.request('GET', url, headers=headers)
+        if response.status == 304 and entry is not None:
+            logger.info(f'Ответ {url} не изменился, продлеваем кэш')
+            return cache.revalidated(url, entry).payload
+        self.check_status_code(response.status, catalog=True)
+        payload = await response.json()
+        cache.set(url, CacheEntry(payload, response.headers.get('ETag'), response.headers.get('Last-Modified')))
+        return payload
+
+    async def close(self):
+        """ Сессия не принадлежит профилю: переданную сессию закрывает тот, кто ее создал,
+            общий пул закрывается через AsyncSessionPool.close()
+        """
+
+    async def __aenter__(self):
+        if not self.is_authorized:
+            await self.auth()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __str__(self):
+        return f'{self.__class__.__name__} (broker_account_id={self.broker_account_id})'
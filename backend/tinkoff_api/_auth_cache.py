@@ -0,0 +1,89 @@
+""" Кэш результатов авторизации.
+    Хранит, к каким брокерским счетам относится токен и является ли он токеном песочницы,
+    чтобы не отправлять запросы user/accounts при каждом создании профиля.
+    Ключ - отпечаток токена, сам токен в кэше не хранится
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+def token_fingerprint(token: str) -> str:
+    """ Отпечаток токена, по которому нельзя восстановить сам токен """
+    return hashlib.sha256(token.encode('latin-1')).hexdigest()
+
+
+class BrokerAccount:
+    """ Брокерский счет, доступный по токену (брокерский счет, ИИС) """
+    __slots__ = ('broker_account_id', 'broker_account_type')
+
+    def __init__(self, broker_account_id: str, broker_account_type: Optional[str] = None):
+        self.broker_account_id = broker_account_id
+        self.broker_account_type = broker_account_type
+
+    @classmethod
+    def from_json(cls, account: dict) -> 'BrokerAccount':
+        return cls(account['brokerAccountId'], account.get('brokerAccountType'))
+
+    def __repr__(self):
+        return f'<BrokerAccount {self.broker_account_type}: {self.broker_account_id}>'
+
+
+class AuthInfo:
+    """ Результат авторизации по токену """
+    __slots__ = ('broker_accounts', 'is_sandbox')
+
+    def __init__(self, broker_accounts: List[BrokerAccount], is_sandbox: bool):
+        self.broker_accounts = broker_accounts
+        self.is_sandbox = is_sandbox
+
+    @property
+    def broker_account_id(self) -> str:
+        """ Счет по умолчанию - первый в ответе user/accounts """
+        return self.broker_accounts[0].broker_account_id
+
+
+class AuthCache:
+    """ Кэш AuthInfo в памяти процесса с ограниченным временем жизни записей """
+
+    def __init__(self, ttl: float = 600):
+        """
+        :param ttl: сколько секунд хранится результат авторизации, 0 - не кэшировать
+        """
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, AuthInfo]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'AuthCache':
+        return cls(float(os.getenv('tinkoff_api_auth_cache_ttl', 600)))
+
+    def get(self, token: str) -> Optional[AuthInfo]:
+        if self.ttl <= 0:
+            return None
+        fingerprint = token_fingerprint(token)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                return None
+            stored_at, auth_info = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._entries[fingerprint]
+                return None
+            return auth_info
+
+    def set(self, token: str, auth_info: AuthInfo) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[token_fingerprint(token)] = (time.monotonic(), auth_info)
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            self._entries.pop(token_fingerprint(token), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,107 @@
+""" Кэш редко изменяющихся справочников Tinkoff API (market/stocks, market/currencies).
+    Ответы хранятся на диске, поэтому переживают перезапуск.
+    Пока запись свежая (не старше ttl), запрос к API не отправляется,
+    после - запись проверяется условным запросом (If-None-Match/If-Modified-Since)
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    """ Закэшированный ответ """
+    __slots__ = ('payload', 'etag', 'last_modified', 'stored_at')
+
+    def __init__(self, payload, etag: Optional[str] = None, last_modified: Optional[str] = None,
+                 stored_at: Optional[float] = None):
+        self.payload = payload
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at if stored_at is not None else time.time()
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.stored_at < ttl
+
+    def conditional_headers(self) -> dict:
+        """ Заголовки для проверки, изменился ли ответ на сервере """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def to_dict(self) -> dict:
+        return {
+            'payload': self.payload,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'stored_at': self.stored_at
+        }
+
+
+class CatalogCache:
+    """ Дисковый кэш ответов, ключ - url запроса (токен в ключ не входит) """
+
+    def __init__(self, directory: str, ttl: float = 3600):
+        """
+        :param directory: директория, в которой хранятся ответы
+        :param ttl: сколько секунд ответ считается свежим
+        """
+        self.directory = directory
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls) -> Optional['CatalogCache']:
+        """ Кэш, настроенный через переменные окружения.
+            tinkoff_api_cache_ttl=0 отключает кэширование
+        """
+        ttl = float(os.getenv('tinkoff_api_cache_ttl', 3600))
+        if ttl <= 0:
+            return None
+        directory = os.getenv('tinkoff_api_cache_dir') or os.path.join(tempfile.gettempdir(), 'tinkoff_api_cache')
+        return cls(directory, ttl)
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        try:
+            with open(self._path(url), encoding='utf-8') as file:
+                return CacheEntry(**json.load(file))
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError, OSError):
+            logger.warning(f'Поврежденная запись кэша для {url}, игнорируем ее')
+            return None
+
+    def set(self, url: str, entry: CacheEntry) -> None:
+        """ Атомарная запись: сначала во временный файл, потом переименование """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(entry.to_dict(), file, ensure_ascii=False)
+            os.replace(tmp_path, self._path(url))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def revalidated(self, url: str, entry: CacheEntry) -> CacheEntry:
+        """ Сервер подтвердил, что ответ не изменился (304), продлеваем запись """
+        entry.stored_at = time.time()
+        self.set(url, entry)
+        return entry
+
+    def clear(self) -> None:
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                os.unlink(os.path.join(self.directory, name))
@@ -0,0 +1,119 @@
+""" Типизированное представление операций Tinkoff API.
+    Вместо словарей из json используются компактные объекты со __slots__,
+    даты разбираются один раз быстрым ISO парсером, денежные значения хранятся в Decimal
+"""
+import datetime as dt
+import re
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Optional, TypeVar
+
+import dateutil.parser
+
+T = TypeVar('T')
+
+# Дробная часть секунд, которую datetime.fromisoformat (python3.8) не понимает
+_FRACTION_RE = re.compile(r'\.(\d+)')
+
+
+def parse_datetime(value: str) -> dt.datetime:
+    """ Разбор даты в формате ISO 8601.
+        Быстрый путь - datetime.fromisoformat, dateutil используется только для нестандартных дат
+    """
+    try:
+        return dt.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    normalized = value[:-1] + '+00:00' if value.endswith('Z') else value
+    normalized = _FRACTION_RE.sub(lambda m: '.' + m.group(1)[:6].ljust(6, '0'), normalized, count=1)
+    try:
+        return dt.datetime.fromisoformat(normalized)
+    except ValueError:
+        return dateutil.parser.isoparse(value)
+
+
+def parse_money(value) -> Decimal:
+    """ Денежное значение в Decimal, без промежуточного float, если json разобран с parse_float=Decimal """
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return Decimal(value)
+
+
+class TradeRecord:
+    """ Сделка (транзакция) внутри операции покупки/продажи """
+    __slots__ = ('trade_id', 'date', 'quantity', 'price')
+
+    def __init__(self, trade_id: str, date: dt.datetime, quantity: int, price: Decimal):
+        self.trade_id = trade_id
+        self.date = date
+        self.quantity = quantity
+        self.price = price
+
+    @classmethod
+    def from_json(cls, trade: dict) -> 'TradeRecord':
+        return cls(trade['tradeId'], parse_datetime(trade['date']), trade['quantity'], parse_money(trade['price']))
+
+
+class OperationRecord:
+    """ Операция Tinkoff API """
+    __slots__ = (
+        'id', 'status', 'operation_type', 'date', 'is_margin_call', 'payment', 'currency',
+        'figi', 'instrument_type', 'quantity', 'commission', 'trades'
+    )
+
+    def __init__(self, id: str, status: str, operation_type: str, date: dt.datetime, is_margin_call: bool,
+                 payment: Decimal, currency: str, figi: Optional[str] = None, instrument_type: Optional[str] = None,
+                 quantity: int = 0, commission: Optional[Decimal] = None, trades: Optional[List[TradeRecord]] = None):
+        self.id = id
+        self.status = status
+        self.operation_type = operation_type
+        self.date = date
+        self.is_margin_call = is_margin_call
+        self.payment = payment
+        self.currency = currency
+        self.figi = figi
+        self.instrument_type = instrument_type
+        self.quantity = quantity
+        # Некоторые операции могут быть без комиссии (например в первый месяц торгов)
+        self.commission = commission
+        self.trades = trades or []
+
+    @classmethod
+    def from_json(cls, operation: dict) -> 'OperationRecord':
+        commission = operation.get('commission')
+        return cls(
+            id=operation['id'],
+            status=operation['status'],
+            operation_type=operation['operationType'],
+            date=parse_datetime(operation['date']),
+            is_margin_call=operation.get('isMarginCall', False),
+            payment=parse_money(operation.get('payment', 0)),
+            currency=operation['currency'],
+            figi=operation.get('figi'),
+            instrument_type=operation.get('instrumentType'),
+            quantity=operation.get('quantity', 0),
+            commission=parse_money(commission['value']) if isinstance(commission, dict) else None,
+            trades=[TradeRecord.from_json(trade) for trade in operation.get('trades') or ()]
+        )
+
+    def __repr__(self):
+        return f'<OperationRecord {self.operation_type}({self.id}): {self.date.isoformat()} {self.payment}>'
+
+
+def iter_operation_records(operations: Iterable[dict]) -> Iterator[OperationRecord]:
+    """ Ленивое преобразование операций из json в OperationRecord """
+    for operation in operations:
+        yield OperationRecord.from_json(operation)
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """ Разбивает последовательность на списки длиной size (последний может быть короче) """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
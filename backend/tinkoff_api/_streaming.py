@@ -0,0 +1,176 @@
+""" Streaming клиент рыночных данных Tinkoff API (production_streaming_url).
+    Подписывается на свечи по списку FIGI, при обрыве соединения
+    переподключается и заново подписывается, последние цены хранит в памяти
+"""
+import asyncio
+import datetime as dt
+import json
+import logging
+import random
+import threading
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Set
+
+import aiohttp
+
+from tinkoff_api._api import TinkoffApiUrl
+
+logger = logging.getLogger(__name__)
+
+
+class LastPrice:
+    """ Последняя известная цена ценной бумаги """
+    __slots__ = ('figi', 'price', 'time')
+
+    def __init__(self, figi: str, price: Decimal, time: dt.datetime):
+        self.figi = figi
+        self.price = price
+        self.time = time
+
+    def __repr__(self):
+        return f'<LastPrice {self.figi}: {self.price} ({self.time.isoformat()})>'
+
+
+class LastPriceTable:
+    """ Таблица последних цен, безопасна для чтения из других потоков """
+
+    def __init__(self):
+        self._prices: Dict[str, LastPrice] = {}
+        self._lock = threading.Lock()
+
+    def update(self, figi: str, price: Decimal, time: dt.datetime) -> None:
+        """ Обновляет цену, если она новее уже сохраненной """
+        with self._lock:
+            last_price = self._prices.get(figi)
+            if last_price is None or last_price.time <= time:
+                self._prices[figi] = LastPrice(figi, price, time)
+
+    def get(self, figi: str) -> Optional[LastPrice]:
+        with self._lock:
+            return self._prices.get(figi)
+
+    def snapshot(self) -> Dict[str, LastPrice]:
+        with self._lock:
+            return dict(self._prices)
+
+    def __len__(self):
+        return len(self._prices)
+
+
+class MarketDataStream:
+    """ Подписка на свечи и последние цены по websocket.
+        Последняя цена - цена закрытия последней полученной свечи
+    """
+    # Интервал свечей, на которые подписывается клиент
+    candle_interval = '1min'
+    # Задержка перед переподключением: экспоненциальная, со случайным разбросом
+    reconnect_delay_base = 0.5
+    reconnect_delay_max = 30
+    # Как часто отправлять ping, чтобы сервер не закрыл неактивное соединение
+    heartbeat = 30
+
+    def __init__(self, token: str, figies: Iterable[str] = (), url: str = TinkoffApiUrl.production_streaming_url,
+                 prices: Optional[LastPriceTable] = None):
+        """
+        :param token: токен от Tinkoff API
+        :param figies: FIGI, на которые надо подписаться сразу после подключения
+        :param url: адрес websocket
+        :param prices: таблица, в которую будут записываться цены, если None - создается новая
+        """
+        self.token = token
+        self.url = url
+        self.prices = prices if prices is not None else LastPriceTable()
+        self.figies: Set[str] = set(figies)
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        # Создается в run(), чтобы быть привязанным к event loop, в котором работает клиент
+        self._stopped: Optional[asyncio.Event] = None
+        # Количество успешных подключений, нужно для наблюдения за переподключениями
+        self.connections = 0
+
+    def subscribe_message(self, figi: str) -> dict:
+        return {'event': 'candle:subscribe', 'figi': figi, 'interval': self.candle_interval}
+
+    def unsubscribe_message(self, figi: str) -> dict:
+        return {'event': 'candle:unsubscribe', 'figi': figi, 'interval': self.candle_interval}
+
+    async def subscribe(self, figies: Iterable[str]) -> None:
+        """ Добавляет FIGI в подписку, если соединение уже установлено - подписывается сразу """
+        new_figies = set(figies) - self.figies
+        self.figies |= new_figies
+        if self._ws is not None and not self._ws.closed:
+            for figi in new_figies:
+                await self._ws.send_json(self.subscribe_message(figi))
+
+    async def unsubscribe(self, figies: Iterable[str]) -> None:
+        removed_figies = self.figies & set(figies)
+        self.figies -= removed_figies
+        if self._ws is not None and not self._ws.closed:
+            for figi in removed_figies:
+                await self._ws.send_json(self.unsubscribe_message(figi))
+
+    def handle_message(self, message: dict) -> None:
+        """ Обработка одного события от сервера """
+        event = message.get('event')
+        payload = message.get('payload') or {}
+        if event == 'candle':
+            self.prices.update(
+                payload['figi'],
+                Decimal(str(payload['c'])),
+                dt.datetime.fromisoformat(payload['time'].replace('Z', '+00:00'))
+            )
+        elif event == 'error':
+            logger.warning(f'Ошибка streaming API: {payload}')
+
+    async def run(self, session: Optional[aiohttp.ClientSession] = None) -> None:
+        """ Слушает поток до вызова stop(), переподключаясь при обрывах """
+        self._stopped = asyncio.Event()
+        own_session = session is None
+        if own_session:
+            session = aiohttp.ClientSession()
+        attempt = 0
+        try:
+            while not self._stopped.is_set():
+                try:
+                    await self._listen(session)
+                    attempt = 0
+                except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                    logger.warning(f'Соединение с streaming API прервано: {e!r}')
+                if self._stopped.is_set():
+                    break
+                delay = random.uniform(0, min(self.reconnect_delay_max, self.reconnect_delay_base * 2 ** attempt))
+                attempt += 1
+                logger.info(f'Переподключение к streaming API через {delay:.2f} сек.')
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if own_session:
+                await session.close()
+
+    async def _listen(self, session: aiohttp.ClientSession) -> None:
+        async with session.ws_connect(
+                self.url, headers={'Authorization': f'Bearer {self.token}'}, heartbeat=self.heartbeat
+        ) as ws:
+            self._ws = ws
+            self.connections += 1
+            logger.info(f'Подключение к streaming API, подписка на {len(self.figies)} FIGI')
+            try:
+                for figi in set(self.figies):
+                    await ws.send_json(self.subscribe_message(figi))
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        try:
+                            self.handle_message(json.loads(msg.data))
+                        except (ValueError, KeyError, TypeError, ArithmeticError):
+                            logger.warning(f'Некорректное сообщение streaming API: {msg.data}')
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        raise ws.exception() or ConnectionError('Ошибка websocket')
+            finally:
+                self._ws = None
+
+    async def stop(self) -> None:
+        if self._stopped is not None:
+            self._stopped.set()
+        if self._ws is not None:
+            await self._ws.close()
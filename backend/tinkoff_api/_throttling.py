@@ -0,0 +1,156 @@
+""" Ограничение частоты запросов к Tinkoff API и повтор неудачных запросов.
+    Лимиты общие для всех профилей процесса, поэтому параллельные синхронизации
+    нескольких ИС не превышают ограничений брокера
+"""
+import asyncio
+import datetime as dt
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from tinkoff_api.exceptions import InvalidArgumentError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Алгоритм token bucket.
+        Каждый запрос забирает один токен, токены восстанавливаются со скоростью rate в секунду.
+        Если токенов нет, запрос резервирует следующий свободный токен и ждет его появления
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        :param rate: сколько токенов восстанавливается за секунду
+        :param capacity: максимальное количество токенов (размер всплеска), по умолчанию rate
+        """
+        if rate <= 0:
+            raise InvalidArgumentError('rate должен быть больше 0')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """ Забирает токен
+        :return: сколько секунд надо подождать, прежде чем отправлять запрос
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay:
+            logger.info(f'Лимит запросов исчерпан, ждем {delay:.2f} сек.')
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self.reserve()
+        if delay:
+            logger.info(f'Лимит запросов исчерпан, ждем {delay:.2f} сек.')
+            await asyncio.sleep(delay)
+
+
+class RateLimits:
+    """ Лимиты запросов в минуту для каждой группы методов Tinkoff API.
+        Группа определяется первым сегментом пути (market, operations, portfolio, user),
+        все запросы к песочнице попадают в группу sandbox
+    """
+    limits: Dict[str, float] = {
+        'market': 240,
+        'operations': 120,
+        'portfolio': 120,
+        'orders': 100,
+        'user': 120,
+        'sandbox': 120,
+        'default': 120,
+    }
+
+    _buckets: Dict[str, TokenBucket] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, **limits: float) -> None:
+        """ Изменение лимитов, например RateLimits.configure(market=120, operations=60) """
+        with cls._lock:
+            cls.limits = {**cls.limits, **limits}
+            cls._buckets = {}
+
+    @staticmethod
+    def group_by_url(url: str) -> str:
+        """ Группа методов, к которой относится url """
+        path = [i for i in urlparse(url).path.split('/') if i]
+        if path and path[0] == 'openapi':
+            path = path[1:]
+        if not path:
+            return 'default'
+        return path[0]
+
+    @classmethod
+    def bucket(cls, url: str) -> TokenBucket:
+        group = cls.group_by_url(url)
+        if group not in cls.limits:
+            group = 'default'
+        with cls._lock:
+            if group not in cls._buckets:
+                cls._buckets[group] = TokenBucket(cls.limits[group] / 60, capacity=cls.limits[group] / 6)
+            return cls._buckets[group]
+
+
+class RetryPolicy:
+    """ Повтор запросов с экспоненциальной задержкой и случайным разбросом (full jitter).
+        Если сервер передал Retry-After, ждем столько, сколько он просит
+    """
+    # 500 не повторяется: Tinkoff API отвечает им на недействительный токен
+    retry_status_codes = (429, 502, 503, 504)
+
+    def __init__(self, max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30):
+        """
+        :param max_retries: максимальное количество повторов
+        :param backoff_base: задержка перед первым повтором в секундах
+        :param backoff_max: максимальная задержка в секундах
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def should_retry(self, status_code: int, attempt: int) -> bool:
+        return status_code in self.retry_status_codes and attempt < self.max_retries
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """ Задержка перед повтором
+        :param attempt: номер повтора, начиная с 0
+        :param retry_after: значение заголовка Retry-After
+        """
+        retry_after_delay = self.parse_retry_after(retry_after)
+        if retry_after_delay is not None:
+            return min(retry_after_delay, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+        """ Retry-After может быть количеством секунд или HTTP датой """
+        if not retry_after:
+            return None
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=dt.timezone.utc)
+        return max((retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds(), 0)
@@ -0,0 +1,211 @@
+""" Транспорт, через который TinkoffProfile отправляет запросы.
+    Помимо обычного (requests) есть запись ответов в кассету и их воспроизведение,
+    что позволяет гонять синхронизацию и замерять ее скорость без доступа к Tinkoff API
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+
+from tinkoff_api.exceptions import InvalidArgumentError
+
+logger = logging.getLogger(__name__)
+
+# Заменяет токен во всем, что попадает в кассету
+TOKEN_PLACEHOLDER = '<TOKEN>'
+# Заголовки ответа, которые сохраняются в кассету
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+
+
+class Transport:
+    """ Базовый транспорт """
+
+    def request(self, method: str, url: str, **kwargs):
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def from_env() -> 'Transport':
+        """ Транспорт по умолчанию.
+            tinkoff_api_replay_cassette - воспроизводить ответы из кассеты,
+            tinkoff_api_record_cassette - отправлять запросы и записывать ответы в кассету
+        """
+        replay_cassette = os.getenv('tinkoff_api_replay_cassette')
+        if replay_cassette:
+            return ReplayTransport(replay_cassette, latency=float(os.getenv('tinkoff_api_replay_latency') or 0))
+        record_cassette = os.getenv('tinkoff_api_record_cassette')
+        if record_cassette:
+            return RecordingTransport(record_cassette)
+        return RequestsTransport()
+
+
+class RequestsTransport(Transport):
+    """ Запросы через requests.Session (keep-alive соединения внутри профиля).
+        requests.Session не потокобезопасна, а окна операций запрашиваются из нескольких потоков,
+        поэтому у каждого потока своя сессия
+    """
+
+    def __init__(self, session_factory: Callable[[], requests.Session] = requests.session):
+        """
+        :param session_factory: создает сессию для потока
+        """
+        self.session_factory = session_factory
+        self._sessions: Dict[threading.Thread, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """ Сессия текущего потока """
+        thread = threading.current_thread()
+        with self._lock:
+            session = self._sessions.get(thread)
+            if session is None:
+                # Потоки пула живут только пока идет запрос операций, их сессии больше не нужны
+                for finished_thread in [t for t in self._sessions if not t.is_alive()]:
+                    self._sessions.pop(finished_thread).close()
+                session = self._sessions[thread] = self.session_factory()
+            return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        return self.session.request(method, url, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+
+def _request_key(method: str, url: str, params: Optional[dict] = None, data: Optional[dict] = None) -> str:
+    """ Ключ, по которому запрос ищется в кассете """
+    key = f'{method.upper()} {url}'
+    query = {**(params or {}), **(data or {})}
+    if query:
+        key += '?' + urlencode(sorted(query.items()))
+    return key
+
+
+class ReplayResponse:
+    """ Ответ, восстановленный из кассеты, повторяет нужную часть интерфейса requests.Response """
+
+    def __init__(self, status_code: int, headers: Dict[str, str], body: str):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.text = body
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+
+def _load_cassette(cassette_path: str) -> Tuple[dict, List[dict]]:
+    """ Метаданные и ответы кассеты (старые кассеты - только список ответов) """
+    with open(cassette_path, encoding='utf-8') as file:
+        cassette = json.load(file)
+    if isinstance(cassette, list):
+        return {}, cassette
+    return cassette.get('metadata', {}), cassette['interactions']
+
+
+class RecordingTransport(Transport):
+    """ Отправляет запросы через другой транспорт и записывает ответы в кассету.
+        Токен из заголовка Authorization вырезается из url, тела запроса и ответа
+    """
+
+    def __init__(self, cassette_path: str, transport: Optional[Transport] = None, metadata: Optional[dict] = None):
+        """
+        :param cassette_path: путь к кассете
+        :param transport: через что отправляются запросы, по умолчанию - RequestsTransport
+        :param metadata: сохраняется в кассету вместе с ответами, например, промежуток синхронизации:
+            параметры from/to запросов операций входят в ключ, поэтому воспроизводить надо тот же промежуток
+        """
+        self.cassette_path = cassette_path
+        self.transport = transport if transport is not None else RequestsTransport()
+        self.metadata = metadata if metadata is not None else {}
+        self.interactions: List[dict] = []
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs):
+        response = self.transport.request(method, url, **kwargs)
+        authorization = (kwargs.get('headers') or {}).get('Authorization', '')
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else None
+
+        def scrub(value: str) -> str:
+            return value.replace(token, TOKEN_PLACEHOLDER) if token else value
+
+        interaction = {
+            'request': scrub(_request_key(method, url, kwargs.get('params'), kwargs.get('data'))),
+            'response': {
+                'status_code': response.status_code,
+                'headers': {k: scrub(response.headers[k]) for k in RECORDED_HEADERS if k in response.headers},
+                'body': scrub(response.text)
+            }
+        }
+        with self._lock:
+            self.interactions.append(interaction)
+        return response
+
+    def save(self) -> None:
+        """ Дописывает записанные ответы в кассету """
+        with self._lock:
+            interactions, self.interactions = self.interactions, []
+        if not interactions:
+            return
+        metadata = self.metadata
+        try:
+            saved_metadata, saved_interactions = _load_cassette(self.cassette_path)
+            metadata, interactions = {**saved_metadata, **metadata}, saved_interactions + interactions
+        except FileNotFoundError:
+            pass
+        directory = os.path.dirname(self.cassette_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.cassette_path, 'w', encoding='utf-8') as file:
+            json.dump({'metadata': metadata, 'interactions': interactions}, file, ensure_ascii=False, indent=1)
+        logger.info(f'В кассету {self.cassette_path} записано {len(interactions)} ответов')
+
+    def close(self) -> None:
+        self.save()
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    """ Воспроизводит ответы из кассеты, сеть не используется.
+        Одинаковые запросы получают записанные ответы по порядку, после последнего - повторяется последний
+    """
+
+    def __init__(self, cassette_path: str, latency: float = 0):
+        """
+        :param cassette_path: путь к кассете
+        :param latency: искусственная задержка каждого ответа в секундах
+        """
+        self.latency = latency
+        # Что было сохранено в кассету при записи (RecordingTransport.metadata)
+        self.metadata, interactions = _load_cassette(cassette_path)
+        self._responses: Dict[str, List[dict]] = {}
+        for interaction in interactions:
+            self._responses.setdefault(interaction['request'], []).append(interaction['response'])
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _next_response(self, key: str) -> dict:
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise InvalidArgumentError(f'В кассете нет ответа на запрос {key}')
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            return responses[min(position, len(responses) - 1)]
+
+    def request(self, method: str, url: str, **kwargs) -> ReplayResponse:
+        key = _request_key(method, url, kwargs.get('params'), kwargs.get('data'))
+        response = self._next_response(key)
+        if self.latency:
+            time.sleep(self.latency)
+        return ReplayResponse(response['status_code'], response['headers'], response['body'])
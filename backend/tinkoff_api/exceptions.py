@@ -16,3 +16,7 @@ class UnknownError(Exception):
 
 class InvalidArgumentError(Exception):
     pass
+
+
+class TooManyRequestsError(Exception):
+    pass
@@ -1,6 +1,36 @@
+import asyncio
+import datetime as dt
+import json
+import threading
+import time
+from decimal import Decimal
+
 import pytest
+from aiohttp import web, test_utils
+
+from tinkoff_api import TinkoffProfile, TinkoffApiUrl, AsyncTinkoffProfile, AsyncSessionPool, RateLimits, \
+    RetryPolicy, TokenBucket, CatalogCache, MarketDataStream, LastPriceTable
+from tinkoff_api import AuthCache
+from tinkoff_api._auth_cache import AuthInfo, BrokerAccount
+from tinkoff_api._records import OperationRecord, parse_datetime
+from tinkoff_api._transport import Transport, RecordingTransport, ReplayTransport, RequestsTransport
+from tinkoff_api.exceptions import InvalidArgumentError, InvalidTokenError, TooManyRequestsError, UnauthorizedError, \
+    UnknownError
+
+
+class FakeResponse:
+    """ Заглушка requests.Response """
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = headers or {}
 
-from tinkoff_api import TinkoffProfile
+    def json(self, **kwargs):
+        return self.payload if self.payload is not None else {'status_code': self.status_code}
+
+    @property
+    def text(self):
+        return json.dumps(self.json(), default=str)
 
 
 class TestTinkoffApiPermission:
@@ -16,3 +46,391 @@ class TestTinkoffApiPermission:
         assert not TinkoffProfile('something').is_production_token_valid
         assert not TinkoffProfile('something').is_authorized
 
+
+class TestAsyncTinkoffProfile:
+    token = 'async-token'
+
+    @staticmethod
+    async def _accounts(request):
+        if request.headers.get('Authorization') != f'Bearer {TestAsyncTinkoffProfile.token}':
+            return web.json_response({}, status=401)
+        return web.json_response({'payload': {'accounts': [{'brokerAccountId': '2000000000'}]}})
+
+    @staticmethod
+    async def _portfolio(request):
+        return web.json_response({'payload': {'positions': [{'figi': 'BBG000B9XRY4'}]}})
+
+    async def _run(self, monkeypatch, coroutine):
+        app = web.Application()
+        app.router.add_get('/openapi/user/accounts/', self._accounts)
+        app.router.add_get('/openapi/portfolio/', self._portfolio)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        base = str(server.make_url('/openapi/'))
+        monkeypatch.setattr(TinkoffApiUrl, 'production', TinkoffApiUrl._Url(base))
+        monkeypatch.setattr(TinkoffApiUrl, 'sandbox', TinkoffApiUrl._Url(base + 'sandbox/'))
+        try:
+            return await coroutine()
+        finally:
+            await AsyncSessionPool.close()
+            await server.close()
+
+    def test_init_auth(self):
+        assert not AsyncTinkoffProfile('something').is_authorized
+
+    def test_shared_session(self, monkeypatch):
+        async def coroutine():
+            async with AsyncTinkoffProfile(self.token) as tp1, AsyncTinkoffProfile(self.token) as tp2:
+                assert tp1.session is tp2.session
+                assert tp1.is_production_token_valid
+                return await asyncio.gather(tp1.portfolio(), tp2.portfolio())
+        portfolios = asyncio.run(self._run(monkeypatch, coroutine))
+        assert [p['payload']['positions'][0]['figi'] for p in portfolios] == ['BBG000B9XRY4'] * 2
+
+    def test_invalid_token(self, monkeypatch):
+        async def coroutine():
+            with pytest.raises(InvalidTokenError):
+                await AsyncTinkoffProfile('wrong').auth()
+        asyncio.run(self._run(monkeypatch, coroutine))
+
+
+class TestThrottling:
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert 0 < bucket.reserve() <= 0.1
+
+    def test_group_by_url(self):
+        assert RateLimits.group_by_url(TinkoffApiUrl.url('production', 'market', 'stocks')) == 'market'
+        assert RateLimits.group_by_url(TinkoffApiUrl.url('sandbox', 'portfolio')) == 'sandbox'
+        assert RateLimits.group_by_url(TinkoffApiUrl.url('production', 'operations')) == 'operations'
+
+    def test_retry_after(self):
+        policy = RetryPolicy(backoff_base=1, backoff_max=30)
+        assert policy.delay(0, '7') == 7
+        assert policy.delay(0, '100') == 30
+        assert 0 <= policy.delay(3) <= 8
+        assert not policy.should_retry(500, 0)
+        assert not policy.should_retry(429, policy.max_retries)
+
+    def test_retry(self, monkeypatch):
+        responses = [FakeResponse(429, headers={'Retry-After': '0'}), FakeResponse(503), FakeResponse(200)]
+        tp = TinkoffProfile('something')
+        tp.retry_policy = RetryPolicy(backoff_base=0)
+        monkeypatch.setattr(tp.transport, 'request', lambda *args, **kwargs: responses.pop(0))
+        assert tp.response_to_json(tp.request('GET', TinkoffApiUrl.url('production', 'portfolio'))) == \
+            {'status_code': 200}
+        assert not responses
+
+    def test_too_many_requests(self, monkeypatch):
+        tp = TinkoffProfile('something')
+        tp.retry_policy = RetryPolicy(max_retries=0)
+        monkeypatch.setattr(tp.transport, 'request', lambda *args, **kwargs: FakeResponse(429))
+        with pytest.raises(TooManyRequestsError):
+            tp.response_to_json(tp.request('GET', TinkoffApiUrl.url('production', 'portfolio')))
+
+
+class TestCatalogCache:
+    @pytest.fixture
+    def profile(self, tmp_path, monkeypatch):
+        tp = TinkoffProfile('something')
+        tp.is_production_token_valid = True
+        tp.catalog_cache = CatalogCache(str(tmp_path), ttl=60)
+        self.requests = []
+        self.responses = []
+
+        def request(method, url, headers=None, **kwargs):
+            self.requests.append(headers or {})
+            return self.responses.pop(0)
+        monkeypatch.setattr(tp.transport, 'request', request)
+        return tp
+
+    def test_fresh_entry(self, profile):
+        self.responses.append(FakeResponse(200, {'payload': 1}, {'ETag': '"v1"'}))
+        assert profile.market_stocks() == {'payload': 1}
+        assert profile.market_stocks() == {'payload': 1}
+        assert len(self.requests) == 1
+
+    def test_revalidation(self, profile):
+        self.responses.append(FakeResponse(200, {'payload': 1}, {'ETag': '"v1"'}))
+        profile.market_stocks()
+        profile.catalog_cache.ttl = 0
+        self.responses.append(FakeResponse(304))
+        assert profile.market_stocks() == {'payload': 1}
+        assert self.requests[-1]['If-None-Match'] == '"v1"'
+        self.responses.append(FakeResponse(200, {'payload': 2}, {'ETag': '"v2"'}))
+        assert profile.market_stocks() == {'payload': 2}
+        # Запись пережила "перезапуск": новый кэш в той же директории
+        assert CatalogCache(profile.catalog_cache.directory).get(
+            TinkoffApiUrl.url('production', 'market', 'stocks')).etag == '"v2"'
+
+    def test_search_by_figi(self, profile, monkeypatch):
+        urls = []
+        request = profile.transport.request
+
+        def request_with_url(method, url, headers=None, **kwargs):
+            urls.append(url)
+            return request(method, url, headers=headers, **kwargs)
+        monkeypatch.setattr(profile.transport, 'request', request_with_url)
+        self.responses.append(FakeResponse(200, {'payload': {'figi': 'BBG1'}}))
+        self.responses.append(FakeResponse(200, {'payload': {'figi': 'BBG2'}}))
+        assert profile.market_search_by_figi('BBG1')['payload']['figi'] == 'BBG1'
+        assert profile.market_search_by_figi('BBG1')['payload']['figi'] == 'BBG1'
+        assert profile.market_search_by_figi('BBG2')['payload']['figi'] == 'BBG2'
+        assert urls == [
+            TinkoffApiUrl.url('production', 'market', 'search', 'by-figi') + '?figi=BBG1',
+            TinkoffApiUrl.url('production', 'market', 'search', 'by-figi') + '?figi=BBG2'
+        ]
+
+
+class TestAuthCache:
+    def test_fingerprint(self):
+        cache = AuthCache(ttl=60)
+        cache.set('secret-token', AuthInfo([BrokerAccount('2000000000')], is_sandbox=False))
+        assert 'secret-token' not in repr(cache._entries)
+        assert cache.get('secret-token').broker_account_id == '2000000000'
+        assert cache.get('other-token') is None
+
+    def test_ttl(self):
+        cache = AuthCache(ttl=0)
+        cache.set('token', AuthInfo([BrokerAccount('2000000000')], is_sandbox=False))
+        assert cache.get('token') is None
+
+    def test_auth_from_cache(self, monkeypatch):
+        tp = TinkoffProfile('cached-token')
+        tp.auth_cache = AuthCache(ttl=60)
+        tp.auth_cache.set('cached-token', AuthInfo([BrokerAccount('SB000000')], is_sandbox=True))
+        monkeypatch.setattr(tp.transport, 'request', pytest.fail)
+        assert tp.auth() == 'sandbox'
+        assert tp.is_sandbox_token_valid and tp.broker_account_id == 'SB000000'
+
+    def test_invalidate_on_401(self):
+        tp = TinkoffProfile('cached-token')
+        tp.auth_cache = AuthCache(ttl=60)
+        tp.auth_cache.set('cached-token', AuthInfo([BrokerAccount('2000000000')], is_sandbox=False))
+        with pytest.raises(UnauthorizedError):
+            tp.check_status_code(401)
+        assert tp.auth_cache.get('cached-token') is None
+
+    def test_catalog_server_error_keeps_auth(self):
+        tp = TinkoffProfile('cached-token')
+        tp.auth_cache = AuthCache(ttl=60)
+        tp.auth_cache.set('cached-token', AuthInfo([BrokerAccount('2000000000')], is_sandbox=False))
+        with pytest.raises(UnknownError):
+            tp.check_status_code(500, catalog=True)
+        assert tp.auth_cache.get('cached-token') is not None
+
+
+class TestBrokerAccounts:
+    accounts = {'payload': {'accounts': [
+        {'brokerAccountType': 'Tinkoff', 'brokerAccountId': '2000000000'},
+        {'brokerAccountType': 'TinkoffIis', 'brokerAccountId': '2000000001'}
+    ]}}
+
+    def test_auth_keeps_all_accounts(self, monkeypatch):
+        tp = TinkoffProfile('multi-token')
+        tp.auth_cache = AuthCache(ttl=60)
+        monkeypatch.setattr(tp.transport, 'request', lambda *args, **kwargs: FakeResponse(200, self.accounts))
+        assert tp.auth() == 'production'
+        assert tp.broker_account_id == '2000000000'
+        assert [a.broker_account_type for a in tp.broker_accounts] == ['Tinkoff', 'TinkoffIis']
+        other = TinkoffProfile('multi-token')
+        other.auth_cache = tp.auth_cache
+        monkeypatch.setattr(other.transport, 'request', pytest.fail)
+        other.auth()
+        assert [a.broker_account_id for a in other.broker_accounts] == ['2000000000', '2000000001']
+
+
+class TestOperationsWindows:
+    to_datetime = dt.datetime(2020, 8, 20, tzinfo=dt.timezone.utc)
+
+    def test_split_date_range(self):
+        tp = TinkoffProfile('something')
+        from_datetime = self.to_datetime - dt.timedelta(days=25)
+        windows = tp.split_date_range(from_datetime, self.to_datetime, dt.timedelta(days=10))
+        assert windows == [
+            (self.to_datetime - dt.timedelta(days=10), self.to_datetime),
+            (self.to_datetime - dt.timedelta(days=20), self.to_datetime - dt.timedelta(days=10)),
+            (from_datetime, self.to_datetime - dt.timedelta(days=20)),
+        ]
+        tp.operations_window = None
+        assert tp.split_date_range(from_datetime, self.to_datetime) == [(from_datetime, self.to_datetime)]
+
+    def test_windowed_operations(self, monkeypatch):
+        tp = TinkoffProfile('something')
+        tp.is_production_token_valid = True
+
+        def request(method, url, params=None, **kwargs):
+            assert 'data' not in kwargs
+            window_to = dt.datetime.fromisoformat(params['to'])
+            days = (self.to_datetime - window_to).days
+            # Операция на границе окна попадает в оба окна
+            operations = [{'id': str(days)}, {'id': str(days + 10)}]
+            return FakeResponse(200, {'payload': {'operations': operations}})
+        monkeypatch.setattr(tp.transport, 'request', request)
+        response = tp.operations(self.to_datetime - dt.timedelta(days=30), self.to_datetime,
+                                 window=dt.timedelta(days=10))
+        assert [i['id'] for i in response['payload']['operations']] == ['0', '10', '20', '30']
+
+
+class TestMarketDataStream:
+    async def _run_stream(self):
+        connections = []
+
+        async def websocket(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            connections.append(request.headers['Authorization'])
+            subscribe = await ws.receive_json()
+            assert subscribe == {'event': 'candle:subscribe', 'figi': 'BBG000B9XRY4', 'interval': '1min'}
+            await ws.send_json({'event': 'candle', 'payload': {
+                'figi': 'BBG000B9XRY4', 'c': 100 + len(connections), 'time': f'2020-08-20T10:0{len(connections)}:00Z'
+            }})
+            if len(connections) == 1:
+                # Первое соединение обрывается, клиент должен переподключиться
+                await ws.close()
+            else:
+                await ws.receive()
+            return ws
+
+        app = web.Application()
+        app.router.add_get('/ws', websocket)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        stream = MarketDataStream('stream-token', ['BBG000B9XRY4'], url=str(server.make_url('/ws')))
+        stream.reconnect_delay_base = 0
+        task = asyncio.ensure_future(stream.run())
+        try:
+            for _ in range(100):
+                if stream.connections == 2 and stream.prices.get('BBG000B9XRY4').price == 102:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await stream.stop()
+            await asyncio.wait_for(task, timeout=1)
+            await server.close()
+        return stream, connections
+
+    def test_reconnect_and_last_price(self):
+        stream, connections = asyncio.run(self._run_stream())
+        assert connections == ['Bearer stream-token'] * 2
+        assert stream.prices.get('BBG000B9XRY4').price == Decimal(102)
+        assert len(stream.prices) == 1
+
+    def test_older_price_is_ignored(self):
+        prices = LastPriceTable()
+        prices.update('FIGI', Decimal(2), dt.datetime(2020, 8, 20, 10, 1, tzinfo=dt.timezone.utc))
+        prices.update('FIGI', Decimal(1), dt.datetime(2020, 8, 20, 10, 0, tzinfo=dt.timezone.utc))
+        assert prices.get('FIGI').price == Decimal(2)
+
+
+class TestOperationRecords:
+    operation = {
+        'id': '123', 'status': 'Done', 'operationType': 'Buy', 'date': '2020-08-18T12:41:37.12+03:00',
+        'isMarginCall': False, 'payment': Decimal('-100.5'), 'currency': 'USD', 'figi': 'BBG000B9XRY4',
+        'instrumentType': 'Stock', 'quantity': 2, 'commission': {'currency': 'USD', 'value': Decimal('-0.05')},
+        'trades': [{'tradeId': '1', 'date': '2020-08-18T12:41:37Z', 'quantity': 2, 'price': Decimal('50.25')}]
+    }
+
+    def test_parse_datetime(self):
+        assert parse_datetime('2020-08-18T12:41:37+03:00') == \
+            dt.datetime(2020, 8, 18, 12, 41, 37, tzinfo=dt.timezone(dt.timedelta(hours=3)))
+        assert parse_datetime('2020-08-18T09:41:37.1Z') == \
+            dt.datetime(2020, 8, 18, 9, 41, 37, 100000, tzinfo=dt.timezone.utc)
+
+    def test_from_json(self):
+        record = OperationRecord.from_json(self.operation)
+        assert not hasattr(record, '__dict__')
+        assert record.payment == Decimal('-100.5') and record.commission == Decimal('-0.05')
+        assert record.trades[0].price == Decimal('50.25')
+        assert record.date.utcoffset() == dt.timedelta(hours=3)
+        no_commission = OperationRecord.from_json({**self.operation, 'commission': None, 'trades': None})
+        assert no_commission.commission is None and no_commission.trades == []
+
+    def test_operations_records(self, monkeypatch):
+        tp = TinkoffProfile('something')
+        tp.is_production_token_valid = True
+        to_datetime = dt.datetime(2020, 8, 20, tzinfo=dt.timezone.utc)
+
+        def request(method, url, params=None, **kwargs):
+            days = (to_datetime - dt.datetime.fromisoformat(params['to'])).days
+            # От новых к старым, операция на границе окна попадает в оба окна
+            operations = [
+                {**self.operation, 'id': str(i), 'date': (to_datetime - dt.timedelta(days=i)).isoformat()}
+                for i in (days, days + 5, days + 10)
+            ]
+            return FakeResponse(200, {'payload': {'operations': operations}})
+        monkeypatch.setattr(tp.transport, 'request', request)
+        batches = list(tp.operations_records(
+            to_datetime - dt.timedelta(days=30), to_datetime, batch_size=4, window=dt.timedelta(days=10)
+        ))
+        assert [len(batch) for batch in batches] == [4, 3]
+        assert [i.id for batch in batches for i in batch] == ['30', '25', '20', '15', '10', '5', '0']
+
+
+class TestTransport:
+    def test_session_per_thread(self, monkeypatch):
+        class FakeSession:
+            def __init__(self):
+                self.thread = None
+                self.closed = False
+
+            def request(self, method, url, **kwargs):
+                # Сессией пользуется только поток, который ее получил
+                assert self.thread in (None, threading.current_thread())
+                self.thread = threading.current_thread()
+                params = kwargs.get('params') or {}
+                if 'to' in params:
+                    # Все три окна запрашиваются одновременно
+                    windows_barrier.wait()
+                return FakeResponse(200, {'payload': {'operations': [{'id': params.get('to')}]}})
+
+            def close(self):
+                self.closed = True
+
+        sessions = []
+        windows_barrier = threading.Barrier(3, timeout=5)
+
+        def session_factory():
+            sessions.append(FakeSession())
+            return sessions[-1]
+        tp = TinkoffProfile('something', transport=RequestsTransport(session_factory))
+        tp.is_production_token_valid = True
+        to_datetime = dt.datetime(2020, 8, 20, tzinfo=dt.timezone.utc)
+        tp.operations(to_datetime - dt.timedelta(days=30), to_datetime, window=dt.timedelta(days=10))
+        assert len(sessions) == 3
+        assert len({session.thread for session in sessions}) == len(sessions)
+        tp.portfolio()
+        # Сессии завершившихся потоков пула закрываются, когда поток создает новую сессию
+        assert all(session.closed for session in sessions[:-1]) and not sessions[-1].closed
+        tp.close()
+        assert all(session.closed for session in sessions)
+
+    def test_record_and_replay(self, tmp_path):
+        cassette = str(tmp_path / 'cassette.json')
+        url = TinkoffApiUrl.url('production', 'operations')
+        responses = [
+            FakeResponse(200, {'payload': {'operations': [], 'token': 'secret-token'}}),
+            FakeResponse(200, {'payload': {'operations': [{'id': '1'}]}})
+        ]
+        inner = Transport()
+        inner.request = lambda *args, **kwargs: responses.pop(0)
+        recording = RecordingTransport(cassette, inner, metadata={'to': '2'})
+        tp = TinkoffProfile('secret-token', transport=recording)
+        tp.request('GET', url, params={'from': '1', 'to': '2'})
+        tp.request('GET', url, params={'from': '0', 'to': '1'})
+        tp.close()
+        with open(cassette, encoding='utf-8') as file:
+            assert 'secret-token' not in file.read()
+
+        replay = ReplayTransport(cassette, latency=0.01)
+        assert replay.metadata == {'to': '2'}
+        tp = TinkoffProfile('other-token', transport=replay)
+        started = time.monotonic()
+        assert tp.request('GET', url, params={'to': '1', 'from': '0'}).json() == \
+            {'payload': {'operations': [{'id': '1'}]}}
+        assert tp.request('GET', url, params={'from': '1', 'to': '2'}).json()['payload']['token'] == '<TOKEN>'
+        assert time.monotonic() - started >= 0.02
+        with pytest.raises(InvalidArgumentError):
+            tp.request('GET', TinkoffApiUrl.url('production', 'portfolio'))
@@ -0,0 +1,76 @@
+import datetime
+import time
+
+from django.core.management import BaseCommand, CommandError, call_command
+from django.utils import timezone
+
+from tinkoff_api import RecordingTransport, ReplayTransport, TinkoffProfile
+from users.models import InvestmentAccount
+
+
+class Command(BaseCommand):
+    help = (
+        'Синхронизация ИС с записью ответов Tinkoff API в кассету (--record) или с их воспроизведением без сети. '
+        'В кассету сохраняется промежуток синхронизации, при воспроизведении запрашивается тот же промежуток. '
+        'Для замера полной синхронизации воспроизводите кассету первой синхронизации в пустую БД'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('cassette', help='Путь к кассете')
+        parser.add_argument(
+            '-a', '--account',
+            type=int,
+            required=True,
+            help='id ИС'
+        )
+        parser.add_argument(
+            '--record',
+            action='store_true',
+            default=False,
+            help='Синхронизировать через Tinkoff API и записать ответы в кассету'
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0,
+            help='Задержка каждого воспроизводимого ответа в секундах'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            investment_account = InvestmentAccount.objects.get(pk=options['account'])
+        except InvestmentAccount.DoesNotExist:
+            raise CommandError(f'ИС {options["account"]} не найден')
+        if options['record']:
+            to_datetime = timezone.now()
+            from_datetime = investment_account.sync_from_datetime().astimezone(to_datetime.tzinfo)
+            transport = RecordingTransport(options['cassette'], metadata={
+                'from': from_datetime.isoformat(), 'to': to_datetime.isoformat()
+            })
+        else:
+            try:
+                transport = ReplayTransport(options['cassette'], latency=options['latency'])
+            except FileNotFoundError:
+                raise CommandError(f'Кассета {options["cassette"]} не найдена')
+            if 'from' not in transport.metadata:
+                raise CommandError('В кассете нет промежутка синхронизации, запишите ее командой с --record')
+            # Updater работает с часовыми поясами pytz
+            from_datetime, to_datetime = (
+                datetime.datetime.fromisoformat(transport.metadata[key]).astimezone(timezone.utc)
+                for key in ('from', 'to')
+            )
+
+        tinkoff_profile = TinkoffProfile(investment_account.token, transport=transport)
+        # Ответы из кэшей не попадают в кассету, поэтому все запросы отправляются в транспорт
+        tinkoff_profile.auth_cache.invalidate(investment_account.token)
+        tinkoff_profile.catalog_cache = None
+        started_at = time.monotonic()
+        try:
+            investment_account.sync(from_datetime, to_datetime, tinkoff_profile=tinkoff_profile)
+        finally:
+            tinkoff_profile.close()
+        self.stdout.write(
+            f'Синхронизация {from_datetime.isoformat()} - {to_datetime.isoformat()}: '
+            f'{time.monotonic() - started_at:.2f} сек.'
+        )
+        call_command('sync_traces', account=investment_account.pk, limit=1, stdout=self.stdout)
@@ -0,0 +1,40 @@
+import os
+
+from django.core.management import BaseCommand, CommandError
+
+from users.services.sync_service import ParallelSync
+
+
+class Command(BaseCommand):
+    help = 'Синхронизация всех ИС, которые давно не синхронизировались, пулом процессов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p', '--processes',
+            type=int,
+            default=min(os.cpu_count() or 1, 8),
+            help='Количество процессов, у каждого не больше одного подключения к БД'
+        )
+        parser.add_argument(
+            '--rate-budget',
+            type=float,
+            default=1,
+            help='Доля лимитов запросов к Tinkoff API на все процессы вместе (1 - лимиты целиком)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1,
+            help='Сколько задач процесс забирает из очереди за раз'
+        )
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1:
+            raise CommandError('Количество процессов должно быть больше 0')
+        if not 0 < options['rate_budget'] <= 1:
+            raise CommandError('--rate-budget должен быть в промежутке (0, 1]')
+        report = ParallelSync(
+            options['processes'], rate_budget=options['rate_budget'], batch_size=options['batch_size']
+        ).run()
+        for line in report.lines():
+            self.stdout.write(line)
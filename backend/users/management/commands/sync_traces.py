@@ -0,0 +1,51 @@
+from django.core.management import BaseCommand, CommandError
+
+from users.models import SyncTrace, SyncTraceStage
+
+
+class Command(BaseCommand):
+    help = 'Трассировки синхронизаций ИС: время, запросы к БД и записанные строки по этапам'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-a', '--account',
+            type=int,
+            help='id ИС, по умолчанию - все ИС'
+        )
+        parser.add_argument(
+            '-n', '--limit',
+            type=int,
+            default=10,
+            help='Сколько последних трассировок показать'
+        )
+        parser.add_argument(
+            '-s', '--stage',
+            help='Показать только этот этап (для сравнения между синхронизациями)'
+        )
+
+    def handle(self, *args, **options):
+        traces = SyncTrace.objects.select_related('investment_account__creator')
+        if options['account'] is not None:
+            traces = traces.filter(investment_account_id=options['account'])
+        traces = list(traces.order_by('-started_at')[:options['limit']])
+        if not traces:
+            raise CommandError('Трассировок нет')
+        stages = SyncTraceStage.objects.filter(trace__in=traces).order_by('trace', 'position')
+        if options['stage']:
+            stages = stages.filter(name=options['stage'])
+        stages_by_trace = {}
+        for stage in stages:
+            stages_by_trace.setdefault(stage.trace_id, []).append(stage)
+
+        for trace in traces:
+            self.stdout.write(
+                f'{trace.started_at:%Y-%m-%d %H:%M:%S} {trace.investment_account}: {trace.wall_time:.2f} сек., '
+                f'операций {trace.operations_count}, запросов {trace.query_count}, строк {trace.rows_written}'
+            )
+            if trace.error:
+                self.stdout.write(self.style.ERROR(f'    Ошибка: {trace.error}'))
+            for stage in stages_by_trace.get(trace.pk, ()):
+                self.stdout.write(
+                    f'    {stage.name:<22} {stage.wall_time:>9.3f} сек. {stage.calls:>5} выз. '
+                    f'{stage.query_count:>7} запр. {stage.rows_written:>8} стр.'
+                )
@@ -0,0 +1,43 @@
+import logging
+
+from django.core.management import BaseCommand
+
+from users.services.sync_service import SyncWorker
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Фоновая синхронизация ИС с Tinkoff API (частота - PROJECT_OPERATIONS_UPDATE_FREQUENCY) '
+        'и пересчет дохода сделок после изменения долей'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Выполнить задачи, которые есть в очереди, и завершиться'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1,
+            help='Сколько задач забирается из очереди за раз'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5,
+            help='Пауза в секундах, если очередь пуста'
+        )
+
+    def handle(self, *args, **options):
+        worker = SyncWorker(batch_size=options['batch_size'], poll_interval=options['poll_interval'])
+        if options['once']:
+            processed = worker.run_once()
+            logger.info(f'Выполнено задач синхронизации: {processed}')
+            logger.info(f'Пересчитано сделок: {worker.recalculate_incomes()}')
+        else:
+            worker.run_forever()
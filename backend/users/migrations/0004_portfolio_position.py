@@ -0,0 +1,38 @@
+# Generated by Django 3.0.8 on 2026-10-18 16:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('operations', '0003_operation_co_owners'),
+        ('users', '0003_auto_20200819_1726'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioPosition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('figi', models.CharField(max_length=32, verbose_name='FIGI')),
+                ('instrument_type', models.CharField(max_length=32, verbose_name='Тип инструмента')),
+                ('balance', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Количество')),
+                ('lots', models.IntegerField(default=0, verbose_name='Количество лотов')),
+                ('average_position_price', models.DecimalField(decimal_places=4, max_digits=20, null=True, verbose_name='Средняя цена позиции')),
+                ('expected_yield', models.DecimalField(decimal_places=4, default=0, max_digits=20, verbose_name='Ожидаемая доходность')),
+                ('currency', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='portfolio_positions', to='operations.Currency', verbose_name='Валюта')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_positions', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Позиция портфеля',
+                'verbose_name_plural': 'Позиции портфеля',
+                'ordering': ('figi',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='portfolioposition',
+            constraint=models.UniqueConstraint(fields=('investment_account', 'figi'), name='unique_portfolio_position'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.8 on 2026-10-18 16:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_portfolio_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Выполнена'), ('failed', 'Ошибка')], db_index=True, default='pending', max_length=16, verbose_name='Статус')),
+                ('scheduled_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Запланирована на')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начало выполнения')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Окончание выполнения')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Количество запусков')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Задача синхронизации',
+                'verbose_name_plural': 'Задачи синхронизации',
+                'ordering': ('-scheduled_at',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='syncjob',
+            constraint=models.UniqueConstraint(condition=models.Q(status='pending'), fields=('investment_account',), name='unique_pending_sync_job'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 16:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_sync_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='investmentaccount',
+            name='operations_watermark',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последняя выполненная операция'),
+        ),
+    ]
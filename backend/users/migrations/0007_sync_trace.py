@@ -0,0 +1,50 @@
+# Generated by Django 3.0.8 on 2026-10-18 16:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_investmentaccount_operations_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncTrace',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(verbose_name='Начало')),
+                ('wall_time', models.FloatField(verbose_name='Время, сек.')),
+                ('query_count', models.PositiveIntegerField(verbose_name='Запросов к БД')),
+                ('rows_written', models.PositiveIntegerField(verbose_name='Записано строк')),
+                ('operations_count', models.PositiveIntegerField(default=0, verbose_name='Получено операций')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('investment_account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_traces', to='users.InvestmentAccount', verbose_name='Инвестиционный счет')),
+            ],
+            options={
+                'verbose_name': 'Трассировка синхронизации',
+                'verbose_name_plural': 'Трассировки синхронизаций',
+                'ordering': ('-started_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncTraceStage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(verbose_name='Порядок')),
+                ('name', models.CharField(max_length=64, verbose_name='Этап')),
+                ('calls', models.PositiveIntegerField(default=1, verbose_name='Количество вызовов')),
+                ('wall_time', models.FloatField(verbose_name='Время, сек.')),
+                ('query_count', models.PositiveIntegerField(verbose_name='Запросов к БД')),
+                ('rows_written', models.PositiveIntegerField(verbose_name='Записано строк')),
+                ('trace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='users.SyncTrace', verbose_name='Трассировка')),
+            ],
+            options={
+                'verbose_name': 'Этап синхронизации',
+                'verbose_name_plural': 'Этапы синхронизации',
+                'ordering': ('trace', 'position'),
+            },
+        ),
+    ]
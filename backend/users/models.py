@@ -1,14 +1,15 @@
 import collections
 import datetime
+import decimal
 import logging
 import os
-from typing import Dict
+from typing import Dict, List, Optional
 
 import pytz
 import requests
 from django.contrib.auth.models import AbstractUser, Group
-from django.db import models
-from django.db.models import Sum, Case, When, Q, F, ExpressionWrapper, Avg
+from django.db import models, transaction
+from django.db.models import Sum, Case, When, Q, F, ExpressionWrapper, Avg, Exists, OuterRef, Min
 from django.db.models.functions import Coalesce
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -18,7 +19,9 @@ from core.utils import ProxyQ
 from market.models import Deal, DealIncome, CurrencyInstrument
 from operations.models import PurchaseOperation, SaleOperation, PayOperation, ServiceCommissionOperation, \
     DividendOperation, Currency, Operation, Share
+from tinkoff_api import LastPrice, TinkoffProfile
 from tinkoff_api.exceptions import InvalidTokenError
+from users.services.sync_trace import SyncTracer
 from users.services.update_service import Updater
 
 logger = logging.getLogger(__name__)
@@ -58,9 +61,14 @@ class InvestmentAccount(models.Model):
         verbose_name='Время последней синхронизации',
         default=datetime.datetime(1990, 1, 1, tzinfo=pytz.timezone('UTC'))
     )
+    # Дата последней выполненной операции, полученной при синхронизации
+    operations_watermark = models.DateTimeField(verbose_name='Последняя выполненная операция', null=True, blank=True)
     investors = models.ManyToManyField(Investor, through='CoOwner')
     currencies = models.ManyToManyField('operations.Currency', through='CurrencyAsset')
 
+    # Операции, которые Tinkoff API может вернуть с опозданием, запрашиваются с таким запасом
+    watermark_overlap = datetime.timedelta(hours=6)
+
     @property
     def prop_total_income(self):
         """ Расчет дохода инвестиционного счета """
@@ -138,32 +146,94 @@ class InvestmentAccount(models.Model):
                     capital_info[capital['currency']]['total_capital'] - capital['distributed_capital']
         return dict(capital_info)
 
+    @staticmethod
+    def update_frequency() -> datetime.timedelta:
+        """ Как часто синхронизировать портфель (PROJECT_OPERATIONS_UPDATE_FREQUENCY, в минутах) """
+        return datetime.timedelta(minutes=float(os.getenv('PROJECT_OPERATIONS_UPDATE_FREQUENCY', 1)))
+
+    def sync_from_datetime(self) -> datetime.datetime:
+        """ С какой даты запрашивать операции при синхронизации.
+            От последней выполненной операции (с запасом watermark_overlap),
+            но не позже самой ранней операции, которая была в процессе выполнения
+        """
+        if self.operations_watermark is None:
+            return self.sync_at - self.watermark_overlap
+        from_datetime = self.operations_watermark - self.watermark_overlap
+        earliest_pending = self.pending_operations.aggregate(d=Min('date'))['d']
+        if earliest_pending is not None:
+            from_datetime = min(from_datetime, earliest_pending)
+        return from_datetime
+
     def update_portfolio(self, now=None):
         """ Обновление всего портфеля.
-            Включает в себя обновление операций, сделок, валютных активов
+            Включает в себя обновление операций, сделок, валютных активов.
+            Ошибки (в т.ч. невалидный токен и сбой подключения к Tinkoff API) пробрасываются,
+            чтобы задача синхронизации завершилась с ошибкой
         :param now: Текущий момент времени, до которого будут обновляться операции
         """
         logger.info(f'Обновление портфеля "{self}"')
         if now is None:
             now = timezone.now()
-        update_frequency = datetime.timedelta(minutes=float(os.getenv('PROJECT_OPERATIONS_UPDATE_FREQUENCY', 1)))
+        update_frequency = self.update_frequency()
         try:
             if now - self.sync_at > update_frequency:
-                from_datetime = self.sync_at - datetime.timedelta(hours=6)
-                to_datetime = now
-                updater = Updater(from_datetime, to_datetime, self.id, token=self.token)
-                updater.update_currency_assets()
-                updater.update_operations()
-                updater.update_deals()
-                self.sync_at = to_datetime
-                self.save()
+                self.sync(self.sync_from_datetime().astimezone(now.tzinfo), now)
                 logger.info('Обновление портфеля завершено')
             else:
                 logger.info('Портфель обновлялся недавно')
         except InvalidTokenError:
             logger.warning('Обновление портфеля не удалось, токен невалидный')
+            raise
         except requests.exceptions.ConnectionError:
             logger.warning('Обновление портфеля не удалось, сбой при подключении к Tinkoff API')
+            raise
+
+    def sync(self, from_datetime: datetime.datetime, to_datetime: datetime.datetime,
+             tinkoff_profile: Optional[TinkoffProfile] = None):
+        """ Синхронизация с Tinkoff API за промежуток: валютные активы, позиции портфеля, операции, сделки
+        :param from_datetime: с какой даты получать операции
+        :param to_datetime: до какой даты получать операции, становится датой синхронизации
+        :param tinkoff_profile: профиль Tinkoff API (например, с воспроизведением ответов из кассеты),
+            если None - создается по токену ИС
+        """
+        # До первой синхронизации sync_at - значение по умолчанию
+        is_first_sync = self.sync_at == self._meta.get_field('sync_at').default
+        tracer = SyncTracer()
+        try:
+            with tracer.stage('auth'):
+                updater = Updater(
+                    from_datetime, to_datetime, self.id,
+                    token=self.token if tinkoff_profile is None else None, tinkoff_profile=tinkoff_profile,
+                    broker_account_id=self.broker_account_id, watermark=self.operations_watermark,
+                    tracer=tracer
+                )
+            updater.update_currency_assets()
+            updater.update_portfolio_positions()
+            updater.update_operations()
+            updater.update_deals()
+        except Exception as e:
+            tracer.error = repr(e)
+            raise
+        finally:
+            tracer.save(self.id)
+        self.sync_at = to_datetime
+        self.operations_watermark = updater.watermark
+        self.save(update_fields=('sync_at', 'operations_watermark'))
+        if is_first_sync:
+            self.init_creator_capital()
+
+    def init_creator_capital(self):
+        """ Весь капитал ИС по каждой валюте отдается создателю ИС (после первой синхронизации) """
+        total_capital = self.capital_info()
+        bulk_updates = []
+        for capital in Capital.objects.filter(
+                co_owner__investment_account=self, co_owner__investor_id=self.creator_id
+        ).select_related('currency'):
+            iso_code = capital.currency.iso_code
+            if iso_code in total_capital:
+                capital.value = total_capital[iso_code]['total_capital']
+                bulk_updates.append(capital)
+        Capital.objects.bulk_update(bulk_updates, fields=('value', ))
 
     def __str__(self):
         return f'{self.name} ({self.creator})'
@@ -254,6 +324,241 @@ class CurrencyAsset(models.Model):
         return f'{self.investment_account}::{self.currency}: {self.value}'
 
 
+class PortfolioPositionQuerySet(models.QuerySet):
+    def by_figi(self) -> Dict[str, 'PortfolioPosition']:
+        """ Позиции портфеля, доступные по FIGI за O(1) """
+        return {position.figi: position for position in self}
+
+    def capital_by_currency(self) -> Dict[str, Dict[str, decimal.Decimal]]:
+        """ Стоимость позиций по средней цене и ожидаемая доходность отдельно по каждой валюте
+            (суммы в разных валютах не складываются)
+        """
+        capital = {}
+        for row in (
+            self.exclude(currency=None).values('currency').order_by()
+            .annotate(
+                price=Sum(ExpressionWrapper(
+                    F('average_position_price') * F('balance'), output_field=models.DecimalField()
+                )),
+                expected_yield=Sum('expected_yield')
+            )
+        ):
+            capital[row['currency']] = {'price': row['price'] or 0, 'expected_yield': row['expected_yield']}
+        return capital
+
+
+class PortfolioPosition(models.Model):
+    """ Позиция портфеля (снимок portfolio Tinkoff API на момент последней синхронизации) """
+    class Meta:
+        verbose_name = 'Позиция портфеля'
+        verbose_name_plural = 'Позиции портфеля'
+        ordering = ('figi', )
+        constraints = [
+            models.UniqueConstraint(fields=('investment_account', 'figi'), name='unique_portfolio_position')
+        ]
+
+    objects = PortfolioPositionQuerySet.as_manager()
+
+    investment_account = models.ForeignKey(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE,
+        related_name='portfolio_positions'
+    )
+    figi = models.CharField(verbose_name='FIGI', max_length=32)
+    instrument_type = models.CharField(verbose_name='Тип инструмента', max_length=32)
+    balance = models.DecimalField(verbose_name='Количество', max_digits=20, decimal_places=4, default=0)
+    lots = models.IntegerField(verbose_name='Количество лотов', default=0)
+    average_position_price = models.DecimalField(
+        verbose_name='Средняя цена позиции', max_digits=20, decimal_places=4, null=True
+    )
+    expected_yield = models.DecimalField(verbose_name='Ожидаемая доходность', max_digits=20, decimal_places=4, default=0)
+    currency = models.ForeignKey(
+        'operations.Currency', verbose_name='Валюта', on_delete=models.PROTECT, null=True,
+        related_name='portfolio_positions'
+    )
+
+    @property
+    def price(self) -> Optional[decimal.Decimal]:
+        """ Стоимость позиции по средней цене """
+        if self.average_position_price is None:
+            return None
+        return self.average_position_price * self.balance
+
+    @property
+    def expected_percent_profit(self) -> decimal.Decimal:
+        """ Ожидаемая доходность позиции в процентах """
+        price = self.price
+        if not price:
+            return decimal.Decimal(0)
+        return self.expected_yield / price * 100
+
+    def live_expected_yield(self, last_price: Optional[LastPrice]) -> decimal.Decimal:
+        """ Ожидаемая доходность по последней цене из streaming API,
+            если цены нет - по снимку портфеля
+        """
+        if last_price is None or self.average_position_price is None:
+            return self.expected_yield
+        return round((last_price.price - self.average_position_price) * self.balance, 4)
+
+    def live_expected_percent_profit(self, last_price: Optional[LastPrice]) -> decimal.Decimal:
+        """ Ожидаемая доходность в процентах по последней цене из streaming API """
+        price = self.price
+        if not price:
+            return decimal.Decimal(0)
+        return self.live_expected_yield(last_price) / price * 100
+
+    def __str__(self):
+        return f'{self.investment_account}::{self.figi}: {self.balance}'
+
+
+class SyncJobQuerySet(models.QuerySet):
+    def active(self):
+        """ Задачи, которые ждут выполнения или выполняются """
+        return self.filter(status__in=(SyncJob.Status.PENDING, SyncJob.Status.RUNNING))
+
+    def enqueue_due(self, now: datetime.datetime) -> int:
+        """ Ставит в очередь синхронизацию ИС, которые не синхронизировались дольше update_frequency.
+            ИС, у которых уже есть активная задача или задача, завершенная недавно (в т.ч. с ошибкой),
+            пропускаются
+        :return: количество новых задач
+        """
+        due_since = now - InvestmentAccount.update_frequency()
+        jobs = self.model.objects.filter(investment_account=OuterRef('pk'))
+        accounts = (
+            InvestmentAccount.objects
+            .filter(sync_at__lt=due_since)
+            .annotate(
+                has_active_job=Exists(jobs.active()),
+                has_recent_job=Exists(jobs.filter(finished_at__gte=due_since))
+            )
+            .filter(has_active_job=False, has_recent_job=False)
+            .values_list('pk', flat=True)
+        )
+        investment_account_ids = list(accounts)
+        self.bulk_create(
+            [self.model(investment_account_id=pk, scheduled_at=now) for pk in investment_account_ids],
+            ignore_conflicts=True
+        )
+        # bulk_create с ignore_conflicts возвращает все объекты, даже не записанные из-за конфликта
+        # (задачу уже поставил другой планировщик), поэтому считаем записанные задачи
+        return self.filter(
+            investment_account_id__in=investment_account_ids, status=SyncJob.Status.PENDING, scheduled_at=now
+        ).count()
+
+    def claim(self, now: datetime.datetime, limit: int = 1) -> List['SyncJob']:
+        """ Забирает задачи из очереди. Строки блокируются с skip_locked,
+            поэтому несколько воркеров не получат одну и ту же задачу
+        """
+        with transaction.atomic():
+            jobs = list(
+                self.select_for_update(skip_locked=True)
+                .filter(status=SyncJob.Status.PENDING, scheduled_at__lte=now)
+                .order_by('scheduled_at')[:limit]
+            )
+            self.filter(pk__in=[job.pk for job in jobs]).update(
+                status=SyncJob.Status.RUNNING, started_at=now, attempts=F('attempts') + 1
+            )
+        return jobs
+
+    def release_stale(self, now: datetime.datetime, timeout: datetime.timedelta) -> int:
+        """ Возвращает в очередь задачи, воркер которых завис или был остановлен """
+        return self.filter(status=SyncJob.Status.RUNNING, started_at__lt=now - timeout).update(
+            status=SyncJob.Status.PENDING, scheduled_at=now
+        )
+
+
+class SyncJob(models.Model):
+    """ Задача фоновой синхронизации ИС (очередь для sync_worker) """
+    class Meta:
+        verbose_name = 'Задача синхронизации'
+        verbose_name_plural = 'Задачи синхронизации'
+        ordering = ('-scheduled_at', )
+        constraints = [
+            # У ИС может быть только одна задача в очереди
+            models.UniqueConstraint(
+                fields=('investment_account', ), condition=Q(status='pending'), name='unique_pending_sync_job'
+            )
+        ]
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'В очереди'
+        RUNNING = 'running', 'Выполняется'
+        DONE = 'done', 'Выполнена'
+        FAILED = 'failed', 'Ошибка'
+
+    objects = SyncJobQuerySet.as_manager()
+
+    investment_account = models.ForeignKey(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE, related_name='sync_jobs'
+    )
+    status = models.CharField(
+        verbose_name='Статус', max_length=16, choices=Status.choices, default=Status.PENDING, db_index=True
+    )
+    scheduled_at = models.DateTimeField(verbose_name='Запланирована на', default=timezone.now, db_index=True)
+    started_at = models.DateTimeField(verbose_name='Начало выполнения', null=True, blank=True)
+    finished_at = models.DateTimeField(verbose_name='Окончание выполнения', null=True, blank=True)
+    attempts = models.PositiveIntegerField(verbose_name='Количество запусков', default=0)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+
+    def __str__(self):
+        return f'{self.investment_account}::{self.status}: {self.scheduled_at}'
+
+
+class SyncTraceQuerySet(models.QuerySet):
+    def trim(self, investment_account_id: int, keep: int) -> int:
+        """ Удаляет старые трассировки ИС, остается keep последних """
+        keep_ids = (
+            self.filter(investment_account_id=investment_account_id)
+            .order_by('-started_at').values_list('pk', flat=True)[:keep]
+        )
+        deleted, _ = self.filter(investment_account_id=investment_account_id).exclude(pk__in=list(keep_ids)).delete()
+        return deleted
+
+
+class SyncTrace(models.Model):
+    """ Трассировка одной синхронизации ИС (update_portfolio) """
+    class Meta:
+        verbose_name = 'Трассировка синхронизации'
+        verbose_name_plural = 'Трассировки синхронизаций'
+        ordering = ('-started_at', )
+
+    # Сколько последних трассировок хранится для каждого ИС
+    keep_per_account = 50
+
+    objects = SyncTraceQuerySet.as_manager()
+
+    investment_account = models.ForeignKey(
+        InvestmentAccount, verbose_name='Инвестиционный счет', on_delete=models.CASCADE, related_name='sync_traces'
+    )
+    started_at = models.DateTimeField(verbose_name='Начало')
+    wall_time = models.FloatField(verbose_name='Время, сек.')
+    query_count = models.PositiveIntegerField(verbose_name='Запросов к БД')
+    rows_written = models.PositiveIntegerField(verbose_name='Записано строк')
+    operations_count = models.PositiveIntegerField(verbose_name='Получено операций', default=0)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+
+    def __str__(self):
+        return f'{self.investment_account}: {self.started_at} ({self.wall_time:.2f} сек.)'
+
+
+class SyncTraceStage(models.Model):
+    """ Этап синхронизации: время, количество запросов к БД и записанных строк """
+    class Meta:
+        verbose_name = 'Этап синхронизации'
+        verbose_name_plural = 'Этапы синхронизации'
+        ordering = ('trace', 'position')
+
+    trace = models.ForeignKey(SyncTrace, verbose_name='Трассировка', on_delete=models.CASCADE, related_name='stages')
+    position = models.PositiveSmallIntegerField(verbose_name='Порядок')
+    name = models.CharField(verbose_name='Этап', max_length=64)
+    calls = models.PositiveIntegerField(verbose_name='Количество вызовов', default=1)
+    wall_time = models.FloatField(verbose_name='Время, сек.')
+    query_count = models.PositiveIntegerField(verbose_name='Запросов к БД')
+    rows_written = models.PositiveIntegerField(verbose_name='Записано строк')
+
+    def __str__(self):
+        return f'{self.name}: {self.wall_time:.2f} сек.'
+
+
 @receiver(post_save, sender=InvestmentAccount)
 def investment_account_post_save(**kwargs):
     if kwargs.get('created'):
@@ -266,19 +571,11 @@ def investment_account_post_save(**kwargs):
         creator.save(update_fields=('default_investment_account', ))
 
         # Создатель счета становится одним из совладельцев счета
-        co_owner = CoOwner.objects.create(investor=creator, investment_account=instance)
+        CoOwner.objects.create(investor=creator, investment_account=instance)
 
-        # Загружаем все операции из Тинькофф
-        instance.update_portfolio()
-        total_capital = instance.capital_info()
-        co_owner_capital = co_owner.capital.select_related('currency').all()
-        bulk_updates = []
-        for co_owner_capital_item in co_owner_capital:
-            iso_code = co_owner_capital_item.currency.iso_code
-            if iso_code in total_capital:
-                bulk_updates.append(co_owner_capital_item)
-                bulk_updates[-1].value = total_capital[iso_code]['total_capital']
-        Capital.objects.bulk_update(bulk_updates, fields=('value', ))
+        # Операции из Тинькофф загрузит воркер синхронизации, запрос к брокеру в обработчике запроса не делается.
+        # После первой синхронизации капитал ИС отдается создателю (InvestmentAccount.init_creator_capital)
+        SyncJob.objects.create(investment_account=instance)
 
 
 @receiver(post_save, sender=CoOwner)
@@ -0,0 +1,185 @@
+""" Распределение операций по сделкам в памяти.
+    Открытые сделки, даты открытия всех сделок и доли совладельцев по умолчанию
+    загружаются один раз, операции распределяются за один проход,
+    запись в БД - пачками (bulk_create/bulk_update)
+"""
+import bisect
+import collections
+import datetime as dt
+import logging
+from decimal import Decimal
+from typing import Dict, List, Optional, Set, Tuple
+
+from django.db import connection
+from django.db.models import Min
+
+from core.bulk_copy import copy_create
+from core.utils import is_proxy_instance
+from market.models import Deal
+from operations.models import Operation, PurchaseOperation, SaleOperation, DividendOperation, Share
+
+logger = logging.getLogger(__name__)
+
+
+class DealState:
+    """ Сделка и количество купленных/проданных по ней бумаг """
+    __slots__ = ('deal', 'opened_date', 'bought_quantity', 'sold_quantity')
+
+    def __init__(self, deal: Deal, opened_date: Optional[dt.datetime], bought_quantity: int = 0,
+                 sold_quantity: int = 0):
+        self.deal = deal
+        self.opened_date = opened_date
+        self.bought_quantity = bought_quantity
+        self.sold_quantity = sold_quantity
+
+    @property
+    def is_opened(self) -> bool:
+        """ То же условие, что и DealQuerySet.opened() """
+        return (
+            self.sold_quantity != self.bought_quantity or self.bought_quantity == 0 or self.sold_quantity == 0
+        )
+
+
+class DealAssembler:
+    """ Привязывает новые операции ИС к сделкам и создает доли совладельцев в операциях """
+    # Размер пачки для bulk_update операций
+    bulk_update_batch_size = 1000
+
+    def __init__(self, investment_account_id: int, co_owner_ids: List[int],
+                 default_shares: Dict[Tuple[int, str], Decimal]):
+        """
+        :param investment_account_id: id ИС
+        :param co_owner_ids: id совладельцев ИС
+        :param default_shares: доли по умолчанию, ключ - (id совладельца, валюта)
+        """
+        self.investment_account_id = investment_account_id
+        self.co_owner_ids = co_owner_ids
+        self.default_shares = default_shares
+        # Открытая сделка по FIGI
+        self.opened_deals: Dict[str, DealState] = {}
+        # Сделки с операциями по FIGI (для дивидендов), отсортированы по дате открытия
+        self.deals_by_instrument: Dict[str, List[DealState]] = collections.defaultdict(list)
+        # Даты открытия сделок self.deals_by_instrument, по ним ищется сделка для дивидендов
+        self.opened_dates_by_instrument: Dict[str, List[dt.datetime]] = collections.defaultdict(list)
+        self.new_deals: List[DealState] = []
+        self.touched_deals: Set[DealState] = set()
+        # id привязанных операций по id сделки (заполняется в assemble)
+        self.operation_ids_by_deal: Dict[int, List[int]] = collections.defaultdict(list)
+
+    @classmethod
+    def for_investment_account(cls, investment_account) -> 'DealAssembler':
+        co_owners = list(investment_account.co_owners.prefetch_related('capital'))
+        default_shares = {
+            (co_owner.pk, capital.currency_id): capital.default_share
+            for co_owner in co_owners for capital in co_owner.capital.all()
+        }
+        assembler = cls(investment_account.pk, [co_owner.pk for co_owner in co_owners], default_shares)
+        assembler.load_deals()
+        return assembler
+
+    def load_deals(self) -> None:
+        deals = (
+            Deal.objects
+            .filter(investment_account_id=self.investment_account_id)
+            ._with_quantity_annotation_by_operation_type()
+            .annotate(opened_date=Min('operations__date'))
+            .order_by('pk')
+        )
+        for deal in deals:
+            state = DealState(deal, deal.opened_date, deal.bought_quantity, deal.sold_quantity)
+            if state.opened_date is not None:
+                self.index_deal(deal.instrument_id, state)
+            if state.is_opened:
+                self.opened_deals[deal.instrument_id] = state
+
+    def index_deal(self, instrument_id: str, state: DealState) -> None:
+        """ Добавляет сделку в self.deals_by_instrument с сохранением сортировки по дате открытия
+            (после сделок, открытых в ту же дату)
+        """
+        opened_dates = self.opened_dates_by_instrument[instrument_id]
+        index = bisect.bisect_right(opened_dates, state.opened_date)
+        opened_dates.insert(index, state.opened_date)
+        self.deals_by_instrument[instrument_id].insert(index, state)
+
+    def unindex_deal(self, instrument_id: str, state: DealState) -> None:
+        index = self.deals_by_instrument[instrument_id].index(state)
+        del self.opened_dates_by_instrument[instrument_id][index]
+        del self.deals_by_instrument[instrument_id][index]
+
+    def deal_for_trade(self, operation: Operation) -> DealState:
+        """ Открытая сделка по инструменту операции, если ее нет - новая """
+        state = self.opened_deals.get(operation.instrument_id)
+        if state is None:
+            logger.debug(f'Новая сделка по {operation.instrument_id}')
+            state = DealState(
+                Deal(instrument_id=operation.instrument_id, investment_account_id=self.investment_account_id),
+                opened_date=operation.date
+            )
+            self.new_deals.append(state)
+            self.opened_deals[operation.instrument_id] = state
+            self.index_deal(operation.instrument_id, state)
+        if is_proxy_instance(operation, PurchaseOperation):
+            state.bought_quantity += operation.quantity
+        else:
+            state.sold_quantity += operation.quantity
+        if state.opened_date is None or operation.date < state.opened_date:
+            # Операция раньше открытия сделки (или первая операция сделки без операций) - сделка меняет место
+            if state.opened_date is not None:
+                self.unindex_deal(operation.instrument_id, state)
+            state.opened_date = operation.date
+            self.index_deal(operation.instrument_id, state)
+        if not state.is_opened:
+            del self.opened_deals[operation.instrument_id]
+        return state
+
+    def deal_for_dividend(self, operation: Operation) -> Optional[DealState]:
+        """ Последняя сделка по инструменту, открытая не позже получения дивидендов """
+        opened_dates = self.opened_dates_by_instrument.get(operation.instrument_id, ())
+        index = bisect.bisect_right(opened_dates, operation.date) - 1
+        return self.deals_by_instrument[operation.instrument_id][index] if index >= 0 else None
+
+    def assemble(self, operations: List[Operation]) -> List[Deal]:
+        """ Распределяет операции (отсортированные по дате) по сделкам
+        :return: сделки, у которых изменился состав операций
+        """
+        deal_states: List[Tuple[Operation, DealState]] = []
+        for operation in operations:
+            if is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
+                state = self.deal_for_trade(operation)
+            elif is_proxy_instance(operation, DividendOperation):
+                state = self.deal_for_dividend(operation)
+                if state is None:
+                    logger.warning(f'Не найдена сделка для дивидендов {operation}')
+                    continue
+            else:
+                continue
+            deal_states.append((operation, state))
+            self.touched_deals.add(state)
+        # Доли создаются только у операций, попавших в сделку
+        shares = [
+            Share(
+                operation=operation, co_owner_id=co_owner_id,
+                value=self.default_shares[(co_owner_id, operation.currency_id)]
+            )
+            for operation, state in deal_states for co_owner_id in self.co_owner_ids
+        ]
+
+        self.save_new_deals()
+        for operation, state in deal_states:
+            operation.deal = state.deal
+            self.operation_ids_by_deal[state.deal.pk].append(operation.pk)
+        Operation.objects.bulk_update(
+            [operation for operation, state in deal_states], fields=('deal', ), batch_size=self.bulk_update_batch_size
+        )
+        copy_create(Share, shares)
+        logger.info(f'Операций привязано к сделкам: {len(deal_states)}, новых сделок: {len(self.new_deals)}')
+        return [state.deal for state in self.touched_deals]
+
+    def save_new_deals(self) -> None:
+        """ Новые сделки создаются одним запросом, если БД возвращает id из bulk_create (PostgreSQL) """
+        deals = [state.deal for state in self.new_deals if state.deal.pk is None]
+        if connection.features.can_return_rows_from_bulk_insert:
+            Deal.objects.bulk_create(deals)
+        else:
+            for deal in deals:
+                deal.save()
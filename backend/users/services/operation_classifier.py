@@ -0,0 +1,72 @@
+""" Классификация операций Tinkoff API по этапам обработки Updater.
+    Каждая операция за один проход попадает ровно в одну корзину,
+    поэтому время классификации линейно зависит от количества операций
+"""
+from typing import Iterable, List
+
+from operations.models_constraints import OperationTypes, OperationStatuses
+from tinkoff_api._records import OperationRecord
+
+# Операции, которым достаточно общих полей (дата, сумма, валюта, инструмент)
+SIMPLE_OPERATION_TYPES = frozenset((
+    OperationTypes.PAY_IN, OperationTypes.PAY_OUT, OperationTypes.DIVIDEND,
+    OperationTypes.SERVICE_COMMISSION, OperationTypes.MARGIN_COMMISSION,
+    OperationTypes.TAX, OperationTypes.TAX_BACK
+))
+# Операции покупки, покупки с карты и продажи, у них есть транзакции
+TRADE_OPERATION_TYPES = frozenset((OperationTypes.BUY, OperationTypes.BUY_CARD, OperationTypes.SELL))
+# Операции, которые не записываются (комиссия брокера учитывается в самих сделках)
+IGNORED_OPERATION_TYPES = frozenset((OperationTypes.BROKER_COMMISSION, ))
+
+
+class OperationBuckets:
+    """ Операции, разложенные по этапам обработки """
+    __slots__ = ('primary', 'trades', 'dividend_taxes', 'pending', 'ignored', 'unprocessed')
+
+    def __init__(self):
+        # Первичные операции, записываются первыми (включая покупки/продажи)
+        self.primary: List[OperationRecord] = []
+        # Покупки/продажи, транзакции которых записываются после первичных операций
+        self.trades: List[OperationRecord] = []
+        # Налоги на дивиденды, дополняют уже записанные дивиденды
+        self.dividend_taxes: List[OperationRecord] = []
+        # Операции в процессе выполнения, записываются после того, как будут выполнены
+        self.pending: List[OperationRecord] = []
+        # Отклоненные операции и операции, которые не записываются
+        self.ignored: List[OperationRecord] = []
+        # Операции, которые не обрабатывает ни один этап
+        self.unprocessed: List[OperationRecord] = []
+
+    def __len__(self):
+        return (
+            len(self.primary) + len(self.dividend_taxes) + len(self.pending) + len(self.ignored) +
+            len(self.unprocessed)
+        )
+
+    def __repr__(self):
+        return (
+            f'<OperationBuckets primary={len(self.primary)} trades={len(self.trades)} '
+            f'dividend_taxes={len(self.dividend_taxes)} pending={len(self.pending)} ignored={len(self.ignored)} '
+            f'unprocessed={len(self.unprocessed)}>'
+        )
+
+
+def classify_operations(operations: Iterable[OperationRecord]) -> OperationBuckets:
+    """ Раскладывает операции по корзинам, порядок операций внутри корзины сохраняется """
+    buckets = OperationBuckets()
+    for operation in operations:
+        operation_type = operation.operation_type
+        if operation.status == OperationStatuses.PROGRESS:
+            buckets.pending.append(operation)
+        elif operation.status != OperationStatuses.DONE or operation_type in IGNORED_OPERATION_TYPES:
+            buckets.ignored.append(operation)
+        elif operation_type in SIMPLE_OPERATION_TYPES:
+            buckets.primary.append(operation)
+        elif operation_type in TRADE_OPERATION_TYPES:
+            buckets.primary.append(operation)
+            buckets.trades.append(operation)
+        elif operation_type == OperationTypes.TAX_DIVIDEND:
+            buckets.dividend_taxes.append(operation)
+        else:
+            buckets.unprocessed.append(operation)
+    return buckets
@@ -0,0 +1,190 @@
+""" Фоновая синхронизация ИС.
+    Планировщик ставит в очередь (SyncJob) ИС, которые давно не синхронизировались,
+    воркер забирает задачи из очереди и обновляет портфель вне запросов пользователей.
+    Тот же воркер пересчитывает доход сделок, у которых изменились доли (Deal.income_outdated_at)
+"""
+import datetime as dt
+import logging
+import multiprocessing
+import time
+from typing import Dict, List, Optional
+
+import django
+from django.apps import apps
+from django.db import close_old_connections, connection, connections
+from django.utils import timezone
+
+from tinkoff_api import RateLimits
+
+logger = logging.getLogger(__name__)
+
+
+class SyncWorker:
+    """ Планировщик и исполнитель задач синхронизации """
+
+    def __init__(self, batch_size: int = 1, poll_interval: float = 5,
+                 stale_timeout: dt.timedelta = dt.timedelta(minutes=30)):
+        """
+        :param batch_size: сколько задач забирается из очереди за раз
+        :param poll_interval: пауза в секундах, если очередь пуста
+        :param stale_timeout: через сколько выполняющаяся задача считается зависшей
+        """
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.sync_job_model = apps.get_model('users', 'SyncJob')
+
+    def schedule(self, now: Optional[dt.datetime] = None) -> int:
+        """ Ставит в очередь ИС, которым пора синхронизироваться """
+        now = now or timezone.now()
+        released = self.sync_job_model.objects.release_stale(now, self.stale_timeout)
+        if released:
+            logger.warning(f'Возвращено в очередь зависших задач синхронизации: {released}')
+        return self.sync_job_model.objects.enqueue_due(now)
+
+    def run_job(self, job: 'SyncJob') -> None:
+        """ Синхронизация одного ИС, ошибка записывается в задачу и не останавливает воркер """
+        logger.info(f'Синхронизация ИС {job.investment_account_id}')
+        try:
+            job.investment_account.update_portfolio()
+        except Exception as e:
+            logger.exception(f'Синхронизация ИС {job.investment_account_id} не удалась')
+            job.status = self.sync_job_model.Status.FAILED
+            job.error = repr(e)
+        else:
+            job.status = self.sync_job_model.Status.DONE
+            job.error = ''
+        job.finished_at = timezone.now()
+        job.save(update_fields=('status', 'error', 'finished_at'))
+
+    def drain(self) -> List[int]:
+        """ Выполнение задач, пока очередь не опустеет
+        :return: id выполненных задач
+        """
+        processed = []
+        while True:
+            jobs = self.sync_job_model.objects.claim(timezone.now(), self.batch_size)
+            if not jobs:
+                return processed
+            for job in jobs:
+                self.run_job(job)
+                processed.append(job.pk)
+
+    def recalculate_incomes(self) -> int:
+        """ Пересчет дохода сделок, доли которых не менялись дольше Deal.income_recalculation_delay().
+            Ошибка (например, сбой БД) записывается в лог и не останавливает воркер
+        :return: количество пересчитанных сделок
+        """
+        deal_model = apps.get_model('market', 'Deal')
+        try:
+            return deal_model.objects.recalculate_outdated_incomes(deal_model.income_recalculation_delay())
+        except Exception:
+            logger.exception('Пересчет дохода сделок не удался')
+            return 0
+
+    def run_once(self) -> int:
+        """ Планирование и выполнение задач, которые уже в очереди
+        :return: количество выполненных задач
+        """
+        self.schedule()
+        return len(self.drain())
+
+    def run_forever(self) -> None:
+        logger.info('Воркер синхронизации запущен')
+        while True:
+            close_old_connections()
+            processed = self.run_once()
+            recalculated = self.recalculate_incomes()
+            if not processed and not recalculated:
+                time.sleep(self.poll_interval)
+
+
+def _init_pool_process(rate_limits: Dict[str, float]) -> None:
+    """ Инициализация процесса пула.
+        Процесс получает свою долю лимитов запросов, чтобы все процессы вместе их не превышали
+    """
+    if not apps.ready:
+        django.setup()
+    RateLimits.configure(**rate_limits)
+
+
+def _drain_in_pool_process(batch_size: int) -> List[int]:
+    """ Выполнение задач в процессе пула, у процесса не больше одного подключения к БД """
+    try:
+        return SyncWorker(batch_size=batch_size).drain()
+    finally:
+        connections.close_all()
+
+
+class SyncReport:
+    """ Итоги синхронизации нескольких ИС """
+
+    def __init__(self, jobs: List['SyncJob'], scheduled: int, elapsed: dt.timedelta):
+        self.jobs = jobs
+        self.scheduled = scheduled
+        self.elapsed = elapsed
+
+    @property
+    def failed(self) -> List['SyncJob']:
+        return [job for job in self.jobs if job.status == job.Status.FAILED]
+
+    @staticmethod
+    def duration(job: 'SyncJob') -> dt.timedelta:
+        return job.finished_at - job.started_at
+
+    def lines(self, slowest: int = 5) -> List[str]:
+        seconds = self.elapsed.total_seconds()
+        lines = [
+            f'Поставлено в очередь: {self.scheduled}, выполнено: {len(self.jobs)}, '
+            f'успешно: {len(self.jobs) - len(self.failed)}, с ошибкой: {len(self.failed)}',
+            f'Время: {seconds:.1f} сек., ИС в минуту: {len(self.jobs) / seconds * 60 if seconds else 0:.1f}'
+        ]
+        if self.jobs:
+            lines.append('Самые долгие синхронизации:')
+            for job in sorted(self.jobs, key=self.duration, reverse=True)[:slowest]:
+                lines.append(f'    {job.investment_account}: {self.duration(job).total_seconds():.1f} сек.')
+        for job in self.failed:
+            lines.append(f'Ошибка {job.investment_account}: {job.error}')
+        return lines
+
+
+class ParallelSync:
+    """ Синхронизация всех ИС, которым пора синхронизироваться, пулом процессов.
+        Процессы забирают задачи из той же очереди, что и sync_worker, поэтому одна ИС
+        не синхронизируется дважды, а ошибка одной ИС записывается в ее задачу и не мешает остальным
+    """
+
+    def __init__(self, processes: int, rate_budget: float = 1, batch_size: int = 1):
+        """
+        :param processes: количество процессов, у каждого не больше одного подключения к БД
+        :param rate_budget: доля лимитов запросов к Tinkoff API на все процессы вместе (1 - лимиты целиком)
+        :param batch_size: сколько задач процесс забирает из очереди за раз
+        """
+        if processes > 1 and not connection.features.has_select_for_update_skip_locked:
+            # Без skip_locked (sqlite) процессы блокируют друг друга при разборе очереди
+            logger.warning('БД не поддерживает SELECT ... SKIP LOCKED, синхронизация выполняется в одном процессе')
+            processes = 1
+        self.processes = processes
+        self.rate_budget = rate_budget
+        self.batch_size = batch_size
+
+    def run(self) -> SyncReport:
+        started_at = time.monotonic()
+        worker = SyncWorker(batch_size=self.batch_size)
+        scheduled = worker.schedule()
+        logger.info(f'Поставлено в очередь ИС: {scheduled}, процессов: {self.processes}')
+        rate_share = self.rate_budget / self.processes
+        rate_limits = {group: limit * rate_share for group, limit in RateLimits.limits.items()}
+        if self.processes > 1:
+            # Дочерние процессы не должны использовать подключение родителя
+            connections.close_all()
+            with multiprocessing.Pool(self.processes, initializer=_init_pool_process, initargs=(rate_limits, )) as pool:
+                job_ids = [
+                    job_id for processed in pool.map(_drain_in_pool_process, [self.batch_size] * self.processes)
+                    for job_id in processed
+                ]
+        else:
+            _init_pool_process(rate_limits)
+            job_ids = worker.drain()
+        jobs = list(worker.sync_job_model.objects.filter(pk__in=job_ids).select_related('investment_account__creator'))
+        return SyncReport(jobs, scheduled, dt.timedelta(seconds=time.monotonic() - started_at))
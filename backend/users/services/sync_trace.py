@@ -0,0 +1,114 @@
+""" Трассировка синхронизации ИС.
+    Для каждого этапа (валютные активы, получение операций, первичная/вторичная обработка,
+    сделки, пересчет дохода) считаются время, количество запросов к БД и записанных строк
+"""
+import contextlib
+import logging
+import time
+from functools import wraps
+from typing import Dict, Optional
+
+from django.apps import apps
+from django.db import connection
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Запросы, строки которых считаются записанными.
+# COPY во временную таблицу (core.bulk_copy) считается запросом, строки - при переносе INSERT ... SELECT
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class StageStats:
+    """ Накопленная статистика этапа (этап может выполняться несколько раз, например для каждой пачки) """
+    __slots__ = ('name', 'calls', 'wall_time', 'query_count', 'rows_written')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.query_count = 0
+        self.rows_written = 0
+
+    def __repr__(self):
+        return f'{self.name}: {self.wall_time:.3f} сек., запросов {self.query_count}, строк {self.rows_written}'
+
+
+class SyncTracer:
+    """ Собирает статистику этапов одной синхронизации и сохраняет ее в SyncTrace.
+        Запросы к БД считаются через connection.execute_wrapper и относятся к самому вложенному этапу
+    """
+
+    def __init__(self):
+        self.started_at = timezone.now()
+        self._started = time.perf_counter()
+        self.stages: Dict[str, StageStats] = {}
+        self.operations_count = 0
+        self.error = ''
+        self._current: Optional[StageStats] = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(name)
+        stats.calls += 1
+        previous, self._current = self._current, stats
+        started = time.perf_counter()
+        try:
+            if previous is None:
+                with connection.execute_wrapper(self._count_query):
+                    yield stats
+            else:
+                yield stats
+        finally:
+            stats.wall_time += time.perf_counter() - started
+            self._current = previous
+
+    def _count_query(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        stats = self._current
+        if stats is not None:
+            stats.query_count += 1
+            if sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+                stats.rows_written += max(context['cursor'].rowcount, 0)
+        return result
+
+    @property
+    def wall_time(self) -> float:
+        return time.perf_counter() - self._started
+
+    def save(self, investment_account_id: int) -> 'SyncTrace':
+        """ Сохраняет трассировку, старые трассировки ИС удаляются """
+        sync_trace_model = apps.get_model('users', 'SyncTrace')
+        sync_trace_stage_model = apps.get_model('users', 'SyncTraceStage')
+        trace = sync_trace_model.objects.create(
+            investment_account_id=investment_account_id,
+            started_at=self.started_at,
+            wall_time=self.wall_time,
+            query_count=sum(stats.query_count for stats in self.stages.values()),
+            rows_written=sum(stats.rows_written for stats in self.stages.values()),
+            operations_count=self.operations_count,
+            error=self.error
+        )
+        sync_trace_stage_model.objects.bulk_create([
+            sync_trace_stage_model(
+                trace=trace, position=position, name=stats.name, calls=stats.calls, wall_time=stats.wall_time,
+                query_count=stats.query_count, rows_written=stats.rows_written
+            )
+            for position, stats in enumerate(self.stages.values())
+        ])
+        sync_trace_model.objects.trim(investment_account_id, sync_trace_model.keep_per_account)
+        logger.info(f'Синхронизация за {trace.wall_time:.2f} сек.: {list(self.stages.values())}')
+        return trace
+
+
+def traced_stage(name: str):
+    """ Метод Updater выполняется как этап name трассировки self.tracer """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.stage(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
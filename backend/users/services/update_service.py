@@ -1,21 +1,31 @@
-""" Модуль для обновления операций, сделок, валютных активов
+""" Модуль для обновления операций, сделок, валютных активов, позиций портфеля
     Получение через Tinkoff API
     Запись в ИС
 """
+import bisect
 import collections
 import datetime as dt
 import logging
-from typing import Optional, List, Dict
+from decimal import Decimal
+from typing import Optional, List, Dict, Set
 
-import dateutil.parser
+import requests
 from django.apps import apps
-from django.db.models import Min
+from django.db.models import Q
+from django.utils import timezone
 
-from core.utils import is_proxy_instance
-from market.models import CurrencyInstrument, InstrumentType, StockInstrument, Deal
+from core.bulk_copy import copy_create
+from core.utils import _get_possible_types_by_proxy_model
+from market.models import CurrencyInstrument, Deal, InstrumentType, StockInstrument
+from market.services.income_engine import IncomeEngine
 from operations.models import Operation, SaleOperation, DividendOperation, \
-    Transaction, PurchaseOperation, Share
+    Transaction, PurchaseOperation, Currency
 from tinkoff_api import TinkoffProfile
+from tinkoff_api._records import OperationRecord
+from tinkoff_api.exceptions import TooManyRequestsError, UnknownError
+from users.services.deal_assembler import DealAssembler
+from users.services.operation_classifier import OperationBuckets, TRADE_OPERATION_TYPES, classify_operations
+from users.services.sync_trace import SyncTracer, traced_stage
 
 logger = logging.getLogger(__name__)
 
@@ -32,17 +42,36 @@ class Updater:
         InstrumentType.Types.STOCK: StockInstrument,
         InstrumentType.Types.CURRENCY: CurrencyInstrument
     }
+    # Сколько операций обрабатывается за один проход (первичная + вторичная обработка)
+    batch_size = 500
+    # С какого количества строк операции и транзакции пачки пишутся через COPY.
+    # Не больше batch_size, иначе COPY_MIN_ROWS для пачки операций никогда не достигается
+    copy_min_rows = 200
+    # Сколько синхронизаций подряд операция может откладываться из-за инструмента, который не удалось получить
+    # (Tinkoff API не отдает инструмент, валюта не поддерживается), после этого она пропускается.
+    # Иначе дата такой операции навсегда остается началом синхронизации (sync_from_datetime)
+    max_deferred_attempts = 20
+    # Поля операции, которые сравниваются с уже записанной операцией с тем же _id
+    upsert_fields = (
+        'date', 'is_margin_call', 'payment', 'currency_id', 'instrument_id', 'quantity', 'commission'
+    )
 
     def __init__(self, from_datetime: dt.datetime, to_datetime: dt.datetime, investment_account_id: int,
-                 token: Optional[str] = None, tinkoff_profile: Optional[TinkoffProfile] = None):
+                 token: Optional[str] = None, tinkoff_profile: Optional[TinkoffProfile] = None,
+                 broker_account_id: Optional[str] = None, watermark: Optional[dt.datetime] = None,
+                 tracer: Optional[SyncTracer] = None):
         """ Инициализатор
         :param from_datetime: с какой даты получать операции
         :param to_datetime: до какой даты получать операции
         :param investment_account_id: id ИС
         :param token: токен от Tinkoff API, если None, будет использоваться tinkoff_profile
         :param tinkoff_profile: профиль Tinkoff API, если None, будет использоваться token
+        :param broker_account_id: брокерский счет ИС, если None - счет по умолчанию для токена
+        :param watermark: дата последней выполненной операции, записанной в прошлые синхронизации
+        :param tracer: трассировка этапов синхронизации, если None - новая
         """
         logger.info('Инициализация Updater')
+        self.tracer = tracer if tracer is not None else SyncTracer()
         if token is None and tinkoff_profile is None:
             raise ValueError('Надо передать token или tinkoff_profile')
         if token:
@@ -56,16 +85,32 @@ class Updater:
         self.to_datetime = to_datetime
         self.timezone = to_datetime.tzinfo
         self.investment_account_id = investment_account_id
-        self.operations = []
-        self.transactions = collections.defaultdict(list)
+        self.broker_account_id = broker_account_id
+        self.operations: List[OperationRecord] = []
+        # Операции self.operations, разложенные по этапам обработки
+        self.buckets = OperationBuckets()
         # Флаг, становится True когда проходит обработка первичных операций
         self._is_processed_primary_operations = False
         # Флаг, становится True когда проходит обработка вторичных операций
         self._is_processed_secondary_operations = False
         # Операции, после первичной обработки
         self.processed_primary_operations = {}
-        # Все валюты и торговые инструменты
-        self.instruments = InstrumentType.objects.all()
+        # Индекс торговых инструментов по FIGI, общий для всех пачек и этапов обработки
+        self.instruments: Dict[str, InstrumentType] = {}
+        # Дата последней выполненной операции, обновляется по мере обработки
+        self.watermark = watermark
+        # id (в Tinkoff API) операций, которые находятся в процессе выполнения
+        self.pending_operation_ids: Dict[str, dt.datetime] = {}
+        # id операций, которые Tinkoff API вернул в процессе выполнения в текущей синхронизации
+        self.fetched_pending_operation_ids: Set[str] = set()
+        # Сколько раз операции в процессе выполнения откладывались из-за инструмента, который не удалось получить
+        self.deferred_attempts: Dict[str, int] = {}
+        # id (в Tinkoff API) операций текущей пачки, которые были созданы или изменены
+        self.written_operation_ids = set()
+        # FIGI, которые не удалось получить от Tinkoff API, их операции откладываются
+        self.unresolved_figies: Set[str] = set()
+        # id сделок, в которых изменились уже привязанные операции, доход по ним пересчитывается с начала
+        self.changed_deal_ids: Set[int] = set()
 
     @property
     def is_processed_primary_operations(self):
@@ -75,15 +120,124 @@ class Updater:
     def is_processed_secondary_operations(self):
         return self._is_processed_secondary_operations
 
+    def resolve_instruments(self, operations: List[OperationRecord]) -> None:
+        """ Добавляет в индекс self.instruments инструменты операций.
+            Одним запросом на каждый тип инструмента, уже известные FIGI не запрашиваются повторно.
+            FIGI, которые не удалось получить, добавляются в self.unresolved_figies
+        """
+        figies_by_type = collections.defaultdict(set)
+        for operation in operations:
+            if operation.instrument_type is not None and operation.figi not in self.instruments:
+                figies_by_type[operation.instrument_type].add(operation.figi)
+        for instrument_type, figies in figies_by_type.items():
+            model = self.model_by_instrument_type.get(instrument_type)
+            if model is None:
+                logger.warning(f'Инструменты типа {instrument_type} не поддерживаются: {", ".join(figies)}')
+                continue
+            self.instruments.update((i.figi, i) for i in model.objects.filter(figi__in=figies))
+            missing_figies = figies - self.instruments.keys()
+            if missing_figies:
+                self.fetch_instruments(model, missing_figies)
+                missing_figies -= self.instruments.keys()
+            if missing_figies:
+                logger.warning(f'Не найдены инструменты {model.__name__}: {", ".join(missing_figies)}')
+                self.unresolved_figies |= missing_figies
+
+    def set_aside_unresolved_operations(self) -> None:
+        """ Убирает из обработки операции, инструмент которых не удалось получить.
+            Операции с неподдерживаемым типом инструмента не обрабатываются,
+            остальные откладываются как операции в процессе выполнения и запрашиваются снова при следующей синхронизации
+        """
+        unsupported, deferred = [], []
+        for operation in self.buckets.primary:
+            if operation.instrument_type is None or operation.figi in self.instruments:
+                continue
+            if operation.instrument_type in self.model_by_instrument_type:
+                deferred.append(operation)
+            else:
+                unsupported.append(operation)
+        # Налог на дивиденды ждет, пока запишется сам дивиденд
+        deferred += [i for i in self.buckets.dividend_taxes if i.figi in self.unresolved_figies]
+        if not unsupported and not deferred:
+            return
+        set_aside_ids = {operation.id for operation in unsupported + deferred}
+        self.buckets.primary = [i for i in self.buckets.primary if i.id not in set_aside_ids]
+        self.buckets.trades = [i for i in self.buckets.trades if i.id not in set_aside_ids]
+        self.buckets.dividend_taxes = [i for i in self.buckets.dividend_taxes if i.id not in set_aside_ids]
+        self.buckets.unprocessed += unsupported
+        skipped = []
+        for operation in deferred:
+            attempts = self.deferred_attempts.get(operation.id, 0) + 1
+            if attempts > self.max_deferred_attempts:
+                skipped.append(operation)
+                self.pending_operation_ids.pop(operation.id, None)
+                self.deferred_attempts.pop(operation.id, None)
+                continue
+            self.deferred_attempts[operation.id] = attempts
+            self.pending_operation_ids[operation.id] = operation.date
+            self.fetched_pending_operation_ids.add(operation.id)
+        if skipped:
+            self.buckets.unprocessed += skipped
+            logger.error(
+                f'Инструмент не удалось получить за {self.max_deferred_attempts} синхронизаций, '
+                f'операции пропущены: {skipped}'
+            )
+        deferred = [i for i in deferred if i not in skipped]
+        if deferred:
+            logger.warning(f'Операции отложены до следующей синхронизации: {[i.id for i in deferred]}')
+
+    @traced_stage('fetch_instruments')
+    def fetch_instruments(self, model, figies: Set[str]) -> None:
+        """ Получает от Tinkoff API инструменты, которых нет в БД, и записывает их одним bulk_create.
+            Запрашиваются только недостающие FIGI (ответы кэшируются в catalog_cache),
+            полный справочник (manage.py init --with-update) для этого не нужен
+        """
+        logger.info(f'Инструментов {model.__name__} нет в БД, запрашиваем: {", ".join(figies)}')
+        instrument_type = _get_possible_types_by_proxy_model(model)[0]
+        currencies = set(Currency.objects.values_list('pk', flat=True))
+        bulk_create = []
+        for figi in sorted(figies):
+            try:
+                instrument = self.tinkoff_profile.market_search_by_figi(figi)['payload']
+            except (UnknownError, TooManyRequestsError, requests.exceptions.RequestException) as e:
+                logger.warning(f'Не удалось получить инструмент {figi} от Tinkoff API: {e!r}')
+                continue
+            if instrument.get('type') != instrument_type:
+                logger.warning(f'Инструмент {figi} имеет тип {instrument.get("type")}, ожидался {instrument_type}')
+                continue
+            if instrument['currency'] not in currencies:
+                logger.warning(f'Валюты {instrument["currency"]} инструмента {figi} нет в БД')
+                continue
+            fields = {
+                'figi': instrument['figi'],
+                'ticker': instrument['ticker'],
+                'min_price_increment': instrument.get('minPriceIncrement', 0),
+                'lot': instrument['lot'],
+                'currency_id': instrument['currency'],
+                'name': instrument['name']
+            }
+            if model is StockInstrument:
+                fields['isin'] = instrument['isin']
+            bulk_create.append(model(**fields))
+        model.objects.bulk_create(bulk_create, ignore_conflicts=True)
+        # Инструмент мог не записаться из-за конфликта (например, тикер занят), поэтому перечитываем из БД
+        self.instruments.update((i.figi, i) for i in model.objects.filter(figi__in=figies))
+        logger.info(f'Добавлено инструментов {model.__name__}: {len(figies & self.instruments.keys())}')
+
     def get_operations_from_tinkoff_api(self) -> None:
         """ Получение списка операций в заданном временном диапазоне """
         # Получаем список операций в диапазоне
-        self.operations = self.tinkoff_profile.operations(
-            self.from_datetime, self.to_datetime
-        )['payload']['operations'][::-1]
+        self.operations = [
+            operation
+            for batch in self.tinkoff_profile.operations_records(
+                self.from_datetime, self.to_datetime, broker_account_id=self.broker_account_id
+            )
+            for operation in batch
+        ]
         self._is_processed_primary_operations = False
         self._is_processed_secondary_operations = False
 
+    @traced_stage('primary_operations')
     def process_primary_operations(self) -> None:
         """ Генерирует список объектов Operation для первичных операций.
             Создает первичные операции через bulk_create.
@@ -92,7 +246,7 @@ class Updater:
             вторичные не могут быть созданы.
         """
         logger.info('Обработка первичных операций')
-        # Типы пе
+        # Типы первичных операций, у которых тип записывается явно
         primary_operation_type = (
             Operation.Types.PAY_IN, Operation.Types.PAY_OUT,
             Operation.Types.SERVICE_COMMISSION, Operation.Types.MARGIN_COMMISSION,
@@ -103,89 +257,137 @@ class Updater:
             logger.warning('Первичные операции уже обработаны')
             return
 
+        # Раскладываем операции по этапам за один проход
+        self.buckets = classify_operations(self.operations)
+        logger.info(f'Операции разложены по этапам: {self.buckets}')
         # Словарь, который будет возвращен.
         # Ключ - модель, значение - список, который потом будет передан в bulk_create
         final_operations: Dict[Operation, List[Operation]] = collections.defaultdict(list)
 
-        for operation in self.operations.copy():
-            logger.info(f'Операция: {operation}')
-            # Будем записывать только завершенные операции
-            if operation['status'] != Operation.Statuses.DONE:
-                logger.info('Статус != DONE, пропускаем')
-                self.operations.remove(operation)
-                continue
-
-            operation_type = operation['operationType']
+        self.resolve_instruments(self.buckets.primary)
+        self.set_aside_unresolved_operations()
+        for operation in self.buckets.primary:
+            logger.debug(f'Операция: {operation}')
+            operation_type = operation.operation_type
             # У каждой операции есть эти свойства, поэтому вынесем их
             base_operation_kwargs = {
                 'investment_account_id': self.investment_account_id,
-                'date': dateutil.parser.isoparse(operation['date']).astimezone(self.timezone),
-                'is_margin_call': operation['isMarginCall'],
-                'payment': operation['payment'],
-                'currency_id': operation['currency'],
-                '_id': operation['id']
+                'date': operation.date.astimezone(self.timezone),
+                'is_margin_call': operation.is_margin_call,
+                'payment': operation.payment,
+                'currency_id': operation.currency,
+                '_id': operation.id
             }
             if operation_type in primary_operation_type:
                 base_operation_kwargs['type'] = operation_type
-            if operation.get('instrumentType') is not None:
-                base_operation_kwargs['instrument'] = (
-                    self.model_by_instrument_type[operation['instrumentType']].objects.get(figi=operation['figi'])
-                )
-                logger.info(f'У операции указан инструмент ({base_operation_kwargs["instrument"]})')
+            if operation.instrument_type is not None:
+                base_operation_kwargs['instrument'] = self.instruments[operation.figi]
             model = Operation.get_operation_model_by_type(operation_type, default=Operation)
-            logger.info(f'Модель операции: {model.__name__}')
 
-            # Операции, которым достаточно значений из base_operation_kwargs
-            if operation_type in (Operation.Types.PAY_IN, Operation.Types.PAY_OUT, Operation.Types.DIVIDEND,
-                                  Operation.Types.SERVICE_COMMISSION, Operation.Types.MARGIN_COMMISSION,
-                                  Operation.Types.TAX, Operation.Types.TAX_BACK):
-                logger.info('Добавляется экземпляр на основе только base_operation_kwargs')
-                final_operations[model].append(model(**base_operation_kwargs))
-                self.operations.remove(operation)
             # Операции покупки, покупки с карты и продажи, по сути, ничем не отличаются,
             # только значением в payment
-            elif operation_type in (Operation.Types.BUY, Operation.Types.BUY_CARD, Operation.Types.SELL):
+            if operation_type in TRADE_OPERATION_TYPES:
                 # Некоторые операции могут быть без комиссии (например в первый месяц торгов)
-                commission = operation.get('commission')
-                commission = commission['value'] if isinstance(commission, dict) else 0
-                logger.info(f'Комиссия: {commission}')
-                # Добавляем транзакции по операции
-                for transaction in operation['trades']:
-                    self.transactions[operation['id']].append({
-                        'id': transaction['tradeId'],
-                        'date': self.timezone.localize(
-                            dateutil.parser.isoparse(transaction['date']).replace(tzinfo=None)
-                        ),
-                        'quantity': transaction['quantity'],
-                        'price': transaction['price']
-                    })
+                commission = operation.commission if operation.commission is not None else 0
                 # Иногда Tinkoff не считает payment, вычисляем из trades
                 if base_operation_kwargs['payment'] == 0:
-                    base_operation_kwargs['payment'] = sum(i['quantity'] * -i['price'] for i in operation['trades'])
+                    base_operation_kwargs['payment'] = sum(i.quantity * -i.price for i in operation.trades)
                     logger.warning(f'payment не указан, вычислили из trades: {base_operation_kwargs["payment"]}')
-                obj = model(
+                final_operations[model].append(model(
                     **base_operation_kwargs,
-                    quantity=operation['quantity'],
+                    quantity=operation.quantity,
                     commission=commission
-                )
-                final_operations[model].append(obj)
-                self.operations.remove(operation)
-            elif operation_type == Operation.Types.BROKER_COMMISSION:
-                logger.info('Комиссия брокера')
-                self.operations.remove(operation)
+                ))
+            # Операции, которым достаточно значений из base_operation_kwargs
             else:
-                logger.info('Операция не является первичной')
+                final_operations[model].append(model(**base_operation_kwargs))
 
-        for model, bulk_create in final_operations.items():
-            logger.info(f'Создаем операции модели {model.__name__} через bulk_create')
-            model.objects.bulk_create(bulk_create, ignore_conflicts=True)
-            logger.info(f'Операции модели {model.__name__} созданы через bulk_create')
+        self.upsert_operations(final_operations)
+        for operation in self.buckets.pending:
+            self.pending_operation_ids[operation.id] = operation.date
+            self.fetched_pending_operation_ids.add(operation.id)
+        for operation in self.buckets.primary + self.buckets.dividend_taxes + self.buckets.ignored:
+            self.pending_operation_ids.pop(operation.id, None)
+            is_newer = self.watermark is None or operation.date > self.watermark
+            if operation.status == Operation.Statuses.DONE and is_newer:
+                self.watermark = operation.date
         # Обработанные операции
         self.processed_primary_operations = final_operations
         # Первичные операции обработаны
         self._is_processed_primary_operations = True
         logger.info('Обработка первичных операций завершена')
 
+    def upsert_operations(self, final_operations: Dict[Operation, List[Operation]]) -> None:
+        """ Запись операций по _id: новые создаются, измененные обновляются,
+            операции, которые уже записаны без изменений, в БД не отправляются
+        """
+        existing_operations = {
+            operation._id: operation
+            for operation in Operation.objects.filter(
+                investment_account_id=self.investment_account_id,
+                _id__in=[obj._id for objs in final_operations.values() for obj in objs]
+            )
+        }
+        self.written_operation_ids = set()
+        bulk_update = []
+        for model, objs in final_operations.items():
+            bulk_create = []
+            for obj in objs:
+                existing = existing_operations.get(obj._id)
+                if existing is None:
+                    bulk_create.append(obj)
+                    self.written_operation_ids.add(obj._id)
+                    continue
+                changed_fields = [
+                    field for field in self.upsert_fields if getattr(existing, field) != getattr(obj, field)
+                ]
+                if changed_fields:
+                    logger.debug(f'Операция {obj._id} изменилась: {", ".join(changed_fields)}')
+                    for field in changed_fields:
+                        setattr(existing, field, getattr(obj, field))
+                    bulk_update.append(existing)
+                    if existing.deal_id is not None:
+                        self.changed_deal_ids.add(existing.deal_id)
+                    self.written_operation_ids.add(obj._id)
+            if bulk_create:
+                logger.info(f'Создаем {len(bulk_create)} операций модели {model.__name__}')
+                copy_create(model, bulk_create, min_rows=self.copy_min_rows)
+        if bulk_update:
+            logger.info(f'Обновляем {len(bulk_update)} измененных операций')
+            Operation.objects.bulk_update(bulk_update, fields=self.upsert_fields)
+        logger.info(
+            f'Операций создано/изменено: {len(self.written_operation_ids)}, '
+            f'без изменений: {len(existing_operations) - len(bulk_update)}'
+        )
+
+    @traced_stage('pending_operations')
+    def save_pending_operations(self) -> None:
+        """ Сохраняет список операций в процессе выполнения, выполненные удаляются из списка """
+        pending_operation_model = apps.get_model('operations', 'PendingOperation')
+        pending_operations = pending_operation_model.objects.filter(investment_account_id=self.investment_account_id)
+        pending_operations.exclude(_id__in=self.pending_operation_ids).delete()
+        existing = {
+            pending_operation._id: pending_operation
+            for pending_operation in pending_operations.filter(_id__in=self.pending_operation_ids)
+        }
+        bulk_update = []
+        for _id, pending_operation in existing.items():
+            deferred_attempts = self.deferred_attempts.get(_id, 0)
+            if pending_operation.deferred_attempts != deferred_attempts:
+                pending_operation.deferred_attempts = deferred_attempts
+                bulk_update.append(pending_operation)
+        pending_operation_model.objects.bulk_update(bulk_update, fields=('deferred_attempts', ))
+        pending_operation_model.objects.bulk_create([
+            pending_operation_model(
+                investment_account_id=self.investment_account_id, _id=_id, date=date,
+                deferred_attempts=self.deferred_attempts.get(_id, 0)
+            )
+            for _id, date in self.pending_operation_ids.items() if _id not in existing
+        ], ignore_conflicts=True)
+        if self.pending_operation_ids:
+            logger.info(f'Операций в процессе выполнения: {len(self.pending_operation_ids)}')
+
+    @traced_stage('secondary_operations')
     def process_secondary_operations(self) -> None:
         """ Обработка вторичных операций и запись вторичных операций.
             Вторичные операции - это те операции, для создания которых
@@ -202,124 +404,166 @@ class Updater:
 
         logger.info('Обновляем транзакции')
         # Словарь операций, которым принадлежат транзакции
-        # Ключ - id в БД, значение id в Tinkoff API
+        # Ключ - id в Tinkoff API, значение - id в БД
+        trades = [i for i in self.buckets.trades if i.id in self.written_operation_ids]
         operation_by_tinkoff_api_operation_id = dict(
-            Operation.objects.filter(_id__in=self.transactions).values_list('_id', 'id')
+            Operation.objects.filter(_id__in=[i.id for i in trades]).values_list('_id', 'id')
         )
         bulk_create_transactions = []
-        for operation_id, transactions in self.transactions.items():
-            for transaction in transactions:
+        for operation in trades:
+            for transaction in operation.trades:
                 bulk_create_transactions.append(Transaction(
-                    **transaction,
-                    operation_id=operation_by_tinkoff_api_operation_id[operation_id]
+                    id=transaction.trade_id,
+                    date=self.timezone.localize(transaction.date.replace(tzinfo=None)),
+                    quantity=transaction.quantity,
+                    price=transaction.price,
+                    operation_id=operation_by_tinkoff_api_operation_id[operation.id]
                 ))
-        Transaction.objects.bulk_create(bulk_create_transactions, ignore_conflicts=True)
+        copy_create(Transaction, bulk_create_transactions, min_rows=self.copy_min_rows)
         logger.info('Транзакции обновлены')
 
         logger.info('Добавляем вторичные операции')
-        for operation in self.operations.copy():
-            logger.info(f'Операция: {operation}')
-            operation_type = operation['operationType']
-            operation_date = dateutil.parser.isoparse(operation['date']).astimezone(self.timezone)
-
-            # Для налога на дивиденды находим последнюю ценную бумагу без налога по figi
-            if operation_type == Operation.Types.TAX_DIVIDEND:
-                logger.info('Операция "Налог на дивиденды"')
-                dividend_tax_exists = (
-                    DividendOperation.objects
-                    .filter(investment_account_id=self.investment_account_id,
-                            instrument__figi=operation['figi'], dividend_tax_date=operation_date)
-                    .exists()
-                )
-                if not dividend_tax_exists:
-                    dividend_obj = (
-                        DividendOperation.objects
-                        .filter(investment_account_id=self.investment_account_id,
-                                instrument__figi=operation['figi'], date__lte=operation_date,
-                                dividend_tax_date__isnull=True)
-                        .order_by('-date')[0]
-                    )
-                    dividend_obj.dividend_tax = operation['payment']
-                    dividend_obj.dividend_tax_date = operation_date
-                    dividend_obj.save(update_fields=('dividend_tax', 'dividend_tax_date'))
-                self.operations.remove(operation)
+        self.process_dividend_taxes()
         logger.info('Вторичные операции добавлены')
-        if self.operations:
-            logger.warning(f'Оставшиеся операции после вторичной обработки: {self.operations}')
+        if self.buckets.unprocessed:
+            logger.warning(f'Оставшиеся операции после вторичной обработки: {self.buckets.unprocessed}')
         else:
             logger.info('После вторичной обработки операций не осталось')
         self._is_processed_secondary_operations = True
         logger.info(f'Обработка вторичных операций завершена')
 
+    def process_dividend_taxes(self) -> None:
+        """ Налог на дивиденды записывается в последний дивиденд без налога по тому же FIGI.
+            Все дивиденды-кандидаты пачки загружаются одним запросом, сопоставление - в памяти,
+            запись - одним bulk_update
+        """
+        dividend_taxes = [
+            (operation.figi, operation.date.astimezone(self.timezone), operation.payment)
+            for operation in self.buckets.dividend_taxes
+        ]
+        if not dividend_taxes:
+            return
+        tax_dates = {date for figi, date, payment in dividend_taxes}
+        dividends = (
+            DividendOperation.objects
+            .filter(Q(dividend_tax_date__isnull=True) | Q(dividend_tax_date__in=tax_dates),
+                    investment_account_id=self.investment_account_id,
+                    instrument_id__in={figi for figi, date, payment in dividend_taxes},
+                    date__lte=max(tax_dates))
+            .only('id', 'type', 'instrument_id', 'date', 'dividend_tax', 'dividend_tax_date', 'deal_id')
+            .order_by('date', 'id')
+        )
+        # Налоги, которые уже записаны: (FIGI, дата налога)
+        applied_taxes = set()
+        # Дивиденды без налога по FIGI, отсортированы по дате
+        untaxed_dividends = collections.defaultdict(list)
+        for dividend in dividends:
+            if dividend.dividend_tax_date is None:
+                untaxed_dividends[dividend.instrument_id].append(dividend)
+            else:
+                applied_taxes.add((dividend.instrument_id, dividend.dividend_tax_date))
+
+        bulk_update = []
+        for figi, date, payment in dividend_taxes:
+            if (figi, date) in applied_taxes:
+                continue
+            candidates = untaxed_dividends[figi]
+            # Последний дивиденд, полученный не позже налога
+            index = bisect.bisect_right([dividend.date for dividend in candidates], date) - 1
+            if index < 0:
+                logger.warning(f'Не найден дивиденд для налога {figi} от {date.isoformat()}')
+                continue
+            dividend = candidates.pop(index)
+            dividend.dividend_tax = payment
+            dividend.dividend_tax_date = date
+            applied_taxes.add((figi, date))
+            bulk_update.append(dividend)
+            if dividend.deal_id is not None:
+                self.changed_deal_ids.add(dividend.deal_id)
+        DividendOperation.objects.bulk_update(bulk_update, fields=('dividend_tax', 'dividend_tax_date'))
+        logger.info(f'Записано налогов на дивиденды: {len(bulk_update)}')
+
     def update_operations(self) -> None:
-        """ Обновление операций """
-        self.get_operations_from_tinkoff_api()
-        self.process_primary_operations()
-        self.process_secondary_operations()
+        """ Обновление операций.
+            Операции обрабатываются пачками от старых к новым, поэтому к моменту
+            обработки налога на дивиденды сами дивиденды уже записаны
+        """
+        batches = iter(self.tinkoff_profile.operations_records(
+            self.from_datetime, self.to_datetime, batch_size=self.batch_size, broker_account_id=self.broker_account_id
+        ))
+        pending_operation_model = apps.get_model('operations', 'PendingOperation')
+        self.fetched_pending_operation_ids = set()
+        self.pending_operation_ids, self.deferred_attempts = {}, {}
+        for _id, date, deferred_attempts in (
+            pending_operation_model.objects
+            .filter(investment_account_id=self.investment_account_id).values_list('_id', 'date', 'deferred_attempts')
+        ):
+            self.pending_operation_ids[_id] = date
+            if deferred_attempts:
+                self.deferred_attempts[_id] = deferred_attempts
+        while True:
+            with self.tracer.stage('fetch_operations'):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            logger.info(f'Обработка пачки из {len(batch)} операций')
+            self.tracer.operations_count += len(batch)
+            self.operations = batch
+            self._is_processed_primary_operations = False
+            self._is_processed_secondary_operations = False
+            self.process_primary_operations()
+            self.process_secondary_operations()
+        self.prune_pending_operations()
+        self.save_pending_operations()
+
+    def prune_pending_operations(self) -> None:
+        """ Убирает из списка операции в процессе выполнения, которые попадают в запрошенный диапазон,
+            но в этот раз не вернулись в процессе выполнения (Tinkoff API перестал их возвращать
+            или они стали операциями, которые не обрабатываются)
+        """
+        stale_ids = [
+            _id for _id, date in self.pending_operation_ids.items()
+            if self.from_datetime <= date <= self.to_datetime and _id not in self.fetched_pending_operation_ids
+        ]
+        for _id in stale_ids:
+            del self.pending_operation_ids[_id]
+        if stale_ids:
+            logger.info(f'Операции больше не в процессе выполнения: {stale_ids}')
 
     def update_deals(self) -> None:
         """ Обновление сделок """
         investment_account_model = apps.get_model('users', 'InvestmentAccount')
         logger.info('Обновление сделок')
-        operations = (
-            Operation.objects
-            .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation),
-                    deal__isnull=True, investment_account_id=self.investment_account_id)
-            .order_by('date')
-        )
-
-        # Сделки, у которых надо пересчитать доход
-        recalculation_income_deals = set()
-        # Список всех совладельцев счета
-        co_owners = (
-            investment_account_model(id=self.investment_account_id).co_owners
-            .prefetch_related('capital').all()
-        )
-        logger.info(f'Список совладельцев: {co_owners}')
-        bulk_create_share = []
-        for operation in operations:
-            logger.info(f'Операция: {operation}')
-            # Добавление долей для операций
-            for co_owner in co_owners:
-                logger.info(f'Добавление доли операции для {co_owner}')
-                default_share = co_owner.capital.get(currency=operation.currency).default_share
-                bulk_create_share.append(
-                    Share(operation=operation, co_owner_id=co_owner.pk, value=default_share)
-                )
-            if is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
-                deal, created = (
-                    Deal.objects.opened()
-                    .get_or_create(instrument=operation.instrument,
-                                   investment_account_id=self.investment_account_id)
-                )
-                if created:
-                    logger.info('Сделка создана')
-                else:
-                    logger.info('Сделка существовала')
-                deal.operations.add(operation)
-                recalculation_income_deals.add(deal)
-            elif is_proxy_instance(operation, DividendOperation):
-                deal = (
-                    Deal.objects
-                    .filter(instrument=operation.instrument, investment_account_id=self.investment_account_id)
-                    .annotate(opened_date=Min('operations__date'))
-                    .filter(opened_date__lte=operation.date)
-                    .latest('opened_date')
+        with self.tracer.stage('deals'):
+            operations = list(
+                Operation.objects
+                .filter(proxy_instance_of=(PurchaseOperation, SaleOperation, DividendOperation),
+                        deal__isnull=True, investment_account_id=self.investment_account_id)
+                .order_by('date', 'pk')
+            )
+            assembler = DealAssembler.for_investment_account(investment_account_model(id=self.investment_account_id))
+            assembler.assemble(operations)
+        with self.tracer.stage('recalculation_income'):
+            # Сделки из очереди на пересчет (изменены доли) пересчитываются вместе с остальными
+            started_at = timezone.now()
+            outdated_deals = Deal.objects.income_outdated().filter(investment_account_id=self.investment_account_id)
+            replay_deal_ids = self.changed_deal_ids | set(outdated_deals.values_list('pk', flat=True))
+            if assembler.operation_ids_by_deal or replay_deal_ids:
+                IncomeEngine(self.investment_account_id).apply(
+                    assembler.operation_ids_by_deal, replay_deal_ids=replay_deal_ids
                 )
-                deal.operations.add(operation)
-                recalculation_income_deals.add(deal)
-        Share.objects.bulk_create(bulk_create_share, ignore_conflicts=True)
-        for deal in recalculation_income_deals:
-            logger.info(f'Пересчет прибыли у {deal}')
-            deal.recalculation_income()
+                outdated_deals.clear_income_outdated(started_at)
         logger.info('Обновление сделок завершено')
 
+    @traced_stage('currency_assets')
     def update_currency_assets(self):
         """ Обновление валютных активов портфеля """
         logger.info('Обновление валютных активов')
         investment_account_model = apps.get_model('users', 'InvestmentAccount')
         currency_asset_model = apps.get_model('users', 'CurrencyAsset')
-        currency_actives = self.tinkoff_profile.portfolio_currencies()['payload']['currencies']
+        currency_actives = self.tinkoff_profile.portfolio_currencies(
+            broker_account_id=self.broker_account_id
+        )['payload']['currencies']
         (
             investment_account_model.objects
             .get(id=self.investment_account_id).currency_assets
@@ -337,3 +581,52 @@ class Updater:
                 obj.value = currency['balance']
                 obj.save(update_fields=['value'])
         logger.info('Обновление валютных активов завершено')
+
+    @traced_stage('portfolio_positions')
+    def update_portfolio_positions(self):
+        """ Обновление снимка портфеля, из которого читают страница сделок и API """
+        logger.info('Обновление позиций портфеля')
+        portfolio_position_model = apps.get_model('users', 'PortfolioPosition')
+        positions = self.tinkoff_profile.portfolio(broker_account_id=self.broker_account_id)['payload']['positions']
+        currencies = set(Currency.objects.values_list('pk', flat=True))
+        existing = (
+            portfolio_position_model.objects
+            .filter(investment_account_id=self.investment_account_id)
+            .by_figi()
+        )
+        (
+            portfolio_position_model.objects
+            .filter(investment_account_id=self.investment_account_id)
+            .exclude(figi__in=[p['figi'] for p in positions]).delete()
+        )
+        bulk_create = []
+        bulk_update = []
+        for position in positions:
+            average_position_price = position.get('averagePositionPrice') or {}
+            expected_yield = position.get('expectedYield') or {}
+            currency = average_position_price.get('currency') or expected_yield.get('currency')
+            fields = {
+                'instrument_type': position.get('instrumentType', ''),
+                'balance': Decimal(str(position['balance'])),
+                'lots': position.get('lots', 0),
+                'average_position_price': (
+                    Decimal(str(average_position_price['value'])) if 'value' in average_position_price else None
+                ),
+                'expected_yield': Decimal(str(expected_yield.get('value', 0))),
+                'currency_id': currency if currency in currencies else None
+            }
+            obj = existing.get(position['figi'])
+            if obj is None:
+                bulk_create.append(portfolio_position_model(
+                    investment_account_id=self.investment_account_id, figi=position['figi'], **fields
+                ))
+            else:
+                for field, value in fields.items():
+                    setattr(obj, field, value)
+                bulk_update.append(obj)
+        portfolio_position_model.objects.bulk_create(bulk_create)
+        portfolio_position_model.objects.bulk_update(
+            bulk_update, fields=('instrument_type', 'balance', 'lots', 'average_position_price', 'expected_yield',
+                                 'currency')
+        )
+        logger.info('Обновление позиций портфеля завершено')
@@ -1,3 +1,628 @@
-from django.test import TestCase
+import collections
+import datetime as dt
+import io
+import json
+import os
+import random
+import tempfile
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import List
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import pytz
+import requests
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models import Min
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from core.bulk_copy import copy_create, copy_expert
+from core.utils import is_proxy_instance
+from market.models import Deal, DealIncome, DealQuerySet, InstrumentType, StockInstrument
+from market.services.income_engine import IncomeEngine
+from market.tests import create_deal_operations, create_investment_account
+from operations.models import (
+    Currency, DividendOperation, InvestmentAccountPurchaseOperation, Operation, PayInOperation, PendingOperation,
+    PurchaseOperation, SaleOperation, Share, Transaction
+)
+from operations.models_constraints import OperationStatuses, OperationTypes
+from tinkoff_api import TinkoffApiUrl, TinkoffProfile, Transport
+from tinkoff_api._records import OperationRecord, batched
+from tinkoff_api._transport import ReplayResponse
+from tinkoff_api.exceptions import InvalidTokenError, UnknownError
+from users.models import Capital, CoOwner, InvestmentAccount, Investor, PortfolioPosition, SyncJob, SyncJobQuerySet
+from users.services.deal_assembler import DealAssembler
+from users.services.sync_service import SyncWorker
+from users.services.sync_trace import SyncTracer
+from users.services.update_service import Updater
+
+
+class SyncTracerTest(TestCase):
+    def test_copy_is_counted(self):
+        copied = []
+        cursor = SimpleNamespace(
+            rowcount=3, cursor=SimpleNamespace(copy_expert=lambda sql, buffer: copied.append(sql))
+        )
+        tracer = SyncTracer()
+        with tracer.stage('copy') as stats:
+            copy_expert(cursor, 'COPY staging (a) FROM STDIN', io.StringIO())
+        self.assertEqual(copied, ['COPY staging (a) FROM STDIN'])
+        self.assertEqual(stats.query_count, 1)
+        # Строки во временной таблице не считаются записанными
+        self.assertEqual(stats.rows_written, 0)
+
+    def test_copy_create_rows_are_counted(self):
+        tracer = SyncTracer()
+        currencies = [Currency(iso_code=f'C{i:02}', abbreviation='c', name=f'Currency {i}') for i in range(5)]
+        with tracer.stage('copy') as stats:
+            copy_create(Currency, currencies, min_rows=1)
+        self.assertEqual(Currency.objects.count(), 5)
+        self.assertEqual(stats.rows_written, 5)
+
+
+class FakeTinkoffProfile(TinkoffProfile):
+    """ Профиль Tinkoff API, который отдает заданные операции (в формате ответа operations) без запросов """
+    def __init__(self, operations=(), instruments=()):
+        super().__init__('token')
+        self.operations_json = list(operations)
+        # Ответы market/search/by-figi, FIGI, которых нет - сбой Tinkoff API
+        self.instruments = {instrument['figi']: instrument for instrument in instruments}
+
+    def auth(self, first='production'):
+        self.broker_account_id = '1'
+        self.is_production_token_valid = True
+        return 'production'
+
+    def operations_records(self, from_datetime, to_datetime, batch_size=500, window=None, broker_account_id=None):
+        records = sorted(
+            (OperationRecord.from_json(operation) for operation in self.operations_json),
+            key=lambda record: record.date
+        )
+        return batched([record for record in records if from_datetime <= record.date <= to_datetime], batch_size)
+
+    def market_search_by_figi(self, figi):
+        if figi not in self.instruments:
+            raise UnknownError('Неизвестный status_code запроса: 500')
+        return {'payload': self.instruments[figi]}
+
+
+class UpdaterOperationsTest(TestCase):
+    start = dt.datetime(2020, 1, 1, tzinfo=pytz.utc)
+
+    def setUp(self):
+        Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        self.investment_account = create_investment_account(Investor.objects.create(username='creator'))
+        self.tinkoff_profile = FakeTinkoffProfile()
+
+    def at(self, hours: float) -> dt.datetime:
+        return self.start + dt.timedelta(hours=hours)
+
+    def pay_in(self, _id: str, hours: float, status: str = OperationStatuses.DONE,
+               operation_type: str = OperationTypes.PAY_IN) -> dict:
+        return {
+            'id': _id, 'status': status, 'operationType': operation_type, 'date': self.at(hours).isoformat(),
+            'isMarginCall': False, 'payment': Decimal(100), 'currency': 'USD'
+        }
+
+    def buy(self, _id: str, hours: float, figi: str, instrument_type: str = InstrumentType.Types.STOCK) -> dict:
+        date = self.at(hours).isoformat()
+        return {
+            'id': _id, 'status': OperationStatuses.DONE, 'operationType': OperationTypes.BUY, 'date': date,
+            'isMarginCall': False, 'payment': Decimal(-10), 'currency': 'USD', 'figi': figi,
+            'instrumentType': instrument_type, 'quantity': 1, 'commission': {'currency': 'USD', 'value': -0.1},
+            'trades': [{'tradeId': f'{_id}-trade', 'date': date, 'quantity': 1, 'price': 10}]
+        }
+
+    @staticmethod
+    def stock(figi: str, currency: str = 'USD') -> dict:
+        return {
+            'figi': figi, 'ticker': f'T{figi}', 'isin': f'I{figi}', 'minPriceIncrement': 0.01, 'lot': 1,
+            'currency': currency, 'name': figi, 'type': InstrumentType.Types.STOCK
+        }
+
+    def update_operations(self, from_hours: float, to_hours: float, watermark: dt.datetime = None) -> Updater:
+        updater = Updater(
+            self.at(from_hours), self.at(to_hours), self.investment_account.pk,
+            tinkoff_profile=self.tinkoff_profile, watermark=watermark
+        )
+        updater.update_operations()
+        return updater
+
+    def pending_ids(self):
+        return set(self.investment_account.pending_operations.values_list('_id', flat=True))
+
+    def test_watermark_advances_to_last_done_operation(self):
+        self.tinkoff_profile.operations_json = [
+            self.pay_in('1', 1), self.pay_in('2', 2),
+            self.pay_in('3', 3, status=OperationStatuses.PROGRESS),
+            self.pay_in('4', 4, status=OperationStatuses.DECLINE)
+        ]
+        # Операции в процессе выполнения и отклоненные не сдвигают watermark
+        self.assertEqual(self.update_operations(0, 10).watermark, self.at(2))
+        # Операции из перекрытия окон не сдвигают watermark назад
+        self.assertEqual(self.update_operations(0, 10, watermark=self.at(5)).watermark, self.at(5))
+        self.assertEqual(
+            set(Operation.objects.filter(investment_account=self.investment_account).values_list('_id', flat=True)),
+            {'1', '2'}
+        )
+
+    def test_sync_from_datetime_overlap(self):
+        investment_account = self.investment_account
+        investment_account.sync_at = self.at(10)
+        self.assertEqual(investment_account.sync_from_datetime(), self.at(10) - investment_account.watermark_overlap)
+        investment_account.operations_watermark = self.at(8)
+        self.assertEqual(investment_account.sync_from_datetime(), self.at(8) - investment_account.watermark_overlap)
+        PendingOperation.objects.create(investment_account=investment_account, _id='pending', date=self.at(1))
+        # Операция в процессе выполнения раньше перекрытия - запрашиваем с нее
+        self.assertEqual(investment_account.sync_from_datetime(), self.at(1))
+
+    def test_pending_lifecycle(self):
+        PendingOperation.objects.create(investment_account=self.investment_account, _id='old', date=self.at(-24))
+        self.tinkoff_profile.operations_json = [
+            self.pay_in('done', 1, status=OperationStatuses.PROGRESS),
+            self.pay_in('gone', 2, status=OperationStatuses.PROGRESS),
+            self.pay_in('unknown', 3, status=OperationStatuses.PROGRESS),
+            self.pay_in('still', 4, status=OperationStatuses.PROGRESS)
+        ]
+        self.update_operations(0, 10)
+        self.assertEqual(self.pending_ids(), {'old', 'done', 'gone', 'unknown', 'still'})
+
+        self.tinkoff_profile.operations_json = [
+            self.pay_in('done', 1),
+            self.pay_in('unknown', 3, operation_type=OperationTypes.UNKNOWN),
+            self.pay_in('still', 4, status=OperationStatuses.PROGRESS)
+        ]
+        self.update_operations(0, 10)
+        # Выполненная, пропавшая из ответа и необрабатываемая операции больше не в процессе выполнения,
+        # операция вне запрошенного диапазона остается
+        self.assertEqual(self.pending_ids(), {'old', 'still'})
+        self.assertTrue(Operation.objects.filter(_id='done').exists())
+
+    def test_unresolved_instruments(self):
+        self.tinkoff_profile.operations_json = [
+            self.buy('etf', 1, 'ETF', instrument_type='Etf'),
+            self.buy('server-error', 2, 'FAILED'),
+            self.buy('unknown-currency', 3, 'XXX_STOCK'),
+            self.buy('stock', 4, 'STOCK')
+        ]
+        self.tinkoff_profile.instruments = {
+            'XXX_STOCK': self.stock('XXX_STOCK', currency='XXX'), 'STOCK': self.stock('STOCK')
+        }
+        self.update_operations(0, 10)
+        operations = Operation.objects.filter(investment_account=self.investment_account)
+        self.assertEqual(set(operations.values_list('_id', flat=True)), {'stock'})
+        # Неподдерживаемый тип пропускается, остальные операции откладываются до следующей синхронизации
+        self.assertEqual(self.pending_ids(), {'server-error', 'unknown-currency'})
+        self.assertEqual(set(InstrumentType.objects.values_list('figi', flat=True)), {'STOCK'})
+
+        Currency.objects.create(iso_code='XXX', abbreviation='X', name='Валюта X')
+        self.tinkoff_profile.instruments['FAILED'] = self.stock('FAILED')
+        self.update_operations(0, 10)
+        self.assertEqual(
+            set(operations.values_list('_id', flat=True)), {'stock', 'server-error', 'unknown-currency'}
+        )
+        self.assertEqual(Transaction.objects.filter(operation__investment_account=self.investment_account).count(), 3)
+        self.assertEqual(self.pending_ids(), set())
+
+    def test_unresolved_instrument_is_given_up(self):
+        self.tinkoff_profile.operations_json = [self.buy('server-error', 2, 'FAILED'), self.buy('stock', 4, 'STOCK')]
+        self.tinkoff_profile.instruments = {'STOCK': self.stock('STOCK')}
+        with mock.patch.object(Updater, 'max_deferred_attempts', 2):
+            for attempt in (1, 2):
+                self.update_operations(0, 10)
+                self.assertEqual(
+                    list(PendingOperation.objects.values_list('_id', 'deferred_attempts')), [('server-error', attempt)]
+                )
+            self.update_operations(0, 10)
+        # Операция пропущена и больше не держит начало синхронизации
+        self.assertEqual(self.pending_ids(), set())
+        self.assertEqual(
+            set(Operation.objects.filter(investment_account=self.investment_account).values_list('_id', flat=True)),
+            {'stock'}
+        )
+
+
+def assign_deals_with_orm(investment_account_id: int, operations: List[Operation]) -> None:
+    """ Прежнее распределение операций по сделкам: запросы к БД на каждую операцию """
+    for operation in operations:
+        if is_proxy_instance(operation, (PurchaseOperation, SaleOperation)):
+            deal, created = Deal.objects.opened().get_or_create(
+                instrument_id=operation.instrument_id, investment_account_id=investment_account_id
+            )
+        else:
+            deal = (
+                Deal.objects
+                .filter(instrument_id=operation.instrument_id, investment_account_id=investment_account_id)
+                .annotate(opened_date=Min('operations__date'))
+                .filter(opened_date__lte=operation.date)
+                .order_by('opened_date').last()
+            )
+            if deal is None:
+                continue
+        deal.operations.add(operation)
+
+
+class DealAssemblerTest(TestCase):
+    start = dt.datetime(2020, 1, 1, tzinfo=pytz.utc)
+    operation_models = {
+        OperationTypes.BUY: InvestmentAccountPurchaseOperation,
+        OperationTypes.SELL: SaleOperation,
+        OperationTypes.DIVIDEND: DividendOperation
+    }
+
+    def setUp(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        self.instruments = [
+            StockInstrument.objects.create(
+                figi=f'FIGI{number}', name=f'Stock {number}', ticker=f'S{number}', lot=1, currency=currency,
+                isin=f'ISIN{number}'
+            )
+            for number in range(2)
+        ]
+        co_owner = Investor.objects.create(username='co_owner')
+        self.investment_accounts = []
+        for username in ('orm', 'assembler'):
+            investment_account = create_investment_account(Investor.objects.create(username=username))
+            CoOwner.objects.create(investor=co_owner, investment_account=investment_account)
+            Capital.objects.filter(co_owner__investor=co_owner).update(default_share=Decimal('0.5'))
+            self.investment_accounts.append(investment_account)
+
+    def generate_operations(self, rnd: random.Random, count: int):
+        """ Покупки, продажи (не больше купленного, поэтому сделки закрываются) и дивиденды,
+            в том числе до первой покупки
+        """
+        held = collections.Counter()
+        specs = []
+        for number in range(count):
+            figi = rnd.choice(self.instruments).figi
+            operation_type = rnd.choice((OperationTypes.BUY, OperationTypes.SELL, OperationTypes.DIVIDEND))
+            if operation_type == OperationTypes.SELL and not held[figi]:
+                operation_type = OperationTypes.BUY
+            quantity = 0
+            if operation_type == OperationTypes.BUY:
+                quantity = rnd.randint(1, 3)
+                held[figi] += quantity
+            elif operation_type == OperationTypes.SELL:
+                quantity = rnd.choice((held[figi], rnd.randint(1, held[figi])))
+                held[figi] -= quantity
+            specs.append((number, operation_type, figi, quantity))
+        return specs
+
+    def create_operations(self, investment_account, specs) -> List[Operation]:
+        operations = []
+        for number, operation_type, figi, quantity in specs:
+            payment = {OperationTypes.BUY: -10 * quantity, OperationTypes.SELL: 12 * quantity}.get(operation_type, 5)
+            operations.append(self.operation_models[operation_type].objects.create(
+                investment_account=investment_account, date=self.start + dt.timedelta(hours=number),
+                payment=payment, currency_id='USD', instrument_id=figi, quantity=quantity,
+                _id=f'{investment_account.pk}-{number}'
+            ))
+        return operations
+
+    def deals(self, investment_account):
+        """ Сделки ИС в виде номеров операций """
+        operations = Operation.objects.filter(investment_account=investment_account, deal__isnull=False)
+        deals = collections.defaultdict(set)
+        for _id, deal_id in operations.values_list('_id', 'deal_id'):
+            deals[deal_id].add(int(_id.split('-')[1]))
+        return sorted(map(sorted, deals.values()))
+
+    def test_matches_orm_assignment(self):
+        rnd = random.Random(0)
+        specs = self.generate_operations(rnd, 300)
+        orm_account, assembler_account = self.investment_accounts
+        # Несколько синхронизаций: сделки из прошлых загружаются из БД
+        for part in (specs[:100], specs[100:101], specs[101:]):
+            assign_deals_with_orm(orm_account.pk, self.create_operations(orm_account, part))
+            assembler = DealAssembler.for_investment_account(assembler_account)
+            assembler.assemble(self.create_operations(assembler_account, part))
+        self.assertEqual(self.deals(assembler_account), self.deals(orm_account))
+        self.assertGreater(Deal.objects.filter(investment_account=assembler_account).count(), 2)
+
+        operations = Operation.objects.filter(investment_account=assembler_account)
+        self.assertTrue(operations.filter(deal__isnull=True).exists())
+        # Доли только у операций, попавших в сделку
+        shares = Share.objects.filter(operation__investment_account=assembler_account)
+        self.assertFalse(shares.filter(operation__deal__isnull=True).exists())
+        self.assertEqual(shares.count(), 2 * operations.filter(deal__isnull=False).count())
+        self.assertEqual(set(shares.values_list('co_owner__investor__username', 'value')), {
+            ('assembler', Decimal(1)), ('co_owner', Decimal('0.5'))
+        })
+
+
+class FakeTinkoffApi(Transport):
+    """ Tinkoff API в памяти: ответы на запросы синхронизации ИС """
+    def __init__(self, operations: List[dict], instruments: List[dict]):
+        self.operations = operations
+        self.instruments = {instrument['figi']: instrument for instrument in instruments}
+
+    def request(self, method: str, url: str, params=None, **kwargs) -> ReplayResponse:
+        url = urlparse(url)
+        path = url.path[len(urlparse(TinkoffApiUrl.production_url).path):]
+        if path == 'user/accounts/':
+            payload = {'accounts': [{'brokerAccountType': 'Tinkoff', 'brokerAccountId': '1'}]}
+        elif path == 'portfolio/currencies/':
+            payload = {'currencies': [{'currency': 'USD', 'balance': 10}]}
+        elif path == 'portfolio/':
+            payload = {'positions': [{
+                'figi': 'FIGI1', 'instrumentType': 'Stock', 'balance': 1, 'lots': 1,
+                'averagePositionPrice': {'currency': 'USD', 'value': 10},
+                'expectedYield': {'currency': 'USD', 'value': 2}
+            }]}
+        elif path == 'operations/':
+            from_datetime, to_datetime = (dt.datetime.fromisoformat(params[key]) for key in ('from', 'to'))
+            payload = {'operations': [
+                operation for operation in self.operations
+                if from_datetime <= dt.datetime.fromisoformat(operation['date']) < to_datetime
+            ][::-1]}
+        elif path == 'market/search/by-figi/':
+            payload = self.instruments[parse_qs(url.query)['figi'][0]]
+        else:
+            return ReplayResponse(404, {}, '')
+        return ReplayResponse(200, {}, json.dumps({'payload': payload}))
+
+
+class ReplaySyncTest(TestCase):
+    start = dt.datetime(2020, 1, 1, tzinfo=pytz.utc)
+
+    def setUp(self):
+        Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        StockInstrument.objects.create(
+            figi='FIGI1', name='Stock', ticker='S1', lot=1, currency_id='USD', isin='ISIN1'
+        )
+        self.creator = Investor.objects.create(username='creator')
+        self.investment_account = create_investment_account(self.creator, sync_at=self.start, broker_account_id='1')
+        self.creator.default_investment_account = self.investment_account
+        self.creator.save()
+        operations = [
+            self.trade('buy1', 1, 'FIGI1', OperationTypes.BUY, 2),
+            self.trade('buy2', 2, 'FIGI2', OperationTypes.BUY, 3),
+            self.trade('sell1', 300 * 24, 'FIGI1', OperationTypes.SELL, 1),
+            {
+                'id': 'dividend1', 'status': 'Done', 'operationType': OperationTypes.DIVIDEND,
+                'date': self.at(400 * 24).isoformat(), 'isMarginCall': False, 'payment': 5, 'currency': 'USD',
+                'figi': 'FIGI2', 'instrumentType': 'Stock'
+            }
+        ]
+        instruments = [{
+            'figi': 'FIGI2', 'ticker': 'S2', 'isin': 'ISIN2', 'minPriceIncrement': 0.01, 'lot': 1,
+            'currency': 'USD', 'name': 'Stock 2', 'type': InstrumentType.Types.STOCK
+        }]
+        self.api = FakeTinkoffApi(operations, instruments)
+
+    def at(self, hours: float) -> dt.datetime:
+        return self.start + dt.timedelta(hours=hours)
+
+    def trade(self, _id: str, hours: float, figi: str, operation_type: str, quantity: int) -> dict:
+        date = self.at(hours).isoformat()
+        payment = -10 * quantity if operation_type == OperationTypes.BUY else 12 * quantity
+        return {
+            'id': _id, 'status': 'Done', 'operationType': operation_type, 'date': date, 'isMarginCall': False,
+            'payment': payment, 'currency': 'USD', 'figi': figi, 'instrumentType': 'Stock', 'quantity': quantity,
+            'commission': {'currency': 'USD', 'value': -0.1},
+            'trades': [{'tradeId': f'{_id}-trade', 'date': date, 'quantity': quantity, 'price': 10}]
+        }
+
+    def snapshot(self):
+        self.investment_account.refresh_from_db()
+        return (
+            self.investment_account.sync_at,
+            sorted(Operation.objects.values_list('_id', 'type', 'payment', 'instrument_id', 'deal__instrument_id')),
+            sorted(DealIncome.objects.values_list('deal__instrument_id', 'co_owner_id', 'value')),
+            sorted(self.investment_account.portfolio_positions.values_list('figi', 'balance')),
+            sorted(self.investment_account.currency_assets.values_list('currency_id', 'value'))
+        )
+
+    # Несколько окон операций (from/to входят в ключ запроса), но без ожидания лимита запросов
+    @mock.patch.object(TinkoffProfile, 'operations_window', dt.timedelta(days=3 * 365))
+    def test_replay_matches_recorded_sync(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cassette = os.path.join(directory, 'sync.json')
+            with mock.patch('tinkoff_api._transport.RequestsTransport', return_value=self.api):
+                call_command('replay_sync', cassette, account=self.investment_account.pk, record=True,
+                             stdout=io.StringIO())
+            recorded = self.snapshot()
+            self.assertEqual(len(recorded[1]), 4)
+
+            # Воспроизведение в ИС до синхронизации, без сети
+            Operation.objects.all().delete()
+            Deal.objects.all().delete()
+            StockInstrument.objects.filter(figi='FIGI2').delete()
+            self.investment_account.portfolio_positions.all().delete()
+            self.investment_account.currency_assets.all().delete()
+            InvestmentAccount.objects.filter(pk=self.investment_account.pk).update(
+                sync_at=self.start, operations_watermark=None
+            )
+            stdout = io.StringIO()
+            with mock.patch('tinkoff_api._transport.RequestsTransport', side_effect=AssertionError('Запрос по сети')):
+                call_command('replay_sync', cassette, account=self.investment_account.pk, stdout=stdout)
+        self.assertEqual(self.snapshot(), recorded)
+        self.assertIn('recalculation_income', stdout.getvalue())
+
+        client = Client()
+        client.force_login(self.creator)
+        response = client.get(reverse('deals'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {deal['instrument_figi'] for deal in response.context['opened_deals']}, {'FIGI1', 'FIGI2'}
+        )
+
+
+class SyncJobTest(TestCase):
+    now = dt.datetime(2020, 6, 1, tzinfo=pytz.utc)
+
+    def setUp(self):
+        sync_at = self.now - dt.timedelta(days=1)
+        self.investment_accounts = [
+            create_investment_account(Investor.objects.create(username=username), sync_at=sync_at)
+            for username in ('first', 'second')
+        ]
+
+    def test_enqueue_due_counts_created_jobs(self):
+        self.assertEqual(SyncJob.objects.enqueue_due(self.now), 2)
+        self.assertEqual(SyncJob.objects.enqueue_due(self.now + dt.timedelta(seconds=1)), 0)
+
+    def test_enqueue_due_skips_conflicts(self):
+        SyncJob.objects.create(investment_account=self.investment_accounts[0], scheduled_at=self.now)
+        # Другой планировщик поставил задачу между проверкой очереди и записью
+        with mock.patch.object(SyncJobQuerySet, 'active', lambda queryset: queryset.filter(status='')):
+            self.assertEqual(SyncJob.objects.enqueue_due(self.now + dt.timedelta(seconds=1)), 1)
+        self.assertEqual(SyncJob.objects.count(), 2)
+
+    def test_claim(self):
+        first, second = self.investment_accounts
+        late = SyncJob.objects.create(investment_account=first, scheduled_at=self.now - dt.timedelta(minutes=1))
+        early = SyncJob.objects.create(investment_account=second, scheduled_at=self.now - dt.timedelta(minutes=2))
+        self.assertEqual(SyncJob.objects.claim(self.now), [early])
+        early.refresh_from_db()
+        self.assertEqual(
+            (early.status, early.started_at, early.attempts), (SyncJob.Status.RUNNING, self.now, 1)
+        )
+        self.assertEqual(SyncJob.objects.claim(self.now, limit=5), [late])
+        self.assertEqual(SyncJob.objects.claim(self.now, limit=5), [])
+
+    def test_claim_skips_future_jobs(self):
+        SyncJob.objects.create(investment_account=self.investment_accounts[0], scheduled_at=self.now)
+        self.assertEqual(SyncJob.objects.claim(self.now - dt.timedelta(seconds=1)), [])
+
+    def test_release_stale(self):
+        timeout = dt.timedelta(minutes=30)
+        stale, running = [
+            SyncJob.objects.create(
+                investment_account=investment_account, status=SyncJob.Status.RUNNING,
+                scheduled_at=started_at, started_at=started_at
+            )
+            for investment_account, started_at in zip(
+                self.investment_accounts, (self.now - timeout * 2, self.now - timeout / 2)
+            )
+        ]
+        self.assertEqual(SyncJob.objects.release_stale(self.now, timeout), 1)
+        stale.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual((stale.status, stale.scheduled_at), (SyncJob.Status.PENDING, self.now))
+        self.assertEqual(running.status, SyncJob.Status.RUNNING)
+
+    def test_failed_sync_fails_job(self):
+        for error in (InvalidTokenError('Авторизация по токенам не удалась'), requests.exceptions.ConnectionError()):
+            SyncJob.objects.all().delete()
+            job = SyncJob.objects.create(investment_account=self.investment_accounts[0], scheduled_at=self.now)
+            with mock.patch('users.models.Updater', side_effect=error):
+                SyncWorker().run_job(job)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.error), (SyncJob.Status.FAILED, repr(error)))
+
+    def test_created_account_is_enqueued(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        creator = Investor.objects.create(username='creator')
+        # Обработчик создания ИС не обращается к брокеру
+        with mock.patch('users.models.Updater', side_effect=AssertionError('Запрос к Tinkoff API')):
+            investment_account = InvestmentAccount.objects.create(
+                name='ИС', creator=creator, token='token', broker_account_id='1'
+            )
+        job = SyncJob.objects.get(investment_account=investment_account)
+        self.assertEqual(job.status, SyncJob.Status.PENDING)
+        PayInOperation.objects.create(
+            investment_account=investment_account, date=self.now, payment=100, currency=currency, _id='pay'
+        )
+        with mock.patch('users.models.Updater') as updater:
+            updater.return_value.watermark = None
+            SyncWorker().run_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, SyncJob.Status.DONE)
+        # После первой синхронизации капитал ИС отдается создателю
+        self.assertEqual(
+            Capital.objects.get(co_owner__investor=creator, currency=currency).value, Decimal(100)
+        )
+
+
+class PortfolioPositionTest(TestCase):
+    def test_by_figi(self):
+        investment_account = create_investment_account(Investor.objects.create(username='creator'))
+        PortfolioPosition.objects.bulk_create([
+            PortfolioPosition(investment_account=investment_account, figi=figi, instrument_type='Stock', balance=1)
+            for figi in ('FIGI1', 'FIGI2')
+        ])
+        positions = PortfolioPosition.objects.filter(investment_account=investment_account).by_figi()
+        self.assertEqual(positions.keys(), {'FIGI1', 'FIGI2'})
+        self.assertEqual(positions['FIGI2'].figi, 'FIGI2')
+        self.assertEqual(PortfolioPosition.objects.none().by_figi(), {})
+
+
+class OutdatedIncomesTest(TestCase):
+    now = dt.datetime(2020, 6, 1, tzinfo=pytz.utc)
+
+    def setUp(self):
+        currency = Currency.objects.create(iso_code='USD', abbreviation='$', name='Доллар')
+        creator = Investor.objects.create(username='creator')
+        self.investment_account = create_investment_account(creator)
+        CoOwner.objects.create(
+            investor=Investor.objects.create(username='co_owner'), investment_account=self.investment_account
+        )
+        instrument = StockInstrument.objects.create(
+            figi='FIGI', name='Apple', ticker='AAPL', lot=1, currency=currency, isin='US0378331005'
+        )
+        self.deal = Deal.objects.create(instrument=instrument, investment_account=self.investment_account)
+        create_deal_operations(random.Random(0), self.deal, dt.datetime(2020, 1, 1, tzinfo=pytz.utc), 20)
+        IncomeEngine(self.investment_account.pk).run()
+        self.stale_incomes = self.deal_incomes()
+        # Совладелец отказался от доли в сделке
+        Share.objects.filter(operation__deal=self.deal, co_owner__investor=creator).update(value=0)
+
+    def deal_incomes(self):
+        return dict(DealIncome.objects.filter(deal=self.deal).values_list('co_owner_id', 'capital'))
+
+    def assert_recalculated(self):
+        self.assertFalse(Deal.objects.income_outdated().exists())
+        incomes = self.deal_incomes()
+        self.assertNotEqual(incomes, self.stale_incomes)
+        IncomeEngine(self.investment_account.pk, deal_ids=[self.deal.pk]).run()
+        self.assertEqual(incomes, self.deal_incomes())
+
+    def test_update_deals_replays_outdated_deals(self):
+        Deal.objects.filter(pk=self.deal.pk).mark_income_outdated(self.now)
+        updater = Updater(
+            self.now - dt.timedelta(days=1), self.now, self.investment_account.pk,
+            tinkoff_profile=FakeTinkoffProfile()
+        )
+        updater.update_deals()
+        self.assert_recalculated()
+
+    def test_recalculation_waits_for_delay(self):
+        delay = dt.timedelta(seconds=5)
+        Deal.objects.filter(pk=self.deal.pk).mark_income_outdated(self.now)
+        # Доли могут еще меняться, пересчет откладывается
+        self.assertEqual(Deal.objects.recalculate_outdated_incomes(delay, self.now + delay / 2), 0)
+        self.assertEqual(self.deal_incomes(), self.stale_incomes)
+        self.assertEqual(Deal.objects.recalculate_outdated_incomes(delay, self.now + delay), 1)
+        self.assert_recalculated()
+
+    def test_failed_deal_does_not_stop_worker(self):
+        instrument = StockInstrument.objects.create(
+            figi='FIGI2', name='Microsoft', ticker='MSFT', lot=1, currency=self.deal.instrument.currency,
+            isin='US5949181045'
+        )
+        failing_deal = Deal.objects.create(instrument=instrument, investment_account=self.investment_account)
+        create_deal_operations(random.Random(1), failing_deal, dt.datetime(2020, 2, 1, tzinfo=pytz.utc), 5)
+        Deal.objects.all().mark_income_outdated(self.now)
+        run = IncomeEngine.run
+
+        def run_or_fail(engine):
+            if failing_deal.pk in engine.deal_ids:
+                raise ValueError('Валюта операции не совпадает с валютой сделки')
+            return run(engine)
+
+        later = self.now + dt.timedelta(minutes=1)
+        with mock.patch.object(IncomeEngine, 'run', run_or_fail), \
+                mock.patch('django.utils.timezone.now', return_value=later), \
+                mock.patch.object(Deal, 'income_recalculation_delay', return_value=dt.timedelta(0)):
+            self.assertEqual(SyncWorker().recalculate_incomes(), 1)
+        self.assertEqual(list(Deal.objects.income_outdated().values_list('pk', 'income_outdated_at')), [
+            (failing_deal.pk, later)
+        ])
+        self.assertNotEqual(self.deal_incomes(), self.stale_incomes)
+        # Сбой БД тоже не останавливает воркер
+        with mock.patch.object(DealQuerySet, 'recalculate_outdated_incomes', side_effect=DatabaseError):
+            self.assertEqual(SyncWorker().recalculate_incomes(), 0)